@@ -0,0 +1,63 @@
+"""
+    Parse throughput of uncompressed and compressed POS files.
+
+    usage: python benchmark.py pos_file.xml [pos_file.xml ...] [--repeat 3]
+
+    Every file is written as .xml, .xml.gz and, if zstandard is installed, as .xml.zst
+    to a temporary directory. Each variant is parsed with PosXml and the best time of
+    [repeat] runs is reported as MB/s of uncompressed document.
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.compressed_file import CompressedFile
+
+
+def best_time(func, repeat: int) -> float:
+    times = list()
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def benchmark_file(pos_file: Path, tmp_dir: Path, repeat: int):
+    data = pos_file.read_bytes()
+    mb = len(data) / 1024 / 1024
+    print(f'\n{pos_file.name} {mb:.1f} MB')
+    print(f'{"variant":<10}{"size MB":>10}{"write s":>10}{"parse s":>10}{"parse MB/s":>12}')
+
+    for suffix in [''] + CompressedFile.supported_suffixes():
+        variant = tmp_dir / f'{pos_file.stem}.xml{suffix}'
+
+        def write():
+            with CompressedFile.writer(variant) as f:
+                f.write(data)
+
+        write_time = best_time(write, 1)
+
+        def parse():
+            PosXml(variant, progress=lambda label, done, total: None)
+
+        parse_time = best_time(parse, repeat)
+        print(f'{suffix or ".xml":<10}{variant.stat().st_size / 1024 / 1024:>10.1f}{write_time:>10.2f}'
+              f'{parse_time:>10.2f}{mb / parse_time:>12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse throughput of uncompressed and compressed POS files.')
+    parser.add_argument('pos_files', nargs='+', type=Path)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='PosSchnuffi_benchmark_') as tmp_dir:
+        for pos_file in args.pos_files:
+            benchmark_file(pos_file, Path(tmp_dir), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from schnuffi import VERSION
 from subprocess import Popen
 # from private.sftp import Remote
 from modules.utils.globals import UPDATE_VERSION_FILE, UPDATE_INSTALL_FILE
+from ui.compile_ui import compile_ui
 
 import shutil
 import winreg
@@ -86,6 +87,10 @@ def main(process: int=0):
     update_version_info(out_dir)
 
     if process in (0, 1, 2):
+        # Create python UI classes, the application falls back to runtime loading of *.ui files
+        if not compile_ui():
+            print('UI classes could not be compiled. Continuing with runtime loaded UI files.')
+
         # Build with PyInstaller
         args = ['pyinstaller', '--noconfirm', SPEC_FILE]
         p = Popen(args=args)
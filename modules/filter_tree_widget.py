@@ -1,16 +1,51 @@
 import re
 from typing import Tuple
 
-from PySide2.QtCore import QEvent, QModelIndex, QObject, QTimer, Qt, Signal
+from PySide2.QtCore import QEvent, QModelIndex, QObject, QPersistentModelIndex, QTimer, Qt, Signal
 from PySide2.QtWidgets import QLineEdit, QTreeWidgetItemIterator, QWidget
 
 from modules.utils.animation import BgrAnimation
+from modules.utils.cancel import NO_CANCEL
 from modules.utils.gui_utils import iterate_widget_items_flat
+from modules.utils.instrumentation import Timing
+from modules.utils.job_scheduler import JobPriority, JobScheduler
 from modules.utils.log import init_logging
 
 LOGGER = init_logging(__name__)
 
 
+def match_rows(rows: list, filter_text: str, cancel_token=NO_CANCEL, progress=None) -> list:
+    """ Item changes (key, hide, expand) for rows (key, parent_key, text, selected) of a tree widget.
+        Keys identify the items, parent_key is None for top level items.
+        Space separated filter strings have to match all, an expand value of -1 scrolls to the item.
+    """
+    with Timing.span('filter'):
+        words = filter_text.split(' ')
+        changes = list()
+
+        for row_num, (key, parent_key, txt, selected) in enumerate(rows):
+            if not row_num % 1000:
+                cancel_token.check()
+
+            # Match space separated filter strings with AND
+            if not all(re.search(word, txt, flags=re.IGNORECASE) for word in words):
+                # Hide all non-matching items
+                changes.append((key, True, 0))
+                continue
+
+            # Un-hide
+            changes.append((key, False, 0))
+
+            if parent_key is not None:
+                # Show and expand parent
+                changes.append((parent_key, False, 1))
+
+            if selected:
+                changes.append((key, False, -1))
+
+    return changes
+
+
 class TreeWidgetFilter(QObject):
     change_item = Signal(QModelIndex, bool, int)
     scroll_to_signal = Signal(QModelIndex)
@@ -21,6 +56,9 @@ class TreeWidgetFilter(QObject):
         self.widget = widget
         self.columns = columns
         self.clean = True
+        self.filter_job = None
+        # key: QPersistentModelIndex of the items read for the running filter job
+        self.filter_indexes = dict()
 
         self.filter_timer = QTimer()
         self.filter_timer.setSingleShot(True)
@@ -115,8 +153,14 @@ class TreeWidgetFilter(QObject):
             self.clean = True
 
     def search(self):
+        if self.filter_job is not None:
+            self.filter_job.cancel()
+
         self._prepare_filtering()
 
+        # Item texts are read here, matching runs as an interactive job off the GUI thread. The job only
+        # receives item keys, the view may be cleared or re-populated until it's result is applied.
+        rows, self.filter_indexes = list(), dict()
         for item in iterate_widget_items_flat(self.widget):
             txt = ''
             for c in self.columns:
@@ -126,33 +170,69 @@ class TreeWidgetFilter(QObject):
             if txt:
                 txt = txt[:-1]
 
-            # Show everything and collapse parents
             index = self.widget.indexFromItem(item)
             parent_index = self.widget.indexFromItem(item.parent())
-
-            results = list()
-
-            # Match space separated filter strings with AND
-            for word in self.line_edit.text().split(' '):
-                results.append(True if re.search(word, txt, flags=re.IGNORECASE) else False)
-
-            if not all(results):
-                # Hide all non-matching items
-                self.change_item.emit(index, True, 0)
+            # QTreeWidget indexes point to their item, the pointer is unique while the item exists
+            key = index.internalId()
+            self.filter_indexes[key] = QPersistentModelIndex(index)
+            rows.append((key, parent_index.internalId() if parent_index.isValid() else None, txt, item.isSelected()))
+
+        self.filter_job = JobScheduler.create_job(match_rows, rows, self.line_edit.text(), name='filter',
+                                                  priority=JobPriority.INTERACTIVE, cooperative=True)
+        self.filter_job.signals.finished.connect(self._apply_matches)
+        self.filter_job.signals.failed.connect(self._filter_failed)
+        JobScheduler.enqueue(self.filter_job)
+
+        # Keep the widget hidden until the matches are applied
+        self.busy_timer.stop()
+
+    def _is_current_job(self) -> bool:
+        """ Ignore results of a previous filter job that finished while it was replaced """
+        return self.filter_job is not None and self.sender() is self.filter_job.signals
+
+    def _apply_matches(self, changes: list):
+        if not self._is_current_job():
+            return
+        self.filter_job = None
+        indexes, self.filter_indexes = self.filter_indexes, dict()
+        applied = False
+
+        for key, hide, expand in changes:
+            # Items removed since the filter started invalidate their persistent index
+            persistent_index = indexes.get(key)
+            if persistent_index is None or not persistent_index.isValid():
                 continue
+            index = self.widget.model().index(persistent_index.row(), persistent_index.column(),
+                                              persistent_index.parent())
+            applied = True
 
-            # Un-hide
-            self.change_item.emit(index, False, 0)
-        
-            if parent_index:
-                # Show and expand parent
-                self.change_item.emit(parent_index, False, 1)
-        
-            # Scroll to selection
-            if item.isSelected():
+            if expand == -1:
+                # Scroll to selection
                 self.scroll_to_signal.emit(index)
+            else:
+                self.change_item.emit(index, hide, expand)
+
+        if not applied:
+            self.filtering_finished()
+
+    def _filter_failed(self, error: str):
+        if not self._is_current_job():
+            return
+        self.filter_job = None
+        self.filter_indexes = dict()
+        LOGGER.info('Filter on %s failed: %s', self.widget.objectName(), error)
+        self.filtering_finished()
 
     def restore(self):
+        with Timing.span('filter'):
+            self._restore()
+
+    def _restore(self):
+        if self.filter_job is not None:
+            self.filter_job.cancel()
+            self.filter_job = None
+            self.filter_indexes = dict()
+
         self._prepare_filtering()
 
         for item in iterate_widget_items_flat(self.widget):
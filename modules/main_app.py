@@ -1,10 +1,12 @@
 import sys
+from time import perf_counter
 
+from PySide2.QtCore import QTimer
 from PySide2.QtWidgets import QApplication, QTreeWidget, QWidget
 
 from modules.pos_schnuffi_ui import SchnuffiWindow
 from modules.utils.globals import APP_NAME
-from modules.utils.gui_utils import KnechtExceptionHook
+from modules.utils.gui_utils import KnechtExceptionHook, time_string
 from modules.utils.language import get_translation
 from modules.utils.log import init_logging
 
@@ -21,8 +23,14 @@ LOGGER = init_logging(__name__)
 
 class SchnuffiApp(QApplication):
 
-    def __init__(self, version: str):
+    def __init__(self, version: str, start_time: float=0.0):
+        """
+
+        :param str version: application version
+        :param float start_time: time.perf_counter() value at process start to measure start up time
+        """
         super(SchnuffiApp, self).__init__(sys.argv)
+        self.start_time = start_time or perf_counter()
         self.setApplicationName(APP_NAME)
         self.setApplicationVersion(version)
         self.setApplicationDisplayName(self.applicationName())
@@ -42,6 +50,22 @@ class SchnuffiApp(QApplication):
         KnechtExceptionHook.app = self
         KnechtExceptionHook.setup_signal_destination(self.report_exception)
 
+        # Measure start up once the event loop has shown the main window
+        QTimer.singleShot(0, self.report_startup_time)
+
+        # Start parsing the last used POS files in the background
+        QTimer.singleShot(0, self.preload_last_used)
+
+    @staticmethod
+    def preload_last_used():
+        from modules.pos_schnuffi_preload import PosXmlPreloader
+        PosXmlPreloader.preload_last_used()
+
+    def report_startup_time(self):
+        startup_time = perf_counter() - self.start_time
+        LOGGER.info('Main window shown %.3fs after process start.', startup_time)
+        self.pos_ui.statusBar().showMessage(_('Gestartet in {}').format(time_string(startup_time)), 5000)
+
     def app_focus_changed(self, old_widget: QWidget, new_widget: QWidget):
         if isinstance(new_widget, QTreeWidget):
             self.last_focus_tree = new_widget
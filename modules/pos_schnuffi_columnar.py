@@ -0,0 +1,164 @@
+"""
+    Columnar export of POS documents for analysis eg. with pandas or DuckDB.
+
+    Every document is written as two tables, one row per action of every actionList:
+        document, actionList, actor, value, type
+    The actions table contains actions of every type, not only the switch, appearance and stateObject
+    actors PosXml compares.
+    and one row per stateObject a condition links to it's actionList:
+        document, actionList, stateObject
+
+    Documents are read with iterparse and written in record batches, memory use is bounded by the
+    batch size and not by the size of the document. Parquet and Arrow IPC require the optional
+    pyarrow package.
+"""
+from pathlib import Path
+from typing import Union
+
+import lxml.etree as Et
+
+from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class _BatchWriter:
+    """ Collects rows column wise and writes them as record batch once [batch_rows] are collected """
+    def __init__(self, file_obj, columns: tuple, file_format: str, batch_rows: int):
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in columns])
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._columns = [list() for _ in columns]
+
+        if file_format == ColumnarExport.PARQUET:
+            self._writer = pyarrow.parquet.ParquetWriter(file_obj, self.schema,
+                                                         compression=ColumnarExport.parquet_compression)
+        else:
+            self._writer = pyarrow.ipc.new_file(file_obj, self.schema)
+
+    def append(self, row: tuple):
+        for column, value in zip(self._columns, row):
+            column.append(value)
+
+        if len(self._columns[0]) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._columns[0]:
+            return
+
+        batch = pyarrow.record_batch([pyarrow.array(c, pyarrow.string()) for c in self._columns], schema=self.schema)
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+        for column in self._columns:
+            column.clear()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class ColumnarExport:
+    """ Convert POS documents to Parquet or Arrow IPC tables of actions and condition links """
+    PARQUET, ARROW = 'parquet', 'arrow'
+    suffixes = {PARQUET: '.parquet', ARROW: '.arrow'}
+
+    ACTION_COLUMNS = ('document', 'actionList', 'actor', 'value', 'type')
+    CONDITION_COLUMNS = ('document', 'actionList', 'stateObject')
+
+    batch_rows = 64 * 1024
+    parquet_compression = 'zstd'
+
+    @staticmethod
+    def available() -> bool:
+        return pyarrow is not None
+
+    @staticmethod
+    def document_name(pos_file: Union[Path, str]) -> str:
+        """ File name without compression and POS suffix eg. pos_2020 for pos_2020.xml.gz """
+        name = Path(pos_file).name
+        for suffixes in (CompressedFile.suffixes, CompressedFile.pos_suffixes):
+            for suffix in suffixes:
+                if name.casefold().endswith(suffix):
+                    name = name[:-len(suffix)]
+                    break
+        return name
+
+    @classmethod
+    def output_files(cls, pos_file: Union[Path, str], out_dir: Union[Path, str], file_format: str=PARQUET):
+        """ Paths of the action and condition table of [pos_file] in [out_dir] """
+        name, suffix = cls.document_name(pos_file), cls.suffixes[file_format]
+        return Path(out_dir) / f'{name}.actions{suffix}', Path(out_dir) / f'{name}.conditions{suffix}'
+
+    @classmethod
+    def write(cls, pos_file: Union[Path, str], out_dir: Union[Path, str], file_format: str=PARQUET,
+              cancel_token=NO_CANCEL, progress=None) -> dict:
+        """ Write the action and condition tables of [pos_file] to [out_dir]. The files are replaced
+            only once both are completely written.
+
+            :returns: dict of the written files and their number of rows
+        """
+        if not cls.available():
+            raise OSError('The columnar export requires the pyarrow package.')
+        if file_format not in cls.suffixes:
+            raise ValueError(f'Unsupported columnar format {file_format}, use one of {", ".join(cls.suffixes)}')
+
+        pos_file = Path(pos_file)
+        actions_file, conditions_file = cls.output_files(pos_file, out_dir, file_format)
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+        with CompressedFile.writer(actions_file, atomic=True) as actions_obj, \
+                CompressedFile.writer(conditions_file, atomic=True) as conditions_obj:
+            actions = _BatchWriter(actions_obj, cls.ACTION_COLUMNS, file_format, cls.batch_rows)
+            conditions = _BatchWriter(conditions_obj, cls.CONDITION_COLUMNS, file_format, cls.batch_rows)
+
+            cls._convert(pos_file, actions, conditions, cancel_token, progress)
+
+            actions.close()
+            conditions.close()
+
+        LOGGER.info('Converted %s to %s actions and %s condition links.', pos_file.name, actions.rows, conditions.rows)
+        return {'actions': {'file': actions_file.as_posix(), 'rows': actions.rows},
+                'conditions': {'file': conditions_file.as_posix(), 'rows': conditions.rows}}
+
+    @classmethod
+    def _convert(cls, pos_file: Path, actions: _BatchWriter, conditions: _BatchWriter, cancel_token, progress):
+        document = cls.document_name(pos_file)
+        label = _('{} konvertieren').format(pos_file.name)
+
+        with CompressedFile.reader(pos_file, label, progress, cancel_token) as reader:
+            for _event, e in Et.iterparse(reader, events=('end', ), tag=('actionList', 'condition', 'stateObject')):
+                if e.tag == 'actionList':
+                    al_name = e.get('name')
+                    if al_name:
+                        for actor, value, action_type in PosXml.iterate_actions(e):
+                            actions.append((document, al_name, actor, value, action_type))
+                elif e.tag == 'condition':
+                    al_name, state_objects = PosXml.condition_links(e)
+                    if al_name:
+                        for state_object in state_objects:
+                            conditions.append((document, al_name, state_object))
+
+                # Drop the processed element and everything before it
+                e.clear()
+                parent = e.getparent()
+                if parent is not None:
+                    while e.getprevious() is not None:
+                        del parent[0]
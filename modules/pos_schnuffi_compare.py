@@ -1,131 +1,324 @@
+import multiprocessing
+from pathlib import Path
+
+from modules.pos_schnuffi_diff_cache import DiffCache
+from modules.pos_schnuffi_incremental import IncrementalDiff
+from modules.pos_schnuffi_preload import PosXmlPreloader
+from modules.pos_schnuffi_worker import compare_process, iterate_diff_rows, load_or_create_diff
 from modules.pos_schnuffi_xml_diff import PosDiff
+from modules.utils.cancel import CancelToken, CancelledError
+from modules.utils.instrumentation import Timing
+from modules.utils.log import init_logging
+from modules.utils.profiler import Profiler
+from modules.utils.progress import ThrottledProgress
 
 from PySide2.QtWidgets import QTreeWidgetItem
 from PySide2 import QtCore
 
+LOGGER = init_logging(__name__)
+
 
 class GuiCompare(QtCore.QThread):
-    add_item = QtCore.Signal()
+    # Number of items in a batch put into the compare queue
+    add_items = QtCore.Signal(int)
     no_difference = QtCore.Signal()
     finished = QtCore.Signal()
     error_report = QtCore.Signal(str, int)
+    # Label, done, total - bytes parsed or actionLists diffed
+    progress = QtCore.Signal(str, 'qint64', 'qint64')
 
     item_flags = (QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEditable)
     item_uneditable_flags = (QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
 
-    def __init__(self, old_path, new_path, widgets, cmp_queue):
+    # Items are delivered to the GUI thread in batches of this size
+    batch_size = 250
+
+    def __init__(self, old_path, new_path, widgets, cmp_queue, diff=None, incremental=None, documents=(),
+                 file_hashes=None):
         super(GuiCompare, self).__init__()
         self.old_path, self.new_path = old_path, new_path
         self.cmp_queue = cmp_queue
 
-        self.widgets = widgets
+        # Diff result, provided eg. from a session or created by the compare
+        self.diff = diff
+        # IncrementalDiff of the previous compare of the same files
+        self.incremental = incremental
+        # PosXml of the previous compare, files that did not change since are not parsed again
+        self.documents = documents
+        # (old, new) DiffCache.file_hash of the compared content, recorded for sessions
+        self.file_hashes = file_hashes
 
-    def run(self):
-        diff = PosDiff(self.new_path, self.old_path)
+        self.widgets = widgets
+        self._batch = list()
 
-        # Populate added tree widget
-        self.add_action_list_items(diff.added_action_ls, 0)
+        self.cancel_token = CancelToken()
 
-        # Populate modified tree widget
-        self.add_action_list_items(diff.modified_action_ls, 1)
+    @Profiler.profiled('compare')
+    def run(self):
+        try:
+            self._compare()
+        except CancelledError:
+            LOGGER.info('Compare of %s and %s cancelled.', self.old_path, self.new_path)
 
-        # Populate removed tree widget
-        self.add_action_list_items(diff.removed_action_ls, 2)
+    def _compare(self):
+        progress = ThrottledProgress(self.progress.emit)
+        if self.diff is None:
+            self._hash_files(progress)
+        cache_key = self._create_diff(progress)
+        diff = self.diff
 
         # Populate error tab widget
         self.error_report.emit(diff.error_report, diff.error_num)
 
-        # Populate actor widgets
-        self.add_actor_items(diff)
+        with Timing.span('build_items'):
+            # Populate added, modified, removed, switches, looks, PosOld and PosNew tree widgets
+            for target, row in self._iterate_rows():
+                self.cancel_token.check()
+                self.add_item_queued(self.create_item(row), self.widgets[target])
 
-        # Populate PosOld
-        self._create_pos_action_list_items(diff.old, 5)
-
-        # Populate PosNew
-        self._create_pos_action_list_items(diff.new, 6)
+            self.flush_items()
 
         self.finished.emit()
 
         if diff.no_difference:
             self.no_difference.emit()
 
-    def _create_pos_action_list_items(self, xml_dict: dict, target: int):
-        for al_name, al_dict in xml_dict.items():
-            al = QTreeWidgetItem([al_name])
-            al.setFlags(self.item_flags)
-
-            for actor_name, actor_dict in al_dict.items():
-                actor = QTreeWidgetItem(al, [actor_name, actor_dict.get('value'), actor_dict.get('type')])
-                actor.setFlags(self.item_flags)
-
-            if al.childCount():
-                self.add_item_queued(al, self.widgets[target])
-
-    def add_action_list_items(self, action_list, target: int=0):
-        """
-        Create QTreeWidgetItem and add to target[int]
-            0 - added widget
-            1 - modified widget
-            2 - removed widget
-        """
-        for al in action_list:
-            item = self.__create_action_list_item(al)
-            self.add_item_queued(item, self.widgets[target])
-
-    def add_actor_items(self, diff_cls: PosDiff):
-        """
-        Create switches/looks items
-            target 0 - switches, 1 - looks
-        """
-        for target in range(0, 2):
-            if target == 0:
-                widget = self.widgets[3 + target]
-                add_set, rem_set, mod_set = diff_cls.add_switches, diff_cls.rem_switches, diff_cls.mod_switches
+        self._compare_finished(cache_key)
+
+    def _hash_files(self, progress):
+        """ Hash the files before they are diffed, the DiffCache remembers the hashes for the cache key """
+        try:
+            self.file_hashes = (DiffCache.file_hash(self.old_path, self.cancel_token, progress),
+                                DiffCache.file_hash(self.new_path, self.cancel_token, progress))
+        except OSError as e:
+            LOGGER.error('Can not hash POS files: %s', e)
+
+    def _create_diff(self, progress):
+        """ Set self.diff unless it was provided, returns the DiffCache key if the diff should be cached """
+        if self.diff is None and self.incremental is not None:
+            if self.incremental.update(self.cancel_token, progress):
+                self.diff = self.incremental.diff
             else:
-                widget = self.widgets[3 + target]
-                add_set, rem_set, mod_set = diff_cls.add_looks, diff_cls.rem_looks, diff_cls.mod_looks
-
-            add_text = f'{len(add_set):03d} Actors - hinzugefügt(kommen -nur- in neuer Xml vor)'
-            rem_text = f'{len(rem_set):03d} Actors - entfernt(in neuer Xml nicht mehr verwendet)'
-            mod_text = f'{len(mod_set):03d} Actors - geändert(Häufigkeit der Verwendung oder Werte verändert)'
-
-            item_num = 0
-            for parent, actor_set, parent_text in zip(
-                    (QTreeWidgetItem(), QTreeWidgetItem(), QTreeWidgetItem()),
-                    (add_set, rem_set, mod_set),
-                    (add_text, rem_text, mod_text)
-                    ):
-                for actor in actor_set:
-                    item = QTreeWidgetItem(parent, [actor])
-                    item.setFlags(self.item_flags)
-
-                if parent.childCount():
-                    parent.setData(0, QtCore.Qt.DisplayRole, f'{item_num} - {parent_text}')
-                    self.add_item_queued(parent, widget)
-                    item_num += 1
-                else:
-                    del parent
+                self.incremental = None
+
+        if self.diff is not None:
+            return None
+
+        self.diff, cache_key = load_or_create_diff(self.new_path, self.old_path, self.cancel_token, progress,
+                                                   preload=PosXmlPreloader.enabled(), documents=self.documents)
+        self.documents = ()
+        return cache_key
+
+    def _iterate_rows(self):
+        return iterate_diff_rows(self.diff)
+
+    def _compare_finished(self, cache_key):
+        if cache_key is not None:
+            with Timing.span('cache_save'):
+                DiffCache.save(self.diff, cache_key)
+
+        if self.incremental is None and IncrementalDiff.enabled():
+            # Index the files for the next compare of the same, changed files
+            self.incremental = IncrementalDiff.create(self.diff)
+
+    def cancel(self):
+        """ Request the compare to stop, the thread finishes at the next cancel check """
+        self.cancel_token.cancel()
+        self.stop()
+
+    def stop(self):
+        """ Stop work that does not end with the thread eg. worker processes """
+        pass
 
     def add_item_queued(self, item, widget):
-        self.add_item.emit()
-        __q = (item, widget)
-        self.cmp_queue.put(__q, block=False)
+        self._batch.append((item, widget))
+
+        if len(self._batch) >= self.batch_size:
+            self.flush_items()
+
+    def flush_items(self):
+        """ Deliver the accumulated items with one queue put and one signal """
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, list()
+        self.queue_batch(batch)
+
+    def queue_batch(self, batch: list):
+        """ Put a list of (item, widget) into the compare queue and inform the GUI thread """
+        Timing.count('items_queued', len(batch))
+        self.cmp_queue.put(batch, block=False)
+        self.add_items.emit(len(batch))
 
     @classmethod
-    def __create_action_list_item(cls, al):
-        list_item = QTreeWidgetItem([al.name])
-        list_item.setFlags(cls.item_flags)
+    def create_item(cls, row) -> QTreeWidgetItem:
+        """ Create a top level QTreeWidgetItem and it's children from a plain row of display texts """
+        columns, children = row
+        item = QTreeWidgetItem(list(columns))
+        item.setFlags(cls.item_flags)
+
+        for child_columns in children:
+            child = QTreeWidgetItem(item, list(child_columns))
+            child.setFlags(cls.item_flags)
+
+        return item
+
+
+class ProcessCompare(GuiCompare):
+    """
+        Parses and diffs in a separate process to keep CPU heavy work from competing with the
+        GUI event loop for the GIL. Rows arrive as batches of plain tuples over a pipe and are
+        queued as is, the GUI thread turns them into QTreeWidgetItems with GuiCompare.create_item.
+        The diff result follows as PosDiff.to_state once all rows are sent.
+    """
+    def __init__(self, old_path, new_path, widgets, cmp_queue, diff=None, incremental=None, documents=(),
+                 file_hashes=None):
+        super(ProcessCompare, self).__init__(old_path, new_path, widgets, cmp_queue, diff, incremental, documents,
+                                    file_hashes)
+        self.process = None
+
+    def _compare(self):
+        if self.diff is not None or self.incremental is not None:
+            # Nothing to parse or an incremental update, populate from the provided diff result
+            super(ProcessCompare, self)._compare()
+            return
+
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=compare_process,
+                                               args=(self.old_path, self.new_path, send_conn),
+                                               daemon=True)
+        self.process.start()
+        # Only the child process writes to the pipe
+        send_conn.close()
+
+        no_difference = False
+
+        while not self.cancel_token.cancelled:
+            try:
+                msg = recv_conn.recv()
+            except (EOFError, OSError):
+                if not self.cancel_token.cancelled:
+                    LOGGER.error('Compare process ended unexpectedly.')
+                break
+
+            if msg[0] == 'rows':
+                _, target, rows = msg
+                widget = self.widgets[target]
+                self.queue_batch([(row, widget) for row in rows])
+            elif msg[0] == 'progress':
+                self.progress.emit(msg[1], msg[2], msg[3])
+            elif msg[0] == 'error_report':
+                self.error_report.emit(msg[1], msg[2])
+            elif msg[0] == 'diff':
+                # Result for sessions and reports
+                self.diff = PosDiff.from_state(msg[1])
+            elif msg[0] == 'file_hashes':
+                self.file_hashes = (msg[1], msg[2])
+            elif msg[0] == 'finished':
+                no_difference = msg[1]
+                break
+            elif msg[0] == 'error':
+                LOGGER.error('Compare process reported an error: %s', msg[1])
+                break
+
+        recv_conn.close()
+        if self.cancel_token.cancelled:
+            self.stop()
+        self.process.join()
+
+        if self.cancel_token.cancelled:
+            LOGGER.info('Compare of %s and %s cancelled.', self.old_path, self.new_path)
+            return
+
+        self.finished.emit()
+
+        if no_difference:
+            self.no_difference.emit()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+
+class SqliteCompare(GuiCompare):
+    """
+        Out-of-core compare through a SQLite database for POS files that do not fit into memory.
+        Rows are read page by page from the database while they are queued. Like the stream compare
+        the complete documents are not loaded into the POS views, only the result views grow.
+    """
+    def __init__(self, old_path, new_path, widgets, cmp_queue, diff=None, incremental=None, documents=(),
+                 file_hashes=None):
+        super(SqliteCompare, self).__init__(old_path, new_path, widgets, cmp_queue, diff, incremental, documents,
+                                    file_hashes)
+        self.sqlite_diff = None
+
+    def _create_diff(self, progress):
+        if self.diff is not None:
+            # Provided diff eg. from a session
+            return None
+
+        from modules.pos_schnuffi_sqlite import SqlitePosDiff
+        self.diff = self.sqlite_diff = SqlitePosDiff(self.new_path, self.old_path, self.cancel_token, progress)
+        return None
+
+    def _iterate_rows(self):
+        if hasattr(self.diff, 'iterate_rows'):
+            return self.diff.iterate_rows(views=False)
+        return iterate_diff_rows(self.diff)
+
+    def _compare_finished(self, cache_key):
+        """ Keep the result for sessions and reports, the database is removed once the thread ends """
+        if self.sqlite_diff is not None:
+            self.diff = PosDiff.from_state(self.sqlite_diff.to_state())
+
+    def run(self):
+        try:
+            super(SqliteCompare, self).run()
+        finally:
+            if self.sqlite_diff is not None:
+                self.sqlite_diff.close()
+
+
+class StreamCompare(GuiCompare):
+    """
+        Bounded memory compare through a sorted merge join of both streamed documents.
+        The complete documents are not kept, the POS views stay empty.
+    """
+    def _create_diff(self, progress):
+        if self.diff is None:
+            from modules.pos_schnuffi_stream_diff import StreamPosDiff
+            self.diff = StreamPosDiff(self.new_path, self.old_path, self.cancel_token, progress)
+        return None
+
+
+class DaemonCompare(GuiCompare):
+    """
+        Compare in the local diff daemon which keeps parsed documents in memory across compares,
+        see modules.pos_schnuffi_daemon. Compares in-process if the daemon is not running.
+    """
+    def _create_diff(self, progress):
+        if self.diff is not None or self.incremental is not None:
+            return super(DaemonCompare, self)._create_diff(progress)
+
+        from modules.pos_schnuffi_daemon import DaemonClient, DaemonError, diff_from_json
+        client = DaemonClient.connect()
+        if client is None:
+            LOGGER.info('Diff daemon not running, comparing in-process.')
+            return super(DaemonCompare, self)._create_diff(progress)
 
-        for __a in al.actors.items():
-            actor, a = __a
-            value = a.get('new_value') or ''
-            old_value = a.get('old_value') or ''
-            actor_type = a.get('type') or ''
+        try:
+            with client:
+                result = client.request('compare', progress, self.cancel_token,
+                                        new=Path(self.new_path).resolve().as_posix(),
+                                        old=Path(self.old_path).resolve().as_posix())
+        except (DaemonError, OSError) as e:
+            LOGGER.error('Diff daemon compare failed, comparing in-process: %s', e)
+            return super(DaemonCompare, self)._create_diff(progress)
 
-            if not actor:
-                actor = ''
+        self.diff = diff_from_json(result['diff'])
+        return None
 
-            actor_item = QTreeWidgetItem(list_item, [actor, value, old_value, actor_type])
-            actor_item.setFlags(cls.item_flags)
 
-        return list_item
+# KnechtSettings.app['compare_backend']: compare class
+COMPARE_BACKENDS = {'thread': GuiCompare, 'process': ProcessCompare, 'sqlite': SqliteCompare, 'stream': StreamCompare,
+                    'daemon': DaemonCompare}
@@ -0,0 +1,414 @@
+"""
+    Local diff daemon keeping parsed POS documents warm across compares.
+
+    The daemon listens on localhost TCP and answers compare, export and query requests of the
+    GUI and the command line from an LRU cache of parsed documents. Port and access token are
+    published in a state file in the settings directory, only processes of the same user can
+    read it.
+
+    Messages are frames of a 4 byte big endian length followed by a utf-8 JSON object. Every
+    request carries the token and a command, the daemon answers with any number of progress
+    frames {"progress": [label, done, total]} followed by one result frame {"ok": true, ...}
+    or {"ok": false, "error": message}.
+"""
+import asyncio
+import os
+import secrets
+import socket
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union
+
+import ujson
+
+from modules.pos_schnuffi_xml_diff import PosDiff, PosXml
+from modules.utils.cancel import CancelledError, NO_CANCEL
+from modules.utils.globals import get_settings_dir
+from modules.utils.gui_utils import XmlHelper
+from modules.utils.job_scheduler import JobScheduler
+from modules.utils.log import init_logging
+from modules.utils.progress import ThrottledProgress
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+PROTOCOL_VERSION = 2
+STATE_FILE_NAME = 'schnuffi_daemon.json'
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 1024 * 1024 * 1024
+
+
+class DaemonError(Exception):
+    pass
+
+
+def encode_frame(message: dict) -> bytes:
+    data = ujson.dumps(message, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+    return _HEADER.pack(len(data)) + data
+
+
+def decode_frame(data: bytes) -> dict:
+    message = ujson.loads(data.decode('utf-8'))
+    if not isinstance(message, dict):
+        raise DaemonError('Invalid frame')
+    return message
+
+
+def state_file() -> Union[Path, None]:
+    settings_dir = get_settings_dir()
+    if not settings_dir:
+        return None
+    return Path(settings_dir) / STATE_FILE_NAME
+
+
+def diff_to_json(diff: PosDiff, views: bool=True) -> dict:
+    """ JSON compatible form of the diff result, actor names may be None and can not be object keys
+
+        :param views: include the complete documents of the POS views
+    """
+    state = diff.to_state()
+
+    def actor_list(actors):
+        return [[actor, a.get('new_value'), a.get('old_value'), a.get('type')] for actor, a in actors.items()]
+
+    def action_lists(als):
+        return [[name, actor_list(actors)] for name, actors in als]
+
+    def xml_dict(d):
+        return [[name, [[actor, a.get('value'), a.get('type')] for actor, a in al_dict.items()]]
+                for name, al_dict in d.items()]
+
+    return {
+        'added': action_lists(state['added']), 'modified': action_lists(state['modified']),
+        'removed': action_lists(state['removed']),
+        'renamed': [[name, actor_list(actors), old_name, similarity]
+                    for name, actors, old_name, similarity in state['renamed']],
+        'error_report': state['error_report'], 'error_num': state['error_num'],
+        'switches': [list(s) for s in state['switches']], 'looks': [list(s) for s in state['looks']],
+        'no_difference': state['no_difference'],
+        'new': xml_dict(state['new']) if views else list(), 'old': xml_dict(state['old']) if views else list(),
+        }
+
+
+def diff_from_json(data: dict) -> PosDiff:
+    def actor_dict(actors):
+        return {actor: {'new_value': new_value, 'old_value': old_value, 'type': actor_type}
+                for actor, new_value, old_value, actor_type in actors}
+
+    def action_lists(als):
+        return [(name, actor_dict(actors)) for name, actors in als]
+
+    def xml_dict(d):
+        return {name: {actor: {'value': value, 'type': actor_type} for actor, value, actor_type in actors}
+                for name, actors in d}
+
+    return PosDiff.from_state({
+        'added': action_lists(data['added']), 'modified': action_lists(data['modified']),
+        'removed': action_lists(data['removed']),
+        'renamed': [(name, actor_dict(actors), old_name, similarity)
+                    for name, actors, old_name, similarity in data['renamed']],
+        'error_report': data['error_report'], 'error_num': data['error_num'],
+        'switches': tuple(set(s) for s in data['switches']), 'looks': tuple(set(s) for s in data['looks']),
+        'no_difference': data['no_difference'],
+        'new': xml_dict(data['new']), 'old': xml_dict(data['old']),
+        })
+
+
+def query_document(pos_xml: PosXml, action_list_names=None) -> dict:
+    """ Document summary and the actors of the actionLists [action_list_names] """
+    return {
+        'summary': {'action_lists': len(pos_xml.xml_dict), 'conditions': len(pos_xml.conditions),
+                    'switches': len(pos_xml.switches), 'looks': len(pos_xml.looks),
+                    'state_objects': len(pos_xml.state_objects)},
+        'action_lists': {name: [[actor, a.get('value'), a.get('type')] for actor, a in pos_xml.xml_dict[name].items()]
+                         for name in action_list_names or list() if name in pos_xml.xml_dict},
+        }
+
+
+class DiffDaemon:
+    """
+        asyncio server answering requests from an LRU cache of parsed PosXml documents.
+
+        Documents are keyed by path, modification time and size, a changed file is parsed again.
+        Parsing and diffing run as JobScheduler jobs, concurrent requests for the same document share
+        one parse.
+    """
+    host = '127.0.0.1'
+    # Results of repeated compares of unchanged files
+    max_diffs = 4
+
+    def __init__(self, port: int=0, max_documents: int=0):
+        self.port = port
+        self.max_documents = max_documents or int(KnechtSettings.app.get('daemon_max_documents', 8))
+        self.token = secrets.token_hex(16)
+
+        self._documents = OrderedDict()  # key: asyncio.Future of PosXml
+        self._diffs = OrderedDict()  # (new key, old key, views): diff_to_json result
+        self._loop = None
+        self._stopped = None
+        self._stopping = False
+
+        self._commands = {'ping': self._ping, 'status': self._status, 'compare': self._compare,
+                          'export': self._export, 'query': self._query, 'shutdown': self._shutdown}
+
+    def run(self):
+        """ Serve until a shutdown request is received """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self._write_state_file()
+        LOGGER.info('Diff daemon listening on %s:%s', self.host, self.port)
+
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            self._remove_state_file()
+            LOGGER.info('Diff daemon stopped.')
+
+    def _write_state_file(self):
+        file = state_file()
+        if file is None:
+            raise DaemonError('No settings directory to publish the daemon state file.')
+
+        tmp_file = file.with_suffix('.tmp')
+        fd = os.open(tmp_file.as_posix(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            ujson.dump({'port': self.port, 'token': self.token, 'pid': os.getpid(), 'version': PROTOCOL_VERSION}, f)
+        os.replace(tmp_file.as_posix(), file.as_posix())
+
+    def _remove_state_file(self):
+        file = state_file()
+        try:
+            with open(file.as_posix(), 'r') as f:
+                if ujson.load(f).get('token') != self.token:
+                    # Another daemon took over
+                    return
+            file.unlink()
+        except (OSError, ValueError):
+            pass
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+
+                size = _HEADER.unpack(header)[0]
+                if size > MAX_FRAME_SIZE:
+                    break
+                request = decode_frame(await reader.readexactly(size))
+
+                if not secrets.compare_digest(str(request.get('token', '')), self.token):
+                    writer.write(encode_frame({'ok': False, 'error': 'Invalid token'}))
+                    break
+
+                result = await self._dispatch(request, writer)
+                writer.write(encode_frame(result))
+                await writer.drain()
+
+                if request.get('cmd') == 'shutdown' and result['ok']:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, DaemonError, ValueError) as e:
+            LOGGER.debug('Diff daemon client disconnected: %s', e)
+        finally:
+            writer.close()
+
+        if self._stopping:
+            # Stop once the requesting client is served, not while it's handler still runs
+            self._stopped.set()
+
+    async def _dispatch(self, request: dict, writer: asyncio.StreamWriter) -> dict:
+        command = self._commands.get(request.get('cmd'))
+        if command is None:
+            return {'ok': False, 'error': f'Unknown command {request.get("cmd")}'}
+
+        def send_progress(label: str, done: int, total: int):
+            # Called from worker threads
+            self._loop.call_soon_threadsafe(writer.write, encode_frame({'progress': [label, done, total]}))
+
+        try:
+            result = await command(request, ThrottledProgress(send_progress))
+        except Exception as e:
+            LOGGER.error('Diff daemon request %s failed: %s', request.get('cmd'), e)
+            return {'ok': False, 'error': str(e)}
+
+        result['ok'] = True
+        return result
+
+    @staticmethod
+    def _absolute_path(path: Union[Path, str]) -> Path:
+        """ Relative paths would be resolved against the working directory of the daemon, not the client's """
+        path = Path(path)
+        if not path.is_absolute():
+            raise DaemonError(f'Path must be absolute: {path}')
+        return path
+
+    @staticmethod
+    def _key(path: Path) -> tuple:
+        stat = path.stat()
+        return path.resolve().as_posix(), stat.st_mtime_ns, stat.st_size
+
+    async def get_document(self, path: Union[Path, str], progress=None) -> PosXml:
+        path = self._absolute_path(path)
+        key = self._key(path)
+
+        future = self._documents.get(key)
+        if future is None:
+            # Drop previous versions of the file
+            for stale_key in [k for k in self._documents if k[0] == key[0]]:
+                del self._documents[stale_key]
+
+            future = self._run_job(PosXml, path, NO_CANCEL, progress, name=f'daemon parse {path.name}',
+                                   parallel=True, lean=True)
+            self._documents[key] = future
+
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+
+        self._documents.move_to_end(key)
+
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if self._documents.get(key) is future:
+                del self._documents[key]
+            raise
+
+    @staticmethod
+    def _run_job(func, *args, name: str, **kwargs) -> asyncio.Future:
+        return asyncio.wrap_future(JobScheduler.submit(func, *args, name=name, **kwargs).future)
+
+    async def _ping(self, request: dict, progress) -> dict:
+        return {'version': PROTOCOL_VERSION, 'pid': os.getpid()}
+
+    async def _status(self, request: dict, progress) -> dict:
+        return {'documents': [{'path': key[0], 'parsed': future.done()} for key, future in self._documents.items()],
+                'max_documents': self.max_documents}
+
+    async def _compare(self, request: dict, progress) -> dict:
+        new_xml, old_xml = await asyncio.gather(self.get_document(request['new'], progress),
+                                                self.get_document(request['old'], progress))
+        views = bool(request.get('views', True))
+        key = (self._key(new_xml.xml_file), self._key(old_xml.xml_file), views)
+
+        if key not in self._diffs:
+            def create_diff():
+                diff = PosDiff(new_xml, old_xml, NO_CANCEL, progress)
+                return diff_to_json(diff, views)
+
+            self._diffs[key] = await self._run_job(create_diff, name='daemon diff')
+            while len(self._diffs) > self.max_diffs:
+                self._diffs.popitem(last=False)
+
+        self._diffs.move_to_end(key)
+        return {'diff': self._diffs[key]}
+
+    async def _export(self, request: dict, progress) -> dict:
+        pos_xml = await self.get_document(request['file'], progress)
+        out_file = self._absolute_path(request['out'])
+
+        def export():
+            tree = pos_xml.action_list_document(request['action_lists'])
+            XmlHelper.write_xml_tree(out_file, tree)
+            return [e.get('name') for e in tree.iterfind('*actionList')]
+
+        return {'exported': await self._run_job(export, name='daemon export')}
+
+    async def _query(self, request: dict, progress) -> dict:
+        pos_xml = await self.get_document(request['file'], progress)
+        return query_document(pos_xml, request.get('action_lists'))
+
+    async def _shutdown(self, request: dict, progress) -> dict:
+        self._stopping = True
+        return dict()
+
+
+class DaemonClient:
+    """ Blocking client of a running DiffDaemon, use connect() to find it """
+    connect_timeout = 1.0
+    poll_interval = 0.1
+
+    def __init__(self, port: int, token: str):
+        self.token = token
+        self.sock = socket.create_connection((DiffDaemon.host, port), timeout=self.connect_timeout)
+        self.sock.settimeout(self.poll_interval)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls):
+        """ Return a client of the running daemon or None """
+        file = state_file()
+        if file is None or not file.exists():
+            return None
+
+        try:
+            with open(file.as_posix(), 'r') as f:
+                state = ujson.load(f)
+            if state.get('version') != PROTOCOL_VERSION:
+                LOGGER.warning('Diff daemon protocol version %s is not supported.', state.get('version'))
+                return None
+            return cls(int(state['port']), state['token'])
+        except (OSError, ValueError, KeyError) as e:
+            LOGGER.debug('Diff daemon not available: %s', e)
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, cmd: str, progress=None, cancel_token=NO_CANCEL, **kwargs) -> dict:
+        """ Send a request and wait for it's result, progress frames are passed to [progress] """
+        message = dict(kwargs, cmd=cmd, token=self.token)
+
+        with self._lock:
+            self.sock.sendall(encode_frame(message))
+
+            while True:
+                size = _HEADER.unpack(self._recv_exactly(_HEADER.size, cancel_token))[0]
+                if size > MAX_FRAME_SIZE:
+                    raise DaemonError('Frame exceeds the maximum size')
+                response = decode_frame(self._recv_exactly(size, cancel_token))
+
+                if 'progress' in response:
+                    if progress is not None:
+                        progress(*response['progress'])
+                    continue
+
+                if not response.get('ok'):
+                    raise DaemonError(response.get('error') or 'Request failed')
+                return response
+
+    def _recv_exactly(self, size: int, cancel_token) -> bytes:
+        data = bytearray()
+
+        while len(data) < size:
+            try:
+                chunk = self.sock.recv(min(size - len(data), 1024 * 1024))
+            except socket.timeout:
+                if cancel_token.cancelled:
+                    # The daemon finishes the request, the result is discarded with the connection
+                    self.close()
+                    raise CancelledError()
+                continue
+
+            if not chunk:
+                raise DaemonError('Diff daemon closed the connection')
+            data.extend(chunk)
+
+        return bytes(data)
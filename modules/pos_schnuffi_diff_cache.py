@@ -0,0 +1,171 @@
+import hashlib
+import os
+import pickle
+import threading
+import zlib
+from pathlib import Path
+from typing import Union
+
+from modules.pos_schnuffi_rename import RenameDetector
+from modules.pos_schnuffi_xml_diff import PosDiff
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.globals import get_settings_dir
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+from modules.utils.mapped_file import MappedFile
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class DiffCache:
+    """
+        Cache of complete PosDiff results keyed by the content hashes and names of both input files
+        and the settings changing the diff result.
+
+        Results are stored as zlib compressed pickles of plain python data in the settings
+        directory. Bump [version] whenever PosDiff.to_state changes.
+    """
+    version = 2
+    cache_dir_name = 'diff_cache'
+    suffix = '.pdc'
+    max_entries = 8
+
+    chunk_size = 1 << 20
+
+    # (path, mtime, size): hash, avoids hashing unchanged files again
+    _hashes = dict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def enabled() -> bool:
+        return KnechtSettings.app.get('diff_cache', True)
+
+    @classmethod
+    def file_hash(cls, file: Union[Path, str], cancel_token=NO_CANCEL, progress=None) -> str:
+        """ Content hash of [file], remembered for unchanged files """
+        file = Path(file)
+        stat = file.stat()
+        stat_key = (file.resolve().as_posix(), stat.st_mtime_ns, stat.st_size)
+
+        with cls._lock:
+            if stat_key in cls._hashes:
+                return cls._hashes[stat_key]
+
+        label = _('{} Prüfsumme').format(file.name)
+        digest, done = hashlib.blake2b(digest_size=20), 0
+
+        with MappedFile.open(file) as mapped:
+            for view in mapped.iter_views(cls.chunk_size):
+                cancel_token.check()
+                digest.update(view)
+                done += len(view)
+                view.release()
+                if progress is not None:
+                    progress(label, done, mapped.size)
+
+        file_hash = digest.hexdigest()
+        with cls._lock:
+            cls._hashes[stat_key] = file_hash
+
+        return file_hash
+
+    @staticmethod
+    def diff_settings() -> tuple:
+        """ Settings changing the PosDiff result """
+        return RenameDetector.enabled(), RenameDetector.threshold()
+
+    @classmethod
+    def key(cls, new_path, old_path, cancel_token=NO_CANCEL, progress=None) -> str:
+        """ Key of the diff of both files by their content, the diff settings and the cache format. The
+            file names are part of the key as the error report of the diff contains them.
+        """
+        parts = (cls.version, cls.file_hash(new_path, cancel_token, progress), Path(new_path).name,
+                 cls.file_hash(old_path, cancel_token, progress), Path(old_path).name, cls.diff_settings())
+        return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=20).hexdigest()
+
+    @classmethod
+    def _cache_dir(cls) -> Union[Path, None]:
+        settings_dir = get_settings_dir()
+        if not settings_dir:
+            return None
+
+        cache_dir = Path(settings_dir) / cls.cache_dir_name
+        try:
+            cache_dir.mkdir(exist_ok=True)
+        except OSError as e:
+            LOGGER.error('Can not create diff cache directory: %s', e)
+            return None
+
+        return cache_dir
+
+    @classmethod
+    def _cache_file(cls, key: str) -> Union[Path, None]:
+        cache_dir = cls._cache_dir()
+        if cache_dir is None:
+            return None
+        return cache_dir / f'{key}{cls.suffix}'
+
+    @staticmethod
+    def dumps(data) -> bytes:
+        """ Compact binary representation of plain python data """
+        return zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+    @staticmethod
+    def loads(data: bytes):
+        return pickle.loads(zlib.decompress(data))
+
+    @classmethod
+    def load(cls, key: str) -> Union[PosDiff, None]:
+        cache_file = cls._cache_file(key)
+        if cache_file is None or not cache_file.exists():
+            return None
+
+        try:
+            with open(cache_file, 'rb') as f:
+                version, state = cls.loads(f.read())
+            if version != cls.version:
+                return None
+
+            # Mark as recently used
+            os.utime(cache_file)
+            diff = PosDiff.from_state(state)
+        except Exception as e:
+            LOGGER.error('Could not load cached diff result %s: %s', cache_file.name, e)
+            return None
+
+        LOGGER.info('Loaded cached diff result %s', cache_file.name)
+        return diff
+
+    @classmethod
+    def save(cls, diff: PosDiff, key: str) -> bool:
+        cache_file = cls._cache_file(key)
+        if cache_file is None:
+            return False
+
+        tmp_file = cache_file.with_suffix('.tmp')
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(cls.dumps((cls.version, diff.to_state())))
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            LOGGER.error('Could not write diff result to cache %s: %s', cache_file.name, e)
+            return False
+
+        cls._evict(cache_file.parent)
+        return True
+
+    @classmethod
+    def _evict(cls, cache_dir: Path):
+        """ Remove the least recently used results """
+        try:
+            files = sorted(cache_dir.glob(f'*{cls.suffix}'), key=lambda f: f.stat().st_mtime, reverse=True)
+            for f in files[cls.max_entries:]:
+                f.unlink()
+        except OSError as e:
+            LOGGER.error('Could not clean up diff cache: %s', e)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from pathlib import Path
-from typing import Union, Tuple, List
+from typing import Union, Tuple
 
 from PySide2 import QtWidgets
 from PySide2.QtCore import Qt
@@ -8,9 +8,14 @@ from lxml import etree
 
 from modules.pos_schnuffi_msg import Msg
 from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.cancel import CancelledError, NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
 from modules.utils.gui_utils import iterate_widget_items_flat, XmlHelper
+from modules.utils.instrumentation import Timing
+from modules.utils.job_scheduler import JobPriority, JobScheduler
 from modules.utils.language import get_translation
 from modules.utils.log import init_logging
+from modules.utils.profiler import Profiler
 from modules.utils.settings import KnechtSettings
 
 # translate strings
@@ -22,13 +27,15 @@ LOGGER = init_logging(__name__)
 
 
 class ExportActionList(object):
-    xml_dom = {'root': 'stateMachine', 'sub_lvl_1': 'stateEngine'}
     err_msg = Msg.POS_ERR_MSG_LS
 
     def __init__(self, pos_app, pos_ui):
-        """ Export selected items as Xml ActionList """
+        """ Export selected items as Xml ActionList. Parsing, updating and writing runs as background
+            job, the finished file replaces the export file only if the job succeeded.
+        """
         self.pos_app, self.pos_ui = pos_app, pos_ui
         self.err = self.pos_app.err_sig
+        self.job = None
 
     def _prepare_export(self):
         widget = self._get_widget()
@@ -55,6 +62,22 @@ class ExportActionList(object):
 
         return action_list_names, file, widget
 
+    def _start_job(self, func, *args) -> bool:
+        """ Run [func] as background export job, only one export runs at a time """
+        if self.job is not None and not self.job.done():
+            self.err.emit(_('Es läuft bereits ein Export. Bitte warten oder den Export abbrechen.'))
+            return False
+
+        self.job = JobScheduler.create_job(func, *args, name=func.__name__, priority=JobPriority.EXPORT,
+                                           cooperative=True)
+        self.pos_app.export_started(self.job)
+        JobScheduler.enqueue(self.job)
+        return True
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+
     def export_selection(self):
         """
             ### GUI Btn "Export selection" points here ###
@@ -65,9 +88,15 @@ class ExportActionList(object):
             self.err.emit(_('Keine actionLists zum Exportieren gefunden.'))
             return
 
-        if not self.export_custom_xml(action_list_names, file):
-            # break on error
-            return
+        self._start_job(self._export_selection, action_list_names, file, self.pos_app.new_path)
+
+    @Profiler.profiled('export_selection')
+    def _export_selection(self, action_list_names: set, file: Path, new_path: Path,
+                          cancel_token=NO_CANCEL, progress=None):
+        with Timing.span('export'):
+            if not self.export_custom_xml(action_list_names, file, new_path, cancel_token, progress):
+                # break on error
+                return
 
         self.pos_app.export_sig.emit()
 
@@ -82,44 +111,78 @@ class ExportActionList(object):
         if not file:
             return
 
+        old_path, new_path = self.pos_app.old_path, self.pos_app.new_path
+
         if widget is self.pos_ui.ModifiedWidget:
             if not action_list_names:
                 self.err.emit(_('Nichts zum Exportieren gewählt.'))
                 return
-            if not self.update_old_pos_xml_with_changed_action_lists(action_list_names, file):
-                return
+            self._start_job(self._export_updated_pos_xml, self.update_old_pos_xml_with_changed_action_lists,
+                            action_list_names, file, old_path, new_path)
         elif widget in (self.pos_ui.posNewWidget, self.pos_ui.posOldWidget):
-            if not self.update_pos_xml_from_pos_widget(file, widget):
-                return
+            xml_path = new_path if widget is self.pos_ui.posNewWidget else old_path
+            self._start_job(self._export_updated_pos_xml, self.update_pos_xml_from_pos_widget,
+                            self.edited_action_lists(widget), file, xml_path)
         else:
             self.err.emit(_('Exportieren aus diesem Baum wird nicht unterstützt.'))
-            return
 
-        self.pos_app.export_sig.emit()
+    @Profiler.profiled('export_updated_pos_xml')
+    def _export_updated_pos_xml(self, update_func, *args, cancel_token=NO_CANCEL, progress=None):
+        with Timing.span('export'):
+            if not update_func(*args, cancel_token=cancel_token, progress=progress):
+                return
 
-    def update_pos_xml_from_pos_widget(self, out_file: Path, widget: QtWidgets.QTreeWidget) -> bool:
-        if widget is self.pos_ui.posNewWidget:
-            # Get new PosXml as base
-            _, pos_xml = self.get_pos_xmls()
-        else:
-            # Get old PosXml as base
-            pos_xml, _ = self.get_pos_xmls()
+        self.pos_app.export_sig.emit()
 
-        al_items = [i for i in iterate_widget_items_flat(widget) if not i.parent()]
-        al_names = [i.data(0, Qt.DisplayRole) for i in al_items]
-        al_updated = list()
+    @staticmethod
+    def edited_action_lists(widget: QtWidgets.QTreeWidget) -> dict:
+        """ Read the edited actionList items of a POS widget as
+            {name: [(action type, actor, value), ...]} on the GUI thread
+        """
+        edited, names = dict(), set()
 
-        for e in pos_xml.iterate_xml_action_list_elements():
-            if e.get('name') not in al_names:
+        for al_item in iterate_widget_items_flat(widget):
+            if al_item.parent():
                 continue
 
-            al_list_index = al_names.index(e.get('name'))
-            al_item = al_items[al_list_index]
+            al_name = al_item.data(0, Qt.DisplayRole)
+            if al_name in names:
+                continue
+            names.add(al_name)
 
             if al_item.data(0, Qt.UserRole) != True:
                 # Skip unedited items
                 continue
 
+            actions = list()
+            for c in range(0, al_item.childCount()):
+                actor_item = al_item.child(c)
+                actions.append((actor_item.data(2, Qt.DisplayRole) or 'None', actor_item.data(0, Qt.DisplayRole),
+                                actor_item.data(1, Qt.DisplayRole)))
+            edited[al_name] = actions
+
+        return edited
+
+    def update_pos_xml_from_pos_widget(self, edited_action_lists: dict, out_file: Path, xml_path: Path,
+                                       cancel_token=NO_CANCEL, progress=None) -> bool:
+        pos_xml = self.parse_pos_xml(xml_path, cancel_token, progress)
+        if not pos_xml:
+            self.err.emit(self.err_msg[3])
+            return False
+
+        elements = list(pos_xml.iterate_xml_action_list_elements())
+        al_updated = list()
+        label = _('actionLists aktualisieren')
+
+        for num, e in enumerate(elements, start=1):
+            cancel_token.check()
+            if progress is not None:
+                progress(label, num, len(elements))
+
+            actions = edited_action_lists.get(e.get('name'))
+            if actions is None:
+                continue
+
             LOGGER.debug('Found edited actionList in widget: %s', e.get('name'))
             al_updated.append(e.get('name'))
 
@@ -128,19 +191,17 @@ class ExportActionList(object):
                 e.remove(old_action)
 
             # Create Action elements from widget
-            for c in range(0, al_item.childCount()):
-                actor_item = al_item.child(c)
-
+            for action_type, actor, value in actions:
                 # <action>
                 action_element = etree.SubElement(e, 'action')
                 # <action type="">
-                action_element.attrib['type'] = actor_item.data(2, Qt.DisplayRole) or 'None'
+                action_element.attrib['type'] = action_type
                 # /<actor>
                 actor_element = etree.SubElement(action_element, 'actor')
-                actor_element.text = actor_item.data(0, Qt.DisplayRole)
+                actor_element.text = actor
                 # /<value>
                 value_element = etree.SubElement(action_element, 'value')
-                value_element.text = actor_item.data(1, Qt.DisplayRole)
+                value_element.text = value
                 # /<description>
                 desc_element = etree.SubElement(action_element, 'description')
 
@@ -149,57 +210,47 @@ class ExportActionList(object):
         self.add_export_info_comment(pos_xml.xml_tree.getroot(), al_updated, Path('.'), pos_xml.xml_file)
 
         try:
-            pos_xml.write_xml_tree(out_file)
+            pos_xml.write_xml_tree(out_file, cancel_token=cancel_token, progress=progress)
             self.err.emit(Msg.POS_EXPORT_MSG.format(out_file.as_posix()))
             return True
+        except CancelledError:
+            raise
         except Exception as e:
             self.err.emit(self.err_msg[5])
             LOGGER.error('POS Xml is malformed and could not be written/serialized.\n%s', e)
 
         return False
 
-    @staticmethod
-    def _collect_action_list(et: etree._ElementTree, action_list_name: str) \
-            -> Tuple[Union[None, etree._Element], Union[None, etree._Element], List[Union[None, etree._Element]]]:
-        al_elem = et.find(f"*actionList[@name='{action_list_name}']")
-        condition = et.xpath(f"*/condition/actionListName[text()='{action_list_name}']/..")[0]
-
-        if al_elem is None or condition is None:
-            return None, None, [None]
-
-        # Collect affected state objects
-        state_objects = list()
-        for state_object_name in condition.xpath(f"stateCondition/stateObjectName"):
-            state_object = et.find(f"*stateObject[@name='{state_object_name.text}']")
-            if state_object is not None:
-                state_objects.append(state_object)
-
-        return al_elem, condition, state_objects
-
     @staticmethod
     def _replace_element(parent, old_element, new_element):
         idx = parent.index(old_element)
         parent.remove(old_element)
         parent.insert(idx, new_element)
 
-    def update_old_pos_xml_with_changed_action_lists(self, action_list_names, out_file):
+    def update_old_pos_xml_with_changed_action_lists(self, action_list_names, out_file, old_path, new_path,
+                                                     cancel_token=NO_CANCEL, progress=None):
         """
         Export an updated version of the old POS Xml, updating selected action lists with the
         content from the new POS Xml.
         """
         # Read old and new POS Xml and return as PosXml class objects
-        pos_xml, new_xml = self.get_pos_xmls()
+        pos_xml, new_xml = self.get_pos_xmls(old_path, new_path, cancel_token, progress)
         if not pos_xml or not new_xml:
             return False
 
         # Prepare storage of updated POS Xml
         updated_et = etree.ElementTree(pos_xml.xml_tree.getroot())
         updated_elements = set()
+        label = _('actionLists aktualisieren')
+
+        for num, al_name in enumerate(action_list_names, start=1):
+            cancel_token.check()
+            if progress is not None:
+                progress(label, num, len(action_list_names))
 
-        for al_name in action_list_names:
             parent = updated_et.find(f'*actionList[@name="{al_name}"]/..')
-            old_al, old_condition, old_states = self._collect_action_list(updated_et, al_name)
-            new_al, new_condition, new_states = self._collect_action_list(new_xml.xml_tree, al_name)
+            old_al, old_condition, old_states = PosXml.collect_action_list(updated_et, al_name)
+            new_al, new_condition, new_states = PosXml.collect_action_list(new_xml.xml_tree, al_name)
 
             if parent is None or old_al is None or new_al is None or old_condition is None or new_condition is None:
                 # Skip elements not present in both POS Xml's
@@ -222,15 +273,16 @@ class ExportActionList(object):
             return False
 
         # Add info comment
-        self.add_export_info_comment(updated_et.getroot(), updated_elements,
-                                     self.pos_app.file_win.old_file_dlg.path,
-                                     self.pos_app.file_win.new_file_dlg.path)
+        self.add_export_info_comment(updated_et.getroot(), updated_elements, old_path, new_path)
 
         # Try to write the POS mess as a file, this will fail with xml.etree
         LOGGER.info('Exporting POS Xml with the following action lists replaced:\n%s', updated_elements)
         try:
-            XmlHelper.write_xml_tree(out_file, updated_et)
+            XmlHelper.write_xml_tree(out_file, updated_et, cancel_token, progress,
+                                     _('{} schreiben').format(out_file.name))
             self.err.emit(Msg.POS_EXPORT_MSG.format(out_file.as_posix()))
+        except CancelledError:
+            raise
         except Exception as e:
             self.err.emit(self.err_msg[5])
             LOGGER.error('POS Xml is malformed and could not be written/serialized.\n%s', e)
@@ -238,30 +290,21 @@ class ExportActionList(object):
 
         return True
 
-    def export_custom_xml(self, action_list_names: set, out_file):
-        _, new_xml = self.get_pos_xmls()
+    def export_custom_xml(self, action_list_names: set, out_file, new_path: Path, cancel_token=NO_CANCEL,
+                          progress=None):
+        new_xml = self.parse_pos_xml(new_path, cancel_token, progress)
         if not new_xml:
             self.err.emit(self.err_msg[3])
             return False
 
-        # Prepare export Xml
-        root, state_engine = self._prepare_custom_xml_export()
-
-        for al_name in action_list_names:
-            al, condition, state_objects = self._collect_action_list(new_xml.xml_tree, al_name)
-            if al is None or condition is None:
-                continue
-
-            LOGGER.debug('Adding actionList Xml element %s', al_name)
-            state_engine.append(al)
-            state_engine.append(condition)
-            for e in state_objects:
-                state_engine.insert(0, e)
+        tree = new_xml.action_list_document(action_list_names, cancel_token, progress)
 
         try:
-            tree = etree.ElementTree(root)
-            XmlHelper.write_xml_tree(out_file, tree)
+            XmlHelper.write_xml_tree(out_file, tree, cancel_token, progress,
+                                     _('{} schreiben').format(out_file.name))
             self.err.emit(Msg.POS_EXPORT_MSG.format(out_file.as_posix()))
+        except CancelledError:
+            raise
         except Exception as e:
             self.err.emit(self.err_msg[4])
             LOGGER.error('POS Xml is malformed and could not be written/serialized.\n%s', e)
@@ -269,12 +312,41 @@ class ExportActionList(object):
 
         return True
 
-    def _prepare_custom_xml_export(self) -> Tuple[etree._Element, etree._Element]:
-        root = etree.Element(self.xml_dom['root'])
-        state_engine = etree.SubElement(root, self.xml_dom['sub_lvl_1'])
-        state_engine.set('autoType', 'variant')
+    def export_report(self):
+        """
+            ### Menu "Vergleichsbericht" points here ###
+            Write the rows of the current diff as spreadsheet report
+        """
+        diff = getattr(self.pos_app.cmp_thread, 'diff', None)
+        if self.pos_app.old_path is None or self.pos_app.cmp_thread.isRunning() or self.pos_app.remaining_items \
+                or not hasattr(diff, 'to_state'):
+            self.err.emit(_('Kein abgeschlossener Vergleich für einen Bericht vorhanden.'))
+            return
+
+        from modules.pos_schnuffi_report import DiffReport
+        file, _file_type = QtWidgets.QFileDialog.getSaveFileName(
+            self.pos_ui, _('Vergleichsbericht speichern'), KnechtSettings.app.get('current_path') or '',
+            DiffReport.file_filter())
+        if not file:
+            return
+
+        self._start_job(self._export_report, Path(file), diff)
 
-        return root, state_engine
+    def _export_report(self, file: Path, diff, cancel_token=NO_CANCEL, progress=None):
+        from modules.pos_schnuffi_report import DiffReport
+
+        with Timing.span('export'):
+            try:
+                DiffReport.write(diff, file, cancel_token, progress)
+            except CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.error('Could not write report: %s', e)
+                self.err.emit(_('Bericht konnte nicht geschrieben werden:<br>{}').format(e))
+                return
+
+        self.err.emit(_('Vergleichsbericht exportiert in:<br>{}').format(file.as_posix()))
+        self.pos_app.export_sig.emit()
 
     def _get_widget(self):
         return self.pos_ui.widget_with_focus()
@@ -285,25 +357,24 @@ class ExportActionList(object):
             self.pos_ui,
             Msg.SAVE_DIALOG_TITLE,
             KnechtSettings.app.get('current_path') or '',
-            Msg.SAVE_FILTER
+            ';;'.join((Msg.SAVE_FILTER, Msg.SAVE_COMPRESSED_FILTER.format(
+                ';'.join(f'*.xml{s}' for s in CompressedFile.supported_suffixes()))))
             )
 
         return file
 
-    def get_pos_xmls(self) -> Tuple[Union[None, PosXml], Union[None, PosXml]]:
+    def get_pos_xmls(self, old_path: Path, new_path: Path, cancel_token=NO_CANCEL, progress=None) \
+            -> Tuple[Union[None, PosXml], Union[None, PosXml]]:
         """ Read old and new POS Xml and return as PosXml class objects """
-        if self.pos_app.file_win:
-            old_pos_xml_file = self.pos_app.file_win.old_file_dlg.path
-            new_pos_xml_file = self.pos_app.file_win.new_file_dlg.path
-        else:
+        if not old_path or not new_path:
             return None, None
 
         # Parse old and new xml file
-        pos_xml = self.parse_pos_xml(old_pos_xml_file)
+        pos_xml = self.parse_pos_xml(old_path, cancel_token, progress)
         if not pos_xml:
             self.err.emit(self.err_msg[3])
             return None, None
-        new_xml = self.parse_pos_xml(new_pos_xml_file)
+        new_xml = self.parse_pos_xml(new_path, cancel_token, progress)
         if not new_xml:
             self.err.emit(self.err_msg[3])
             return None, None
@@ -311,12 +382,14 @@ class ExportActionList(object):
         return pos_xml, new_xml
 
     @staticmethod
-    def parse_pos_xml(xml_file_path: Path) -> Union[PosXml, None]:
+    def parse_pos_xml(xml_file_path: Path, cancel_token=NO_CANCEL, progress=None) -> Union[PosXml, None]:
         # Parse to Xml
-        if xml_file_path.exists():
+        if xml_file_path and xml_file_path.exists():
             try:
-                pos_xml = PosXml(xml_file_path)
+                pos_xml = PosXml(xml_file_path, cancel_token, progress)
                 return pos_xml
+            except CancelledError:
+                raise
             except Exception as e:
                 LOGGER.debug('Error parsing POS Xml: %s', e)
                 return
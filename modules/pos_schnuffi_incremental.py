@@ -0,0 +1,341 @@
+import hashlib
+import mmap
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Union
+
+import lxml.etree as Et
+
+from modules.pos_schnuffi_xml_diff import PosDiff, PosXml
+from modules.utils.cancel import CancelledError, NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.instrumentation import Timing
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+from modules.utils.mapped_file import MappedFile, fromstring
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class PosSpanIndex:
+    """
+        Byte spans and digests of the actionList and condition elements of a POS file.
+
+        Elements are found with a byte scan instead of a parser. The index is only used if
+        it agrees with a complete parse of the same document, see IncrementalDiff.
+    """
+    _name_re = re.compile(rb'\sname\s*=\s*(?:"([^"&]*)"|\'([^\'&]*)\')')
+    _condition_name_re = re.compile(rb'<actionListName>([^<&]*)</actionListName>')
+    _encoding_re = re.compile(rb'encoding\s*=\s*["\']([\w-]+)["\']')
+    _tag_end = (b' ', b'>', b'/', b'\t', b'\n', b'\r')
+
+    def __init__(self, data: Union[bytes, mmap.mmap], valid: bool=True):
+        """ Index [data] eg. the bytes or the mapping of a MappedFile, spans are hashed without copies """
+        # name: (start, end, digest)
+        self.action_lists = dict()
+        self.conditions = dict()
+        self.valid = valid
+        if not valid:
+            return
+
+        encoding = self._encoding_re.search(data[:200])
+        if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8'):
+            LOGGER.info('Incremental diff only supports utf-8 documents.')
+            self.valid = False
+            return
+
+        try:
+            with memoryview(data) as view:
+                self._scan(data, view, b'actionList', self.action_lists, self._action_list_name)
+                self._scan(data, view, b'condition', self.conditions, self._condition_name)
+        except (ValueError, Et.XMLSyntaxError) as e:
+            LOGGER.info('Can not index POS document: %s', e)
+            self.valid = False
+
+    @classmethod
+    def from_file(cls, file: Union[Path, str]):
+        if CompressedFile.compression(file):
+            # Byte spans of the decompressed document would require it in memory
+            LOGGER.info('Incremental diff not available for compressed document %s.', Path(file).name)
+            return cls(b'', valid=False)
+
+        with MappedFile.open(file) as mapped:
+            return cls(mapped.data)
+
+    def _scan(self, data: bytes, view: memoryview, tag: bytes, spans: dict, get_name):
+        for start, tag_end, end in self._iterate_spans(data, tag):
+            name = get_name(data, view, start, tag_end, end)
+            if not name:
+                # Skipped by PosXml as well
+                continue
+            if name in spans:
+                raise ValueError(f'Duplicate {tag.decode()} {name}')
+
+            with view[start:end] as span:
+                spans[name] = (start, end, hashlib.blake2b(span, digest_size=16).digest())
+
+    @classmethod
+    def _iterate_spans(cls, data: bytes, tag: bytes):
+        """ Yield (start, end of opening tag, end) of every <tag> element """
+        open_tag, close_tag = b'<' + tag, b'</' + tag + b'>'
+        start = data.find(open_tag)
+
+        while start != -1:
+            if data[start + len(open_tag):start + len(open_tag) + 1] not in cls._tag_end:
+                # eg. <actionListName
+                start = data.find(open_tag, start + 1)
+                continue
+
+            tag_end = data.find(b'>', start) + 1
+            if not tag_end:
+                raise ValueError(f'Unterminated {tag.decode()} element')
+
+            if data[tag_end - 2:tag_end - 1] == b'/':
+                end = tag_end
+            else:
+                end = data.find(close_tag, tag_end)
+                if end == -1:
+                    raise ValueError(f'Unterminated {tag.decode()} element')
+                end += len(close_tag)
+
+            yield start, tag_end, end
+            start = data.find(open_tag, end)
+
+    @classmethod
+    def _action_list_name(cls, data: bytes, view: memoryview, start: int, tag_end: int, end: int) -> str:
+        m = cls._name_re.search(data, start, tag_end)
+        if m:
+            return (m.group(1) if m.group(1) is not None else m.group(2)).decode('utf-8')
+        if b'name' not in data[start:tag_end]:
+            return ''
+
+        # Entities or other unusual markup, let the parser decide
+        return cls.parse(view, start, end).get('name') or ''
+
+    @classmethod
+    def _condition_name(cls, data: bytes, view: memoryview, start: int, tag_end: int, end: int) -> str:
+        m = cls._condition_name_re.search(data, tag_end, end)
+        if m:
+            return m.group(1).decode('utf-8')
+        if b'actionListName' not in data[start:end]:
+            return ''
+
+        return cls.parse(view, start, end).findtext('actionListName') or ''
+
+    @staticmethod
+    def parse(view: memoryview, start: int, end: int) -> Et._Element:
+        with view[start:end] as span:
+            return fromstring(span)
+
+    @staticmethod
+    def changed(old_spans: dict, new_spans: dict) -> set:
+        """ Names of added, removed and changed elements """
+        changed = set(old_spans).symmetric_difference(new_spans)
+        changed.update(n for n in set(old_spans).intersection(new_spans) if old_spans[n][2] != new_spans[n][2])
+        return changed
+
+
+class _IncrementalSide:
+    """ Span index and actor value counts of one PosXml of the diff """
+    actor_types = PosXml.actor_types
+
+    def __init__(self, pos_xml: PosXml):
+        self.pos_xml = pos_xml
+        self.stat = self._stat(pos_xml.xml_file)
+
+        self.index = PosSpanIndex.from_file(pos_xml.xml_file)
+        # (type, actor): Counter(value: number of actionLists using it)
+        self.actor_values = dict()
+        for al_dict in pos_xml.xml_dict.values():
+            self._count_actors(al_dict, 1)
+
+        self.valid = self.index.valid and self._agrees_with_parse()
+
+    @staticmethod
+    def _stat(file: Path):
+        stat = file.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def _actor_dicts(self) -> dict:
+        return {'switch': self.pos_xml.switches, 'appearance': self.pos_xml.looks,
+                'stateObject': self.pos_xml.state_objects}
+
+    def _count_actors(self, al_dict: dict, count: int):
+        for actor, a in al_dict.items():
+            values = self.actor_values.setdefault((a['type'], actor), Counter())
+            values[a['value']] += count
+
+    def _agrees_with_parse(self) -> bool:
+        """ Byte scan and actor counts produce exactly what the parser found """
+        if set(self.index.action_lists) != set(self.pos_xml.xml_dict) or \
+                set(self.index.conditions) != set(self.pos_xml.conditions):
+            LOGGER.info('Incremental diff not available, POS document %s does not match it\'s index.',
+                        self.pos_xml.xml_file.name)
+            return False
+
+        actor_dicts = self._actor_dicts()
+        for actor_type in self.actor_types:
+            counted = {actor: set(values) for (t, actor), values in self.actor_values.items() if t == actor_type}
+            if counted != actor_dicts[actor_type]:
+                LOGGER.info('Incremental diff not available, POS document %s uses actors more than once '
+                            'per actionList.', self.pos_xml.xml_file.name)
+                return False
+
+        return True
+
+    def file_changed(self) -> bool:
+        return self._stat(self.pos_xml.xml_file) != self.stat
+
+    def update(self, cancel_token=NO_CANCEL) -> Union[set, None]:
+        """ Re-scan the file and re-parse changed elements.
+
+            :returns: names of changed actionLists or None if the file can not be updated incrementally
+        """
+        stat = self._stat(self.pos_xml.xml_file)
+        if CompressedFile.compression(self.pos_xml.xml_file):
+            return None
+
+        with MappedFile.open(self.pos_xml.xml_file) as mapped:
+            new_index = PosSpanIndex(mapped.data)
+            if not new_index.valid:
+                return None
+
+            return self._update(new_index, stat, mapped.view, cancel_token)
+
+    def _update(self, new_index: PosSpanIndex, stat: tuple, view: memoryview, cancel_token) -> Union[set, None]:
+        xml = self.pos_xml
+        changed_action_lists = PosSpanIndex.changed(self.index.action_lists, new_index.action_lists)
+        changed_conditions = PosSpanIndex.changed(self.index.conditions, new_index.conditions)
+        touched_actors = set()
+
+        for name in changed_action_lists:
+            cancel_token.check()
+            old_al = xml.xml_dict.pop(name, None)
+            if old_al is not None:
+                self._count_actors(old_al, -1)
+                touched_actors.update((a['type'], actor) for actor, a in old_al.items())
+
+            if name not in new_index.action_lists:
+                continue
+
+            start, end, _digest = new_index.action_lists[name]
+            e = PosSpanIndex.parse(view, start, end)
+            xml.add_action_list(e)
+
+            if len(xml.xml_dict.get(name, ())) != len(e.xpath("./*[@type='switch' or @type='appearance' "
+                                                               "or @type='stateObject']")):
+                # Actors used more than once, actor counts would no longer be exact
+                return None
+
+            self._count_actors(xml.xml_dict[name], 1)
+            touched_actors.update((a['type'], actor) for actor, a in xml.xml_dict[name].items())
+
+        for name in changed_conditions:
+            cancel_token.check()
+            xml.conditions.pop(name, None)
+
+            if name in new_index.conditions:
+                start, end, _digest = new_index.conditions[name]
+                xml.add_condition(PosSpanIndex.parse(view, start, end))
+
+        # Update actor value sets from the counts
+        actor_dicts = self._actor_dicts()
+        for actor_type, actor in touched_actors:
+            values = self.actor_values.get((actor_type, actor), Counter())
+            used_values = {value for value, count in values.items() if count > 0}
+            if used_values:
+                actor_dicts[actor_type][actor] = used_values
+            else:
+                actor_dicts[actor_type].pop(actor, None)
+                self.actor_values.pop((actor_type, actor), None)
+
+        # The element tree no longer matches the data, it is reloaded on access
+        xml.data_updated()
+        self.index, self.stat = new_index, stat
+
+        return changed_action_lists
+
+
+class IncrementalDiff:
+    """
+        Keeps a PosDiff up to date with changes to it's POS files by re-parsing and
+        re-diffing only actionList and condition elements whose bytes changed.
+
+        Created after a complete compare of both files. If an update is not possible the
+        instance becomes unavailable and a complete compare is required.
+    """
+    def __init__(self, diff: PosDiff):
+        self.diff = diff
+        self.available = False
+
+        with Timing.span('incremental_index'):
+            self.sides = [_IncrementalSide(diff.new_xml), _IncrementalSide(diff.old_xml)]
+
+        self.available = all(side.valid for side in self.sides)
+
+    @staticmethod
+    def enabled() -> bool:
+        """ Indexing costs a scan of both files after every compare, only done in watch mode """
+        return KnechtSettings.app.get('watch_mode', False) and KnechtSettings.app.get('incremental_diff', True)
+
+    @classmethod
+    def create(cls, diff: PosDiff):
+        """ Return a IncrementalDiff for a complete diff of two PosXml or None """
+        if diff.new_xml is None or diff.old_xml is None:
+            return None
+
+        try:
+            incremental = cls(diff)
+        except (OSError, Et.XMLSyntaxError) as e:
+            LOGGER.info('Incremental diff not available: %s', e)
+            return None
+
+        return incremental if incremental.available else None
+
+    def update(self, cancel_token=NO_CANCEL, progress=None) -> bool:
+        """ Update the diff to the current content of both files, returns False if a complete compare is required """
+        if not self.available:
+            return False
+
+        # Partial updates leave the PosXml data inconsistent, the instance can only be used if all succeed
+        self.available = False
+        changed = set()
+        label = _('Geänderte actionLists vergleichen')
+
+        try:
+            with Timing.span('incremental_update'):
+                for idx, side in enumerate(self.sides):
+                    if progress is not None:
+                        progress(label, idx, len(self.sides) + 1)
+
+                    if not side.file_changed():
+                        continue
+
+                    side_changed = side.update(cancel_token)
+                    if side_changed is None:
+                        return False
+                    changed.update(side_changed)
+
+                self.diff.cancel_token = cancel_token
+                self.diff.patch(changed)
+                self.diff.cancel_token = NO_CANCEL
+        except CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error('Incremental diff failed, a complete compare is required: %s', e)
+            return False
+
+        if progress is not None:
+            progress(label, len(self.sides) + 1, len(self.sides) + 1)
+
+        Timing.count('action_lists_rediffed', len(changed))
+        LOGGER.info('Incremental diff updated %s actionLists.', len(changed))
+        self.available = True
+        return True
@@ -41,6 +41,7 @@ class Msg:
 
     SAVE_DIALOG_TITLE = 'Benutzer Presets als *.XML speichern...'
     SAVE_FILTER = 'Variant Preset Dateien (*.xml)'
+    SAVE_COMPRESSED_FILTER = 'Komprimierte Variant Preset Dateien ({})'
 
     DIALOG_TITLE = 'Variants *.XML auswählen'
     FILTER = 'Variant Preset Dateien (*.xml);'
\ No newline at end of file
@@ -0,0 +1,177 @@
+import multiprocessing
+import re
+from typing import List, Tuple, Union
+
+import lxml.etree as Et
+
+from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.cancel import CancelledError
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.instrumentation import Timing
+from modules.utils.job_scheduler import JobScheduler
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+from modules.utils.mapped_file import MappedFile
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+def parse_chunk(xml_file: str, start: int, end: int) -> PosXml:
+    """ Process pool entry point, parse the stateEngine children between byte offsets start and end """
+    parser = Et.XMLParser()
+    # Several elements need a wrapper to parse, the chunk is fed between the wrapper tags
+    parser.feed(b'<chunk>')
+    with MappedFile.open(xml_file) as mapped:
+        for view in mapped.iter_views(PosXml.feed_size, start, end):
+            # The feed interface only accepts bytes, one slice at a time is copied
+            parser.feed(bytes(view))
+            view.release()
+    parser.feed(b'</chunk>')
+
+    return PosXml.from_elements(xml_file, parser.close())
+
+
+class ParallelPosParser:
+    """
+        Parses large POS files in chunks on all cores.
+
+        The children of the stateEngine element are split at element boundaries into byte ranges
+        which are parsed in a process pool and merged in document order. Documents that can not
+        be split safely eg. with a DTD, namespaces or several stateEngine elements fall back to
+        the serial parser. A chunk split inside an element fails to parse and falls back as well.
+        Chunks are process jobs of the JobScheduler.
+    """
+    min_chunk_size = 4 * 1024 * 1024
+    chunks_per_worker = 4
+    poll_interval = 0.1
+    scan_window = 256 * 1024
+
+    _tags = (b'<actionList', b'<condition', b'<stateObject')
+    _tag_end = (b' ', b'>', b'/', b'\t', b'\n', b'\r')
+    _encoding_re = re.compile(rb'encoding\s*=\s*["\']([\w-]+)["\']')
+
+    @staticmethod
+    def enabled() -> bool:
+        # Daemonic processes eg. the process compare backend can not start a pool
+        return KnechtSettings.app.get('parallel_parse', True) and not multiprocessing.current_process().daemon
+
+    @staticmethod
+    def min_size() -> int:
+        """ Smaller files are parsed faster than a pool can distribute them """
+        return int(KnechtSettings.app.get('parallel_parse_min_mb', 32)) * 1024 * 1024
+
+    @staticmethod
+    def workers() -> int:
+        return JobScheduler.process_workers()
+
+    @classmethod
+    def load(cls, pos_xml: PosXml) -> bool:
+        """ Parse the file of [pos_xml] into it, returns False if the serial parser has to be used """
+        xml_file = pos_xml.xml_file
+        size = xml_file.stat().st_size
+
+        if not cls.enabled() or cls.workers() < 2 or size < cls.min_size():
+            return False
+        if CompressedFile.compression(xml_file):
+            # Compressed streams can not be split at byte offsets
+            return False
+
+        with MappedFile.open(xml_file) as mapped:
+            chunks = cls.chunks(mapped.data, mapped.size)
+        if not chunks:
+            return False
+
+        try:
+            with Timing.span('parallel_parse'):
+                cls._parse(pos_xml, chunks)
+        except CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.info('Parallel parse of %s not possible, parsing serial: %s', xml_file.name, e)
+            pos_xml._init_data(xml_file)
+            return False
+
+        Timing.count('parallel_chunks', len(chunks))
+        return True
+
+    @classmethod
+    def _parse(cls, pos_xml: PosXml, chunks: List[Tuple[int, int]]):
+        xml_file = pos_xml.xml_file.as_posix()
+        jobs = [JobScheduler.submit_process(parse_chunk, xml_file, start, end, name=f'parse chunk {start}',
+                                            priority=JobScheduler.current_priority()) for start, end in chunks]
+        label, total = _('{} lesen').format(pos_xml.xml_file.name), chunks[-1][1]
+
+        try:
+            # Merge in document order while later chunks are still parsed
+            for job, (start, end) in zip(jobs, chunks):
+                pos_xml.merge(job.result(pos_xml.cancel_token, cls.poll_interval))
+                if pos_xml.progress is not None:
+                    pos_xml.progress(label, end, total)
+        finally:
+            for job in jobs:
+                job.cancel()
+
+    @classmethod
+    def chunks(cls, data, size: int) -> Union[List[Tuple[int, int]], None]:
+        """ Byte ranges of the stateEngine children of [data] eg. the mapping of a MappedFile """
+        head = data[:cls.scan_window]
+
+        encoding = cls._encoding_re.search(head[:200])
+        if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8'):
+            return None
+
+        start = cls._find_tag(head, b'<stateEngine', 0)
+        if start == -1 or b'<!DOCTYPE' in head[:start] or b'xmlns' in head[:start]:
+            return None
+        content_start = head.find(b'>', start) + 1
+        if not content_start or head[content_start - 2:content_start - 1] == b'/':
+            return None
+
+        content_end = data.rfind(b'</stateEngine>', max(0, size - cls.scan_window))
+        if content_end == -1:
+            return None
+
+        chunk_size = max(cls.min_chunk_size, (content_end - content_start) // (cls.workers() * cls.chunks_per_worker))
+        boundaries = [content_start]
+
+        while boundaries[-1] + chunk_size < content_end:
+            boundary = cls._next_element_start(data, boundaries[-1] + chunk_size, content_end)
+            if boundary is None:
+                break
+            boundaries.append(boundary)
+
+        boundaries.append(content_end)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    @classmethod
+    def _find_tag(cls, data: bytes, tag: bytes, pos: int, end: int=None) -> int:
+        """ Position of the next <tag element in data, ignoring longer tag names eg. <stateObjectName """
+        end = len(data) if end is None else end
+        pos = data.find(tag, pos, end)
+        while pos != -1 and data[pos + len(tag):pos + len(tag) + 1] not in cls._tag_end:
+            pos = data.find(tag, pos + 1, end)
+        return pos
+
+    @classmethod
+    def _next_element_start(cls, data, offset: int, content_end: int) -> Union[int, None]:
+        """ Offset of the first stateEngine child element starting at or after [offset] """
+        while offset < content_end:
+            # Search windows so rare tags do not scan the rest of the file every time,
+            # overlap them by the longest tag so tags on a window border are found
+            window_end = min(offset + cls.scan_window + 16, len(data))
+            positions = [p for p in (cls._find_tag(data, tag, offset, window_end) for tag in cls._tags) if p != -1]
+            positions = [p for p in positions if p < offset + cls.scan_window]
+
+            if positions:
+                boundary = min(positions)
+                return boundary if boundary < content_end else None
+
+            offset += cls.scan_window
+
+        return None
@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union
+
+from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.cancel import CancelledError, NO_CANCEL
+from modules.utils.job_scheduler import Job, JobPriority, JobScheduler
+from modules.utils.log import init_logging
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+
+class PosXmlPreloader:
+    """
+        Speculative background parsing of POS files.
+
+        Files are parsed as soon as they are chosen in the FileWindow or, at application start,
+        from the last used paths. A compare picks up the finished or in-flight parse instead of
+        starting over. Entries are keyed by path, modification time and size so changed files
+        get parsed again. Parses run as background jobs of the JobScheduler, progress is forwarded
+        to whoever currently waits for the result.
+
+        At most the parses of the current old and new file are kept. A parse is released as soon as
+        a compare took it, the preloader does not keep documents alive for the whole session. Watch mode
+        compares get the unchanged document handed over from the previous compare instead.
+    """
+    max_entries = 2
+    poll_interval = 0.1
+
+    _jobs = OrderedDict()  # key: Job
+    _lock = threading.Lock()
+
+    @staticmethod
+    def enabled() -> bool:
+        """ Only the default thread compare backend uses preloaded files, the others parse on their own """
+        return KnechtSettings.app.get('preload', True) and \
+            KnechtSettings.app.get('compare_backend') in (None, 'thread')
+
+    @staticmethod
+    def _key(path: Union[Path, str]):
+        try:
+            path = Path(path)
+            stat = path.stat()
+            return path.resolve().as_posix(), stat.st_mtime_ns, stat.st_size
+        except OSError as e:
+            LOGGER.error('Can not access POS file to preload: %s', e)
+            return None
+
+    @classmethod
+    def preload(cls, path: Union[Path, str]) -> Union[Job, None]:
+        """ Start parsing [path] in the background unless it is already parsed or in-flight """
+        if not cls.enabled():
+            # Eg. the stream or sqlite backend was chosen, they bound memory and parse on their own
+            cls.clear()
+            return None
+
+        key = cls._key(path)
+        if key is None:
+            return None
+
+        with cls._lock:
+            job = cls._jobs.get(key)
+            if job is not None:
+                cls._jobs.move_to_end(key)
+                return job
+
+            LOGGER.debug('Preloading POS file %s', key[0])
+            job = JobScheduler.submit(PosXml, Path(path), name=f'preload {Path(path).name}',
+                                      priority=JobPriority.BACKGROUND, cooperative=True, parallel=True, lean=True)
+            cls._jobs[key] = job
+
+            # Evict the least recently used parses
+            while len(cls._jobs) > cls.max_entries:
+                _, evicted = cls._jobs.popitem(last=False)
+                evicted.cancel()
+
+        return job
+
+    @classmethod
+    def get(cls, path: Union[Path, str], cancel_token=NO_CANCEL, progress=None) -> PosXml:
+        """ Return the preloaded PosXml of [path], waiting for an in-flight parse if necessary """
+        job = cls.preload(path)
+        if job is None:
+            return PosXml(path, cancel_token, progress, lean=True)
+
+        # The user waits for this parse now
+        JobScheduler.prioritize(job, JobPriority.NORMAL)
+        job.listener = progress
+        try:
+            pos_xml = job.result(cancel_token, cls.poll_interval)
+            # The compare owns the document from now on
+            cls._release(job)
+            return pos_xml
+        except CancelledError:
+            if cancel_token.cancelled:
+                raise
+            # Preload was evicted while waiting
+        except Exception as e:
+            LOGGER.error('Preloading %s failed, parsing again: %s', path, e)
+        finally:
+            job.listener = None
+
+        cls.discard(path)
+        return PosXml(path, cancel_token, progress, parallel=True, lean=True)
+
+    @classmethod
+    def _release(cls, job: Job):
+        with cls._lock:
+            for key, entry in list(cls._jobs.items()):
+                if entry is job:
+                    del cls._jobs[key]
+
+    @classmethod
+    def clear(cls):
+        """ Cancel and release all preloads """
+        with cls._lock:
+            jobs = list(cls._jobs.values())
+            cls._jobs.clear()
+
+        for job in jobs:
+            job.cancel()
+
+    @classmethod
+    def discard(cls, path: Union[Path, str]):
+        key = cls._key(path)
+        with cls._lock:
+            job = cls._jobs.pop(key, None)
+        if job is not None:
+            job.cancel()
+
+    @classmethod
+    def preload_last_used(cls):
+        """ Start parsing the POS files of the last compare """
+        if not cls.enabled():
+            return
+
+        for setting_key in ('pos_old_path', 'pos_new_path'):
+            path = KnechtSettings.app.get(setting_key)
+            if path and Path(path).is_file():
+                cls.preload(path)
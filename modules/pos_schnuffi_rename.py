@@ -0,0 +1,154 @@
+"""
+    Detection of renamed actionLists.
+
+    An actionList renamed between both documents shows up as one removed and one added list.
+    Removed and added lists with identical content are paired by a hash join on their content,
+    lists whose actions differ slightly are paired by a bottom-k MinHash sketch of their actors
+    and actions: lists sharing sketch hashes are candidates, the best candidates are verified
+    with the exact Jaccard similarity of both token sets.
+
+    Every list is hashed once and looked up in buckets of bounded size, the detection stays
+    linear in the number of removed and added actionLists.
+"""
+import heapq
+import zlib
+from collections import Counter, deque
+from typing import Dict, Iterable, List, Tuple
+
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.log import init_logging
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+
+class RenameDetector:
+    """ Pair removed actionLists of the old document with added actionLists of the new document """
+    # Number of smallest token hashes kept per actionList
+    sketch_size = 16
+    # Sketch hashes shared by more actionLists are too common to tell them apart
+    max_bucket = 64
+    # Candidates verified per added actionList, most shared sketch hashes first
+    max_candidates = 4
+    # Smaller actionLists are only paired if their content is identical
+    min_near_actions = 3
+
+    @staticmethod
+    def enabled() -> bool:
+        return KnechtSettings.app.get('rename_detection', True)
+
+    @staticmethod
+    def threshold() -> float:
+        """ Minimum Jaccard similarity of slightly changed actionLists """
+        return float(KnechtSettings.app.get('rename_similarity', 0.6))
+
+    @staticmethod
+    def content_key(action: dict) -> frozenset:
+        """ Hashable content of a PosXml.xml_dict actionList """
+        return frozenset((actor, a.get('value'), a.get('type')) for actor, a in action.items())
+
+    @staticmethod
+    def tokens(action: dict) -> set:
+        """ 32 bit hashes of the actors and actions of an actionList, a changed value keeps the actor token """
+        tokens = set()
+        for actor, a in action.items():
+            tokens.add(zlib.crc32(f'a\x1f{actor}'.encode('utf-8')))
+            tokens.add(zlib.crc32(f'v\x1f{actor}\x1f{a.get("value")}\x1f{a.get("type")}'.encode('utf-8')))
+        return tokens
+
+    @classmethod
+    def sketch(cls, tokens: set) -> List[int]:
+        return heapq.nsmallest(cls.sketch_size, tokens)
+
+    @classmethod
+    def detect(cls, removed: Iterable[str], added: Iterable[str], old: Dict[str, dict], new: Dict[str, dict],
+               cancel_token=NO_CANCEL) -> List[Tuple[str, str, float]]:
+        """ Find renamed actionLists
+
+        :param removed: names of actionLists only in the old document
+        :param added: names of actionLists only in the new document
+        :param old: PosXml.xml_dict of the old document
+        :param new: PosXml.xml_dict of the new document
+        :returns: list of (old name, new name, similarity) - similarity is 1.0 for identical content
+        """
+        pairs, removed, added = cls._exact_pairs(sorted(removed), sorted(added), old, new, cancel_token)
+
+        threshold = cls.threshold()
+        if removed and added and threshold < 1.0:
+            pairs += cls._near_pairs(removed, added, old, new, threshold, cancel_token)
+
+        LOGGER.debug('Detected %s renamed actionLists', len(pairs))
+        return pairs
+
+    @classmethod
+    def _exact_pairs(cls, removed: List[str], added: List[str], old: dict, new: dict, cancel_token):
+        """ Hash join of removed and added actionLists on their content. Returns the pairs and
+            the names left unpaired.
+        """
+        by_content, unpaired_removed = dict(), list()
+        for name in removed:
+            cancel_token.check()
+            action = old.get(name)
+            if action:
+                by_content.setdefault(cls.content_key(action), deque()).append(name)
+            else:
+                # Empty actionLists are all alike
+                unpaired_removed.append(name)
+
+        pairs, unpaired_added = list(), list()
+        for name in added:
+            cancel_token.check()
+            action = new.get(name)
+            names = by_content.get(cls.content_key(action)) if action else None
+            if names:
+                pairs.append((names.popleft(), name, 1.0))
+            else:
+                unpaired_added.append(name)
+
+        unpaired_removed.extend(name for names in by_content.values() for name in names)
+        return pairs, sorted(unpaired_removed), unpaired_added
+
+    @classmethod
+    def _near_pairs(cls, removed: List[str], added: List[str], old: dict, new: dict, threshold: float,
+                    cancel_token) -> List[Tuple[str, str, float]]:
+        """ Pair the most similar actionLists first, every actionList is paired at most once """
+        removed_tokens, index = dict(), dict()
+        for name in removed:
+            cancel_token.check()
+            action = old.get(name)
+            if not action or len(action) < cls.min_near_actions:
+                continue
+
+            removed_tokens[name] = tokens = cls.tokens(action)
+            for h in cls.sketch(tokens):
+                index.setdefault(h, list()).append(name)
+
+        candidates = list()
+        for name in added:
+            cancel_token.check()
+            action = new.get(name)
+            if not action or len(action) < cls.min_near_actions:
+                continue
+
+            tokens, shared = cls.tokens(action), Counter()
+            for h in cls.sketch(tokens):
+                bucket = index.get(h)
+                if bucket and len(bucket) <= cls.max_bucket:
+                    shared.update(bucket)
+
+            for old_name, _count in shared.most_common(cls.max_candidates):
+                old_tokens = removed_tokens[old_name]
+                similarity = len(tokens & old_tokens) / len(tokens | old_tokens)
+                if similarity >= threshold:
+                    candidates.append((similarity, old_name, name))
+
+        candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+        pairs, paired_old, paired_new = list(), set(), set()
+        for similarity, old_name, new_name in candidates:
+            if old_name in paired_old or new_name in paired_new:
+                continue
+            paired_old.add(old_name)
+            paired_new.add(new_name)
+            pairs.append((old_name, new_name, similarity))
+
+        return pairs
@@ -0,0 +1,248 @@
+"""
+    Spreadsheet reports of a PosDiff written row by row from the diff result, not from the tree views.
+
+    Every changed actor of the added, modified, removed and renamed actionLists is one row and every
+    added, removed and modified switch and look actor is one row:
+        section, result, actionList, actor, new_value, old_value, type, old_actionList, similarity
+
+    Renamed actionLists without changed actors are one row without actor.
+
+    Rows are generated and written one at a time, memory use does not grow with the number of rows.
+    CSV and JSON reports are compressed if their file name ends with .gz or .zst.
+"""
+import csv
+import io
+import re
+import zipfile
+from pathlib import Path
+from typing import Iterator, Union
+from xml.sax.saxutils import escape
+
+import ujson
+
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+COLUMNS = ('section', 'result', 'actionList', 'actor', 'new_value', 'old_value', 'type', 'old_actionList',
+           'similarity')
+
+
+def iterate_report_rows(diff) -> Iterator[tuple]:
+    """ Yield the report rows of a modules.pos_schnuffi_xml_diff.PosDiff """
+    for result, action_lists in (('added', diff.added_action_ls),
+                                 ('modified', diff.modified_action_ls),
+                                 ('removed', diff.removed_action_ls)):
+        for al in action_lists:
+            for actor, a in al.actors.items():
+                yield 'actionList', result, al.name, actor, a.get('new_value'), a.get('old_value'), a.get('type'), \
+                      None, None
+
+    for al in diff.renamed_action_ls:
+        similarity = round(al.similarity, 3)
+        if not al.actors:
+            yield 'actionList', 'renamed', al.name, None, None, None, None, al.old_name, similarity
+        for actor, a in al.actors.items():
+            yield 'actionList', 'renamed', al.name, actor, a.get('new_value'), a.get('old_value'), a.get('type'), \
+                  al.old_name, similarity
+
+    for section, actor_sets in (('switch', (diff.add_switches, diff.rem_switches, diff.mod_switches)),
+                                ('look', (diff.add_looks, diff.rem_looks, diff.mod_looks))):
+        for result, actors in zip(('added', 'removed', 'modified'), actor_sets):
+            for actor in sorted(actors, key=str):
+                yield section, result, None, actor, None, None, None, None, None
+
+
+def report_row_count(diff) -> int:
+    count = sum(len(al.actors) for als in (diff.added_action_ls, diff.modified_action_ls, diff.removed_action_ls)
+                for al in als)
+    count += sum(len(al.actors) or 1 for al in diff.renamed_action_ls)
+    return count + sum(len(s) for s in (diff.add_switches, diff.rem_switches, diff.mod_switches,
+                                        diff.add_looks, diff.rem_looks, diff.mod_looks))
+
+
+class _XlsxWriter:
+    """
+        Minimal streaming Office Open XML workbook. Cells are written as inline strings so no shared
+        string table has to be kept in memory, rows beyond the sheet limit continue on a new sheet.
+    """
+    max_rows = 1048576
+    _invalid_xml_re = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    _ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    _rel_ns = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    _pkg_rel_ns = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    _sheet_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+    _workbook_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml'
+
+    def __init__(self, file_obj, sheet_name: str, header: tuple):
+        self.zip_file = zipfile.ZipFile(file_obj, 'w', zipfile.ZIP_DEFLATED)
+        self.sheet_name = sheet_name
+        self.header = header
+        self.sheets = 0
+        self.sheet = None
+        self.sheet_rows = 0
+
+    def _cell(self, value) -> str:
+        if value is None:
+            return '<c/>'
+        return f'<c t="inlineStr"><is><t xml:space="preserve">' \
+               f'{escape(self._invalid_xml_re.sub("", str(value)))}</t></is></c>'
+
+    def _row(self, row: tuple) -> bytes:
+        return f'<row>{"".join(self._cell(v) for v in row)}</row>'.encode('utf-8')
+
+    def _new_sheet(self):
+        self._close_sheet()
+        self.sheets += 1
+        self.sheet = self.zip_file.open(f'xl/worksheets/sheet{self.sheets}.xml', 'w', force_zip64=True)
+        self.sheet.write(
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="{self._ns}">'
+            f'<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" '
+            f'state="frozen"/></sheetView></sheetViews><sheetData>'.encode('utf-8'))
+        self.sheet.write(self._row(self.header))
+        self.sheet_rows = 1
+
+    def _close_sheet(self):
+        if self.sheet is None:
+            return
+
+        last_column = chr(ord('A') + len(self.header) - 1)
+        self.sheet.write(f'</sheetData><autoFilter ref="A1:{last_column}{self.sheet_rows}"/></worksheet>'
+                         .encode('utf-8'))
+        self.sheet.close()
+        self.sheet = None
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.sheet is None or self.sheet_rows >= self.max_rows:
+                self._new_sheet()
+            self.sheet.write(self._row(row))
+            self.sheet_rows += 1
+
+    def close(self):
+        if self.sheet is None:
+            self._new_sheet()
+        self._close_sheet()
+
+        names = [self.sheet_name if n == 1 else f'{self.sheet_name} {n}' for n in range(1, self.sheets + 1)]
+        overrides = ''.join(f'<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="{self._sheet_type}"/>'
+                            for n in range(1, self.sheets + 1))
+        sheets = ''.join(f'<sheet name="{escape(name)}" sheetId="{n}" r:id="rId{n}"/>'
+                         for n, name in enumerate(names, start=1))
+        sheet_rels = ''.join(f'<Relationship Id="rId{n}" Target="worksheets/sheet{n}.xml" '
+                             f'Type="{self._rel_ns}/worksheet"/>' for n in range(1, self.sheets + 1))
+        head = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+        self.zip_file.writestr(
+            '[Content_Types].xml',
+            f'{head}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            f'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" ContentType="{self._workbook_type}"/>{overrides}</Types>')
+        self.zip_file.writestr(
+            '_rels/.rels',
+            f'{head}<Relationships xmlns="{self._pkg_rel_ns}"><Relationship Id="rId1" Target="xl/workbook.xml" '
+            f'Type="{self._rel_ns}/officeDocument"/></Relationships>')
+        self.zip_file.writestr(
+            'xl/workbook.xml',
+            f'{head}<workbook xmlns="{self._ns}" xmlns:r="{self._rel_ns}"><sheets>{sheets}</sheets></workbook>')
+        self.zip_file.writestr(
+            'xl/_rels/workbook.xml.rels',
+            f'{head}<Relationships xmlns="{self._pkg_rel_ns}">{sheet_rels}</Relationships>')
+        self.zip_file.close()
+
+
+class DiffReport:
+    """ Write the rows of a PosDiff as CSV, JSON array of records or XLSX workbook """
+    CSV, JSON, XLSX = 'csv', 'json', 'xlsx'
+    suffixes = {'.csv': CSV, '.json': JSON, '.xlsx': XLSX}
+
+    # Excel with german locale expects semicolon separated values and recognizes utf-8 by it's BOM
+    csv_delimiter = ';'
+    csv_encoding = 'utf-8-sig'
+    batch_size = 1000
+
+    @classmethod
+    def file_filter(cls) -> str:
+        return ';;'.join((_('Excel Arbeitsmappe (*.xlsx)'), _('CSV Datei (*.csv)'), _('JSON Datei (*.json)')))
+
+    @classmethod
+    def report_format(cls, file: Union[Path, str]) -> str:
+        report_format = cls.suffixes.get(CompressedFile.base_suffix(file))
+        if report_format is None:
+            raise ValueError(f'Unsupported report file type {Path(file).name}, use one of '
+                             f'{", ".join(cls.suffixes)}')
+        if report_format == cls.XLSX and CompressedFile.suffix_compression(file):
+            raise ValueError('XLSX workbooks are compressed already.')
+        return report_format
+
+    @classmethod
+    def write(cls, diff, file: Union[Path, str], cancel_token=NO_CANCEL, progress=None) -> int:
+        """ Write the report of [diff] to [file] in the format of it's suffix, returns the number of rows.
+            The file is replaced only once it is completely written.
+        """
+        file = Path(file)
+        write_rows = getattr(cls, f'_write_{cls.report_format(file)}')
+        total, label = report_row_count(diff), _('Bericht {} schreiben').format(file.name)
+
+        def batches():
+            batch, done = list(), 0
+            for row in iterate_report_rows(diff):
+                batch.append(row)
+                if len(batch) >= cls.batch_size:
+                    cancel_token.check()
+                    done += len(batch)
+                    yield batch
+                    batch = list()
+                    if progress is not None:
+                        progress(label, done, total)
+            if batch:
+                yield batch
+            if progress is not None:
+                progress(label, total, total)
+
+        with CompressedFile.writer(file, atomic=True) as f:
+            write_rows(f, batches())
+
+        LOGGER.info('Wrote report of %s rows to %s', total, file.as_posix())
+        return total
+
+    @classmethod
+    def _write_csv(cls, f, batches):
+        text = io.TextIOWrapper(f, encoding=cls.csv_encoding, newline='')
+        try:
+            writer = csv.writer(text, delimiter=cls.csv_delimiter)
+            writer.writerow(COLUMNS)
+            for batch in batches:
+                writer.writerows(batch)
+        finally:
+            text.flush()
+            text.detach()
+
+    @classmethod
+    def _write_json(cls, f, batches):
+        f.write(b'[')
+        separator = b'\n'
+        for batch in batches:
+            for row in batch:
+                f.write(separator)
+                f.write(ujson.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False,
+                                    escape_forward_slashes=False).encode('utf-8'))
+                separator = b',\n'
+        f.write(b'\n]\n')
+
+    @classmethod
+    def _write_xlsx(cls, f, batches):
+        workbook = _XlsxWriter(f, 'POS Diff', COLUMNS)
+        for batch in batches:
+            workbook.write_rows(batch)
+        workbook.close()
@@ -0,0 +1,152 @@
+import gzip
+import os
+import zlib
+from pathlib import Path
+from typing import Union
+
+import ujson
+from PySide2.QtCore import Qt
+from PySide2.QtWidgets import QTreeWidget
+
+from modules.pos_schnuffi_daemon import diff_from_json, diff_to_json
+from modules.pos_schnuffi_diff_cache import DiffCache
+from modules.pos_schnuffi_xml_diff import PosDiff
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+from modules.utils.ui_resource import FontRsc
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class SchnuffiSession:
+    """
+        A compare session: both input paths with their content hashes, the diff result and
+        the user edits made in the tree widgets.
+
+        Edits are stored per widget as actionList name and the texts of all children of
+        top level items flagged as edited by ItemEditUndoCommand.
+
+        Sessions are shared between users and stored as gzip compressed JSON, never as pickle.
+    """
+    version = 2
+    format_name = 'pos_schnuffi_session'
+    suffix = '.schnuffi'
+    file_filter = _('POS Schnuffi Sitzung (*.schnuffi)')
+
+    def __init__(self, old_path: Union[Path, str], new_path: Union[Path, str], diff: PosDiff, edits: dict=None,
+                 old_hash: str='', new_hash: str=''):
+        self.old_path, self.new_path = Path(old_path), Path(new_path)
+        self.diff = diff
+        # widget object name: list of (actionList name, children texts)
+        self.edits = edits or dict()
+        self.old_hash, self.new_hash = old_hash, new_hash
+
+    def hashes_match(self) -> bool:
+        """ Both source files still exist and are unchanged since the session was saved """
+        try:
+            return (DiffCache.file_hash(self.old_path) == self.old_hash and
+                    DiffCache.file_hash(self.new_path) == self.new_hash)
+        except OSError:
+            return False
+
+    def save(self, file: Path):
+        state = {
+            'format': self.format_name, 'version': self.version,
+            'old_path': self.old_path.as_posix(), 'new_path': self.new_path.as_posix(),
+            'old_hash': self.old_hash, 'new_hash': self.new_hash,
+            'diff': diff_to_json(self.diff),
+            'edits': self.edits,
+            }
+        data = ujson.dumps(state, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+        tmp_file = file.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(gzip.compress(data, 6))
+        os.replace(tmp_file, file)
+
+        LOGGER.info('Saved session %s', file.as_posix())
+
+    @classmethod
+    def load(cls, file: Path):
+        """ :raises ValueError: if the file is not a session of this version """
+        with open(file, 'rb') as f:
+            data = f.read()
+
+        try:
+            state = ujson.loads(gzip.decompress(data).decode('utf-8'))
+        except (OSError, EOFError, ValueError, zlib.error):
+            state = None
+
+        if not isinstance(state, dict) or state.get('format') != cls.format_name \
+                or state.get('version') != cls.version or not isinstance(state.get('edits'), dict):
+            raise ValueError(_('Sitzungsdatei hat ein unbekanntes Format: {}').format(file.name))
+
+        try:
+            diff = diff_from_json(state['diff'])
+            return cls(state['old_path'], state['new_path'], diff, state['edits'],
+                       state['old_hash'], state['new_hash'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(_('Sitzungsdatei ist beschädigt: {}').format(file.name)) from e
+
+    @staticmethod
+    def collect_edits(widgets) -> dict:
+        """ Collect children of all top level items flagged as edited """
+        edits = dict()
+
+        for widget in widgets:
+            widget_edits = list()
+
+            for idx in range(widget.topLevelItemCount()):
+                item = widget.topLevelItem(idx)
+                if not item.data(0, Qt.UserRole):
+                    continue
+
+                children = list()
+                for c in range(item.childCount()):
+                    child = item.child(c)
+                    children.append(tuple(child.text(column) for column in range(child.columnCount())))
+
+                widget_edits.append((item.text(0), children))
+
+            if widget_edits:
+                edits[widget.objectName()] = widget_edits
+
+        return edits
+
+    @staticmethod
+    def apply_edits(widgets, edits: dict) -> int:
+        """ Restore edited children texts, returns the number of restored actionLists """
+        restored = 0
+
+        for widget in widgets:
+            widget: QTreeWidget
+            widget_edits = edits.get(widget.objectName())
+            if not widget_edits:
+                continue
+
+            items = {widget.topLevelItem(idx).text(0): widget.topLevelItem(idx)
+                     for idx in range(widget.topLevelItemCount())}
+
+            for al_name, children in widget_edits:
+                item = items.get(al_name)
+                if item is None:
+                    LOGGER.warning('Can not restore edits of %s in %s', al_name, widget.objectName())
+                    continue
+
+                for c, texts in enumerate(children[:item.childCount()]):
+                    child = item.child(c)
+                    for column, text in enumerate(texts):
+                        if child.text(column) != text:
+                            child.setText(column, text)
+
+                # Flag and style like ItemEditUndoCommand
+                item.setData(0, Qt.UserRole, True)
+                item.setFont(0, FontRsc.italic)
+                restored += 1
+
+        return restored
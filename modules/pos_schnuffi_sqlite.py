@@ -0,0 +1,356 @@
+"""
+    Out-of-core compare of POS files through a local SQLite database.
+
+    Both documents are streamed with lxml.etree.iterparse into indexed tables and
+    diffed with SQL queries. Rows for the views are read from the database in pages,
+    so neither document nor the diff result needs to fit into memory at once.
+"""
+import os
+import sqlite3
+import tempfile
+from itertools import groupby
+from pathlib import Path
+from typing import Union
+
+import lxml.etree as Et
+
+from modules.pos_schnuffi_worker import ADDED, MODIFIED, REMOVED, SWITCHES, LOOKS, POS_OLD, POS_NEW, actor_rows
+from modules.pos_schnuffi_xml_diff import PosXml
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.globals import get_settings_dir
+from modules.utils.instrumentation import Timing
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+NEW_DOC, OLD_DOC = 1, 2
+
+_SCHEMA = """
+CREATE TABLE action_lists(doc INTEGER, name TEXT, first_seq INTEGER, last_seq INTEGER, PRIMARY KEY(doc, name));
+CREATE TABLE raw_actions(doc INTEGER, al TEXT, al_seq INTEGER, seq INTEGER, actor TEXT, value TEXT, type TEXT);
+CREATE TABLE conditions(doc INTEGER, name TEXT, first_seq INTEGER, PRIMARY KEY(doc, name));
+CREATE TABLE condition_states(doc INTEGER, name TEXT, cond_seq INTEGER, state_object TEXT);
+"""
+
+# Effective actors like PosXml.xml_dict: the last occurrence of an actionList replaces
+# earlier ones, the last action of an actor wins but keeps the position of it's first.
+_FINALIZE = """
+CREATE TABLE actions AS
+    SELECT doc, al, actor, value, type, pos FROM (
+        SELECT r.doc, r.al, r.actor, r.value, r.type,
+               ROW_NUMBER() OVER (PARTITION BY r.doc, r.al, r.actor ORDER BY r.seq DESC) AS rn,
+               MIN(r.seq) OVER (PARTITION BY r.doc, r.al, r.actor) AS pos
+        FROM raw_actions r JOIN action_lists a ON a.doc = r.doc AND a.name = r.al AND a.last_seq = r.al_seq
+        )
+    WHERE rn = 1;
+CREATE INDEX actions_idx ON actions(doc, al, actor);
+CREATE TABLE actor_values AS SELECT DISTINCT doc, type, actor, value FROM raw_actions;
+CREATE INDEX actor_values_idx ON actor_values(doc, type, actor);
+DROP TABLE raw_actions;
+"""
+
+_DIFFERING_ACTORS = """
+SELECT n.al AS al, n.actor AS actor, n.value AS new_value, COALESCE(n.type, o.type) AS type,
+       o.value AS old_value, n.pos AS pos FROM actions n
+    LEFT JOIN actions o ON o.doc = :old AND o.al = n.al AND o.actor = n.actor
+    WHERE n.doc = :new AND n.al IN (SELECT name FROM {table})
+      AND (o.actor IS NULL OR o.value IS NOT n.value OR o.type IS NOT n.type)
+UNION ALL
+SELECT o.al, o.actor, NULL, o.type, o.value, o.pos FROM actions o
+    LEFT JOIN actions n ON n.doc = :new AND n.al = o.al AND n.actor = o.actor
+    WHERE o.doc = :old AND o.al IN (SELECT name FROM {table}) AND n.actor IS NULL
+"""
+
+
+class PosSqliteStore:
+    """ SQLite database of the actionLists, actions, conditions and condition stateObjects of POS documents """
+    batch_size = 5000
+
+    def __init__(self, db_file: Union[Path, str, None]=None):
+        if db_file is None:
+            fd, db_file = tempfile.mkstemp(suffix='.sqlite', prefix='PosSchnuffi_', dir=get_settings_dir() or None)
+            os.close(fd)
+            os.remove(db_file)
+
+        self.db_file = Path(db_file)
+        self.conn = sqlite3.connect(self.db_file.as_posix(), check_same_thread=False)
+        # The database is temporary, trade durability for speed
+        self.conn.executescript('PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF; PRAGMA temp_store=FILE;')
+        self.conn.executescript(_SCHEMA)
+
+    def import_document(self, doc: int, xml_file: Path, cancel_token=NO_CANCEL, progress=None):
+        """ Stream a POS document into the database, elements are released as soon as they are stored """
+        xml_file = Path(xml_file)
+        actions, states, seq, action_seq = list(), list(), 0, 0
+        cur = self.conn.cursor()
+
+        with CompressedFile.reader(xml_file, _('{} lesen').format(xml_file.name), progress, cancel_token) as reader, \
+                Timing.span('sqlite_import'):
+            for _event, e in Et.iterparse(reader, events=('end', ), tag=('actionList', 'condition')):
+                parent = e.getparent()
+                # Only top level elements like PosXml: root/stateEngine/actionList
+                if parent is None or parent.getparent() is None or parent.getparent().getparent() is not None:
+                    continue
+
+                seq += 1
+                if e.tag == 'actionList':
+                    name = e.get('name')
+                    if name:
+                        cur.execute('INSERT INTO action_lists VALUES (?, ?, ?, ?) '
+                                    'ON CONFLICT(doc, name) DO UPDATE SET last_seq = excluded.last_seq',
+                                    (doc, name, seq, seq))
+                        # Same order as PosXml.add_action_list
+                        for actor, value, actor_type in PosXml.iterate_actors(e):
+                            action_seq += 1
+                            actions.append((doc, name, seq, action_seq, actor, value, actor_type))
+                else:
+                    name = e.findtext('actionListName')
+                    if name:
+                        cur.execute('INSERT OR IGNORE INTO conditions VALUES (?, ?, ?)', (doc, name, seq))
+                        for s in e.iterfind('./stateCondition'):
+                            state_obj_name = s.findtext('stateObjectName')
+                            if state_obj_name:
+                                states.append((doc, name, seq, state_obj_name))
+
+                # Release the element and it's already processed siblings
+                e.clear()
+                while e.getprevious() is not None:
+                    del parent[0]
+
+                if len(actions) >= self.batch_size or len(states) >= self.batch_size:
+                    self._flush(cur, actions, states)
+
+        self._flush(cur, actions, states)
+        self.conn.commit()
+
+    @staticmethod
+    def _flush(cur, actions: list, states: list):
+        cur.executemany('INSERT INTO raw_actions VALUES (?, ?, ?, ?, ?, ?, ?)', actions)
+        cur.executemany('INSERT INTO condition_states VALUES (?, ?, ?, ?)', states)
+        actions.clear()
+        states.clear()
+
+    def finalize(self):
+        """ Resolve duplicates and create the indices used by the diff queries """
+        with Timing.span('sqlite_index'):
+            self.conn.executescript(_FINALIZE)
+            self.conn.commit()
+
+    def close(self, remove: bool=True):
+        if self.conn is None:
+            return
+
+        self.conn.close()
+        self.conn = None
+        if remove:
+            try:
+                self.db_file.unlink()
+            except OSError as e:
+                LOGGER.error('Could not remove compare database %s: %s', self.db_file, e)
+
+
+class SqlitePosDiff:
+    """
+        Diff of two POS documents computed with indexed queries on a PosSqliteStore.
+
+        Provides the summary attributes of PosDiff. ActionList rows are not held in memory,
+        read them with iterate_rows or page them with rows.
+    """
+    page_size = 1000
+
+    def __init__(self, new_xml_path, old_xml_path, cancel_token=NO_CANCEL, progress=None, db_file=None):
+        self.new_xml_path, self.old_xml_path = Path(new_xml_path), Path(old_xml_path)
+        self.cancel_token = cancel_token
+        self.store = PosSqliteStore(db_file)
+        self.conn = self.store.conn
+
+        try:
+            self.store.import_document(NEW_DOC, self.new_xml_path, cancel_token, progress)
+            self.store.import_document(OLD_DOC, self.old_xml_path, cancel_token, progress)
+            self.store.finalize()
+
+            with Timing.span('diff'):
+                self.__create_diff_tables()
+                self.error_num = 0
+                self.error_report = self.__create_error_report()
+
+                self.add_switches, self.rem_switches, self.mod_switches = self.__diff_actors('switch')
+                self.add_looks, self.rem_looks, self.mod_looks = self.__diff_actors('appearance')
+        except Exception:
+            self.close()
+            raise
+
+        self.no_difference = not any((self.count(ADDED), self.count(REMOVED), self.count(MODIFIED),
+                                      self.add_switches, self.rem_switches, self.mod_switches,
+                                      self.add_looks, self.rem_looks, self.mod_looks))
+
+    def __create_diff_tables(self):
+        """ Names of added, removed and modified actionLists """
+        self.conn.executescript(f"""
+            CREATE TEMP TABLE added AS SELECT name, first_seq FROM action_lists n WHERE doc = {NEW_DOC}
+                AND NOT EXISTS (SELECT 1 FROM action_lists o WHERE o.doc = {OLD_DOC} AND o.name = n.name);
+            CREATE TEMP TABLE removed AS SELECT name, first_seq FROM action_lists o WHERE doc = {OLD_DOC}
+                AND NOT EXISTS (SELECT 1 FROM action_lists n WHERE n.doc = {NEW_DOC} AND n.name = o.name);
+            CREATE TEMP TABLE modified AS SELECT n.name, n.first_seq FROM action_lists n
+                JOIN action_lists o ON o.doc = {OLD_DOC} AND o.name = n.name
+                WHERE n.doc = {NEW_DOC} AND n.name IN (
+                    SELECT n.al FROM actions n LEFT JOIN actions o
+                        ON o.doc = {OLD_DOC} AND o.al = n.al AND o.actor = n.actor
+                        WHERE n.doc = {NEW_DOC}
+                          AND (o.actor IS NULL OR o.value IS NOT n.value OR o.type IS NOT n.type)
+                    UNION
+                    SELECT o.al FROM actions o LEFT JOIN actions n
+                        ON n.doc = {NEW_DOC} AND n.al = o.al AND n.actor = o.actor
+                        WHERE o.doc = {OLD_DOC} AND n.actor IS NULL
+                    );
+            """)
+
+    def __create_error_report(self, report: str='') -> str:
+        for doc, file_path in ((NEW_DOC, self.new_xml_path), (OLD_DOC, self.old_xml_path)):
+            self.cancel_token.check()
+            report += f'<h4>{file_path.name}</h4>'
+
+            missing_al = [r[0] for r in self.conn.execute(
+                'SELECT name FROM conditions c WHERE doc = ? AND NOT EXISTS '
+                '(SELECT 1 FROM action_lists a WHERE a.doc = c.doc AND a.name = c.name) ORDER BY first_seq', (doc, ))]
+            missing_co = [r[0] for r in self.conn.execute(
+                'SELECT name FROM action_lists a WHERE doc = ? AND NOT EXISTS '
+                '(SELECT 1 FROM conditions c WHERE c.doc = a.doc AND c.name = a.name) ORDER BY first_seq', (doc, ))]
+
+            report += PosXml.condition_report(missing_al, missing_co)
+            self.error_num += len(missing_al) + len(missing_co)
+
+        return report
+
+    def __diff_actors(self, actor_type: str):
+        """ Added, removed and changed actors compared by the set of values they are used with """
+        in_other = 'EXISTS (SELECT 1 FROM actor_values b WHERE b.doc = :other AND b.type = :type AND b.actor = a.actor)'
+        value_in_other = 'EXISTS (SELECT 1 FROM actor_values b WHERE b.doc = :other AND b.type = :type ' \
+                         'AND b.actor = a.actor AND b.value IS a.value)'
+
+        def actors(doc: int, other: int, condition: str) -> set:
+            self.cancel_token.check()
+            return {r[0] for r in self.conn.execute(
+                f'SELECT DISTINCT a.actor FROM actor_values a WHERE a.doc = :doc AND a.type = :type AND {condition}',
+                {'doc': doc, 'other': other, 'type': actor_type})}
+
+        added = actors(NEW_DOC, OLD_DOC, f'NOT {in_other}')
+        removed = actors(OLD_DOC, NEW_DOC, f'NOT {in_other}')
+        changed = actors(NEW_DOC, OLD_DOC, f'{in_other} AND NOT {value_in_other}')
+        changed.update(actors(OLD_DOC, NEW_DOC, f'{in_other} AND NOT {value_in_other}'))
+
+        return added, removed, changed
+
+    def count(self, target: int) -> int:
+        if target in (ADDED, REMOVED, MODIFIED):
+            table = self._diff_table(target)
+            return self.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        if target in (POS_OLD, POS_NEW):
+            return self.conn.execute('SELECT COUNT(DISTINCT al) FROM actions WHERE doc = ?',
+                                     (self._doc(target), )).fetchone()[0]
+        return len(self._actor_rows(target))
+
+    @staticmethod
+    def _diff_table(target: int) -> str:
+        return {ADDED: 'added', REMOVED: 'removed', MODIFIED: 'modified'}[target]
+
+    @staticmethod
+    def _doc(target: int) -> int:
+        return OLD_DOC if target == POS_OLD else NEW_DOC
+
+    def _actor_rows(self, target: int) -> list:
+        if target == SWITCHES:
+            return actor_rows(self.add_switches, self.rem_switches, self.mod_switches)
+        return actor_rows(self.add_looks, self.rem_looks, self.mod_looks)
+
+    def _query_rows(self, target: int, offset: int=0, limit: int=-1):
+        """ Yield rows of [target] in view order, actionLists are paged with offset and limit """
+        if target in (SWITCHES, LOOKS):
+            yield from self._actor_rows(target)[offset:None if limit < 0 else offset + limit]
+            return
+
+        if target in (POS_OLD, POS_NEW):
+            cursor = self.conn.execute(
+                'SELECT a.al, a.actor, a.value, a.type FROM actions a JOIN ('
+                '   SELECT name, first_seq FROM action_lists WHERE doc = :doc AND name IN '
+                '   (SELECT al FROM actions WHERE doc = :doc) ORDER BY first_seq LIMIT :limit OFFSET :offset'
+                ') p ON p.name = a.al WHERE a.doc = :doc ORDER BY p.first_seq, a.pos',
+                {'doc': self._doc(target), 'limit': limit, 'offset': offset})
+
+            for al_name, actors in groupby(cursor, key=lambda r: r[0]):
+                yield (al_name, ), tuple((actor, value, actor_type) for _al, actor, value, actor_type in actors)
+            return
+
+        for al_name, actors in self._query_action_lists(target, offset, limit):
+            children = tuple((actor or '', new_value or '', old_value or '', actor_type or '')
+                             for actor, new_value, old_value, actor_type in actors)
+            yield (al_name, ), children
+
+    def _query_action_lists(self, target: int, offset: int=0, limit: int=-1):
+        """ Yield (name, [(actor, new_value, old_value, type), ...]) of the added, modified or removed
+            actionLists in view order
+        """
+        table = self._diff_table(target)
+        page = f'(SELECT name FROM {table} ORDER BY first_seq LIMIT {int(limit)} OFFSET {int(offset)})'
+        cursor = self.conn.execute(
+            f'SELECT p.name, d.actor, d.new_value, d.old_value, d.type FROM '
+            f'(SELECT name, first_seq FROM {table} WHERE name IN {page}) p '
+            f'LEFT JOIN ({_DIFFERING_ACTORS.format(table=page)}) d ON d.al = p.name '
+            f'ORDER BY p.first_seq, d.pos',
+            {'new': NEW_DOC, 'old': OLD_DOC})
+
+        for al_name, actors in groupby(cursor, key=lambda r: r[0]):
+            yield al_name, [(actor, new_value, old_value, actor_type)
+                            for _al, actor, new_value, old_value, actor_type in actors if actor is not None]
+
+    def to_state(self) -> dict:
+        """ Diff result like PosDiff.to_state, without the complete documents. Holds the changed
+            actionLists in memory, the size of the result views.
+        """
+        def action_lists(target: int) -> list:
+            self.cancel_token.check()
+            return [(al_name, {actor: {'new_value': new_value, 'type': actor_type, 'old_value': old_value}
+                               for actor, new_value, old_value, actor_type in actors})
+                    for al_name, actors in self._query_action_lists(target)]
+
+        return {
+            'added': action_lists(ADDED), 'modified': action_lists(MODIFIED), 'removed': action_lists(REMOVED),
+            'renamed': list(),
+            'error_report': self.error_report, 'error_num': self.error_num,
+            'switches': (self.add_switches, self.rem_switches, self.mod_switches),
+            'looks': (self.add_looks, self.rem_looks, self.mod_looks),
+            'no_difference': self.no_difference,
+            'new': dict(), 'old': dict(),
+            }
+
+    def rows(self, target: int, offset: int, limit: int) -> list:
+        """ A page of top level rows eg. for a model fetching rows on demand """
+        return list(self._query_rows(target, offset, limit))
+
+    def iterate_rows(self, views: bool=True):
+        """ Yield (target, row) like modules.pos_schnuffi_worker.iterate_diff_rows, page by page
+
+        :param views: include the rows of the complete documents of the POS views
+        """
+        targets = (ADDED, MODIFIED, REMOVED, SWITCHES, LOOKS) + ((POS_OLD, POS_NEW) if views else tuple())
+        for target in targets:
+            offset = 0
+            while True:
+                self.cancel_token.check()
+                page = self.rows(target, offset, self.page_size)
+                for row in page:
+                    yield target, row
+
+                if len(page) < self.page_size:
+                    break
+                offset += self.page_size
+
+    def close(self):
+        self.store.close()
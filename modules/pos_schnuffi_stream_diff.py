@@ -0,0 +1,263 @@
+"""
+    Streaming diff of POS files with bounded memory.
+
+    Each document is streamed as (actionList name, sequence, actions) records. Records are
+    sorted by name in memory up to a budget and spilled to sorted run files beyond it. The
+    sorted runs of both documents are merged and joined to find added, removed and modified
+    actionLists without materializing either document.
+"""
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator
+
+import lxml.etree as Et
+
+from modules.pos_schnuffi_xml_diff import ActionList, PosDiff, PosXml
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.dictdiffer import DictDiffer
+from modules.utils.compressed_file import CompressedFile
+from modules.utils.globals import get_settings_dir
+from modules.utils.instrumentation import Timing
+from modules.utils.language import get_translation
+from modules.utils.log import init_logging
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class ExternalSorter:
+    """ Sort records by their first field, spilling sorted runs to disk above a memory budget """
+    # Rough per record and per field overhead of python objects in bytes
+    record_overhead = 200
+    field_overhead = 120
+
+    def __init__(self, tmp_dir: str, budget: int):
+        self.tmp_dir = tmp_dir
+        self.budget = budget
+        self._records = list()
+        self._size = 0
+        self._runs = list()
+
+    def add(self, record: tuple, size: int):
+        self._records.append(record)
+        self._size += size + self.record_overhead
+
+        if self._size >= self.budget:
+            self._spill()
+
+    def _spill(self):
+        self._records.sort(key=lambda r: (r[0], r[1]))
+
+        with tempfile.NamedTemporaryFile('wb', dir=self.tmp_dir, suffix='.run', delete=False) as f:
+            # One pickle per record, a shared Pickler would keep a reference to every record written
+            for record in self._records:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._runs.append(f.name)
+
+        LOGGER.debug('Spilled %s records to sorted run %s', len(self._records), f.name)
+        Timing.count('sorted_runs')
+        self._records, self._size = list(), 0
+
+    @staticmethod
+    def _read_run(file: str) -> Iterator[tuple]:
+        with open(file, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def sorted(self) -> Iterator[tuple]:
+        """ Merge of all runs and the records still in memory """
+        self._records.sort(key=lambda r: (r[0], r[1]))
+        if not self._runs:
+            return iter(self._records)
+
+        return heapq.merge(*[self._read_run(run) for run in self._runs], self._records,
+                           key=lambda r: (r[0], r[1]))
+
+
+class _StreamedDocument:
+    """ Sorted actionList and condition records and the actor value sets of one POS document """
+    def __init__(self, xml_file: Path, tmp_dir: str, budget: int):
+        self.xml_file = Path(xml_file)
+        self.action_lists = ExternalSorter(tmp_dir, budget)
+        self.conditions = ExternalSorter(tmp_dir, budget)
+        # Actor values are bounded by the number of distinct actors, not by document size
+        self.switches, self.looks, self.state_objects = dict(), dict(), dict()
+        self.missing_al, self.missing_co = list(), list()
+
+    def read(self, cancel_token=NO_CANCEL, progress=None):
+        actor_dicts = {'switch': self.switches, 'appearance': self.looks, 'stateObject': self.state_objects}
+        seq = 0
+
+        with CompressedFile.reader(self.xml_file, _('{} lesen').format(self.xml_file.name),
+                                   progress, cancel_token) as reader:
+            for _event, e in Et.iterparse(reader, events=('end', ), tag=('actionList', 'condition')):
+                parent = e.getparent()
+                # Only top level elements like PosXml: root/stateEngine/actionList
+                if parent is None or parent.getparent() is None or parent.getparent().getparent() is not None:
+                    continue
+
+                seq += 1
+                if e.tag == 'actionList' and e.get('name'):
+                    actions, size = dict(), len(e.get('name'))
+                    # Same order and last-wins rules as PosXml.add_action_list
+                    for actor, value, actor_type in PosXml.iterate_actors(e):
+                        actions[actor] = {'value': value, 'type': actor_type}
+                        actor_dicts[actor_type].setdefault(actor, set()).add(value)
+                        size += len(actor or '') + len(value or '') + ExternalSorter.field_overhead
+
+                    self.action_lists.add((e.get('name'), seq, actions), size)
+                elif e.tag == 'condition':
+                    condition_name = e.findtext('actionListName')
+                    if condition_name:
+                        self.conditions.add((condition_name, seq), len(condition_name))
+
+                # Release the element and it's already processed siblings
+                e.clear()
+                while e.getprevious() is not None:
+                    del parent[0]
+
+    def iterate_action_lists(self) -> Iterator[tuple]:
+        """ Yield (name, first_seq, actions) sorted by name. Like PosXml.xml_dict the last occurrence
+            of a duplicate actionList wins but it keeps the position of the first.
+        """
+        for name, records in groupby(self.action_lists.sorted(), key=lambda r: r[0]):
+            records = list(records)
+            yield name, records[0][1], records[-1][2]
+
+    def join_conditions(self, action_lists: Iterator[tuple]) -> Iterator[tuple]:
+        """ Pass through sorted action_lists while collecting actionLists without condition and vice versa """
+        conditions = groupby(self.conditions.sorted(), key=lambda r: r[0])
+        condition = next(conditions, None)
+        missing_al, missing_co = list(), list()
+
+        for record in action_lists:
+            name = record[0]
+            while condition is not None and condition[0] < name:
+                missing_al.append((next(condition[1])[1], condition[0]))
+                condition = next(conditions, None)
+
+            if condition is not None and condition[0] == name:
+                condition = next(conditions, None)
+            else:
+                missing_co.append((record[1], name))
+
+            yield record
+
+        while condition is not None:
+            missing_al.append((next(condition[1])[1], condition[0]))
+            condition = next(conditions, None)
+
+        # Report in document order like PosXml.check_conditions
+        self.missing_al = [name for _seq, name in sorted(missing_al)]
+        self.missing_co = [name for _seq, name in sorted(missing_co)]
+
+
+class StreamPosDiff(PosDiff):
+    """
+        PosDiff computed by a sorted merge join of two streamed documents.
+
+        Memory is bounded by [budget] bytes per sorter plus the differences found. The complete
+        documents are not kept, so new and old are empty and the POS views stay empty.
+    """
+    def __init__(self, new_xml_path, old_xml_path, cancel_token=NO_CANCEL, progress=None, budget: int=0):
+        self.no_difference = True
+        self.cancel_token = cancel_token
+        self.progress = progress
+        self.new_xml, self.old_xml = None, None
+        self.new, self.old = dict(), dict()
+        self._diff_total, self._diff_done = 0, 0
+
+        if not budget:
+            budget = self.default_budget()
+
+        with tempfile.TemporaryDirectory(prefix='PosSchnuffi_', dir=get_settings_dir() or None) as tmp_dir:
+            new_doc = _StreamedDocument(new_xml_path, tmp_dir, budget)
+            old_doc = _StreamedDocument(old_xml_path, tmp_dir, budget)
+
+            with Timing.span('parse'):
+                new_doc.read(cancel_token, progress)
+                old_doc.read(cancel_token, progress)
+
+            with Timing.span('diff'):
+                self.__merge_join(new_doc, old_doc)
+
+        self.error_num = 0
+        self.error_report = ''
+        for doc in (new_doc, old_doc):
+            self.error_report += f'<h4>{doc.xml_file.name}</h4>'
+            self.error_report += PosXml.condition_report(doc.missing_al, doc.missing_co)
+            self.error_num += len(doc.missing_al) + len(doc.missing_co)
+
+        self.add_switches, self.rem_switches, self.mod_switches = self.__diff_actors(new_doc.switches,
+                                                                                     old_doc.switches)
+        self.add_looks, self.rem_looks, self.mod_looks = self.__diff_actors(new_doc.looks, old_doc.looks)
+
+    @staticmethod
+    def default_budget() -> int:
+        """ Memory budget of each sorter in bytes """
+        return int(KnechtSettings.app.get('stream_memory_mb', 256)) * 1024 * 1024
+
+    def __merge_join(self, new_doc: _StreamedDocument, old_doc: _StreamedDocument):
+        self.added_action_ls, self.removed_action_ls, self.modified_action_ls = list(), list(), list()
+        # Rename detection would have to keep the content of all added and removed actionLists
+        self.renamed_action_ls = list()
+        label = _('actionLists vergleichen')
+
+        new_records = new_doc.join_conditions(new_doc.iterate_action_lists())
+        old_records = old_doc.join_conditions(old_doc.iterate_action_lists())
+        new_record, old_record = next(new_records, None), next(old_records, None)
+
+        while new_record is not None or old_record is not None:
+            self._diff_done += 1
+            if self._diff_done % 1000 == 0:
+                self.cancel_token.check()
+                if self.progress is not None:
+                    self.progress(label, self._diff_done, 0)
+
+            if old_record is None or (new_record is not None and new_record[0] < old_record[0]):
+                self.added_action_ls.append(self.__action_list(new_record[0], new_record[2], dict()))
+                new_record = next(new_records, None)
+            elif new_record is None or old_record[0] < new_record[0]:
+                self.removed_action_ls.append(self.__action_list(old_record[0], dict(), old_record[2]))
+                old_record = next(old_records, None)
+            else:
+                if new_record[2] != old_record[2]:
+                    self.modified_action_ls.append(self.__action_list(new_record[0], new_record[2], old_record[2]))
+                new_record, old_record = next(new_records, None), next(old_records, None)
+
+        if self.added_action_ls or self.removed_action_ls or self.modified_action_ls:
+            self.no_difference = False
+
+        Timing.count('action_lists_diffed', self._diff_done)
+
+    @staticmethod
+    def __action_list(name: str, new_action: dict, old_action: dict) -> ActionList:
+        """ Same as PosDiff for a single actionList """
+        al = ActionList(name)
+        diff = DictDiffer(new_action, old_action)
+
+        for changed_keys in [diff.added(), diff.changed(), diff.removed()]:
+            if changed_keys:
+                al.actors = (changed_keys, new_action, old_action)
+
+        return al
+
+    def __diff_actors(self, new_actor_dict, old_actor_dict):
+        actor_diff = DictDiffer(new_actor_dict, old_actor_dict)
+
+        added, removed, changed = actor_diff.added(), actor_diff.removed(), actor_diff.changed()
+        if added or removed or changed:
+            self.no_difference = False
+
+        return added, removed, changed
@@ -1,19 +1,22 @@
 import logging
+from collections import deque
 from pathlib import Path
 from queue import Queue
 
 from PySide2 import QtCore, QtWidgets
 from PySide2.QtGui import QBrush, QColor, QKeySequence
-from PySide2.QtWidgets import QGroupBox, QLineEdit, QUndoStack, QUndoGroup, QMenu
+from PySide2.QtWidgets import QAction, QActionGroup, QGroupBox, QLineEdit, QUndoStack, QUndoGroup, QMenu, QTreeWidgetItem
 
 from modules.filter_tree_widget import TreeWidgetFilter
 from modules.item_edit_undo import KnechtValueDelegate
-from modules.pos_schnuffi_compare import GuiCompare
-from modules.pos_schnuffi_export import ExportActionList
 from modules.utils.globals import Resource, UI_MAIN_WINDOW
-from modules.utils.gui_utils import SetupWidget, sort_widget
+from modules.utils.gui_utils import PredictProgressTime, SetupWidget, capture_tree_state, restore_tree_state, \
+    sort_widget
+from modules.utils.instrumentation import Timing
 from modules.utils.language import get_translation
 from modules.utils.log import init_logging
+from modules.utils.profiler import Profiler
+from modules.utils.settings import KnechtSettings
 from modules.utils.ui_overlay import InfoOverlay
 from modules.widgets import FileWindow
 
@@ -45,9 +48,22 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
 
         self.file_win = None
 
+        # Paths of the current compare
+        self.old_path, self.new_path = None, None
+        # Session edits applied once the views are populated
+        self.pending_edits = dict()
+        # Tab and tree states restored once the views are populated
+        self.pending_view_state = dict()
+
+        # -- Stage timing, enabled by env POS_SCHNUFFI_TIMING or settings --
+        if KnechtSettings.app.get('timing'):
+            Timing.enabled = True
+
         # -- Comparision thread --
         self.cmp_thread = QtCore.QThread(self)
         self.cmp_queue = Queue(-1)
+        # Cancelled threads are kept referenced until they returned from their next cancel check
+        self.cancelled_threads = list()
         
         # -- Timer --
         self.intro_timer = QtCore.QTimer()
@@ -59,15 +75,34 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
         self.item_worker.setInterval(15)
         self.remaining_items = 0
         self.item_chunk_size = 35
+        # Batch of (item, widget) taken from the compare queue
+        self.item_batch = deque()
+
+        # -- Parse/Diff progress --
+        self.item_progress_format = ''
+        self.progress_label = ''
+        self.progress_eta = None
         
-        self.export = ExportActionList(self, self)
+        # Export machinery is created on first use
+        self._export = None
+
+        # -- Watch mode --
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.watched_file_changed)
+        # Files are usually written in several steps, wait until they settle
+        self.watch_timer = QtCore.QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(1000)
+        self.watch_timer.timeout.connect(self.watched_files_settled)
+        # path: (mtime, size) seen when the change was reported
+        self.watched_stats = dict()
 
         self.info_overlay = InfoOverlay(self)
 
         self.undo_grp = QUndoGroup(self)
         self.widget_list = [self.AddedWidget, self.ModifiedWidget, self.RemovedWidget,
                             self.switchesWidget, self.looksWidget, self.posOldWidget,
-                            self.posNewWidget]
+                            self.posNewWidget, self.RenamedWidget]
         self.setup_widgets()
 
         # --- Create undo menu ---
@@ -81,8 +116,36 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
         self.undo_menu.addActions((self.undo, self.redo))
         self.menuBar().addMenu(self.undo_menu)
 
+        # --- Create extras menu ---
+        self.extras_menu = QMenu(_('Extras'), self)
+        self.profile_action = self.extras_menu.addAction(_('Profil von Vergleich und Export aufzeichnen'))
+        self.profile_action.setCheckable(True)
+        self.profile_action.setChecked(Profiler.enabled)
+        self.profile_action.toggled.connect(self.toggle_profiling)
+        # Compare backends, see modules.pos_schnuffi_compare.COMPARE_BACKENDS
+        self.backend_menu = self.extras_menu.addMenu(_('Vergleichsmodus'))
+        self.backend_group = QActionGroup(self)
+        self.backend_group.setExclusive(True)
+        current_backend = KnechtSettings.app.get('compare_backend') or 'thread'
+        for backend, text in (('thread', _('Standard')),
+                              ('process', _('In separatem Prozess ausführen')),
+                              ('sqlite', _('Große Dateien über SQLite Datenbank vergleichen')),
+                              ('stream', _('Große Dateien sortiert streamen (ohne POS Ansichten)')),
+                              ('daemon', _('Über lokalen Vergleichsdienst (schnuffi_cli.py daemon)'))):
+            action = self.backend_menu.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(backend == current_backend)
+            action.setData(backend)
+            self.backend_group.addAction(action)
+        self.backend_group.triggered.connect(self.set_compare_backend)
+        self.watch_action = self.extras_menu.addAction(_('POS Dateien überwachen und automatisch neu vergleichen'))
+        self.watch_action.setCheckable(True)
+        self.watch_action.setChecked(KnechtSettings.app.get('watch_mode', False))
+        self.watch_action.toggled.connect(self.toggle_watch_mode)
+        self.menuBar().addMenu(self.extras_menu)
+
         self.non_exportable_widgets = (self.switchesWidget, self.looksWidget, self.errorTextWidget,
-                                       self.AddedWidget, self.RemovedWidget)
+                                       self.AddedWidget, self.RemovedWidget, self.RenamedWidget)
 
         self.show()
 
@@ -95,12 +158,31 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
         self.item_worker.timeout.connect(self.add_widget_item)
 
         self.progressBar.hide()
+        self.item_progress_format = self.progressBar.format()
 
         # Menu
         self.actionOpen.triggered.connect(self.open_file_window)
+        self.open_session_action = QAction(_('Sitzung öffnen...'), self)
+        self.open_session_action.triggered.connect(self.open_session)
+        self.menuDatei.insertAction(self.actionBeenden, self.open_session_action)
+        self.save_session_action = QAction(_('Sitzung speichern...'), self)
+        self.save_session_action.triggered.connect(self.save_session)
+        self.menuDatei.insertAction(self.actionBeenden, self.save_session_action)
+        self.cancel_action = QAction(_('Vergleich abbrechen'), self)
+        self.cancel_action.triggered.connect(self.cancel_compare)
+        self.menuDatei.insertAction(self.actionBeenden, self.cancel_action)
+        self.cancel_export_action = QAction(_('Export abbrechen'), self)
+        self.cancel_export_action.triggered.connect(self.cancel_export)
+        self.cancel_export_action.setEnabled(False)
+        self.menuDatei.insertAction(self.actionBeenden, self.cancel_export_action)
         self.actionBeenden.triggered.connect(self.close)
-        self.actionExport.triggered.connect(self.export.export_selection)
-        self.actionExportPos.triggered.connect(self.export.export_updated_pos_xml)
+        self.actionExport.triggered.connect(self.export_selection)
+        self.actionExportPos.triggered.connect(self.export_updated_pos_xml)
+        self.report_action = QAction(_('Vergleichsbericht (XLSX, CSV, JSON) ...'), self)
+        self.report_action.setStatusTip(_('Exportiert alle geänderten actionLists und Actors mit alten und neuen '
+                                          'Werten als Tabelle.'))
+        self.report_action.triggered.connect(self.export_report)
+        self.menuExport.addAction(self.report_action)
 
         # File display
         self.file_name_box: QGroupBox
@@ -132,6 +214,134 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
         # Tab Changed
         self.widgetTabs.currentChanged.connect(self.tab_changed)
 
+    def toggle_profiling(self, enabled: bool):
+        Profiler.enabled = enabled
+
+        if enabled:
+            self.statusBar().showMessage(_('Profile werden im Einstellungsverzeichnis gespeichert.'), 8000)
+
+    @staticmethod
+    def set_compare_backend(action: QAction):
+        from modules.pos_schnuffi_preload import PosXmlPreloader
+
+        KnechtSettings.app['compare_backend'] = action.data()
+        if not PosXmlPreloader.enabled():
+            PosXmlPreloader.clear()
+
+    def toggle_watch_mode(self, enabled: bool):
+        KnechtSettings.app['watch_mode'] = enabled
+        self.update_watched_paths()
+
+    def update_watched_paths(self):
+        """ Watch the files of the current compare if watch mode is enabled """
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+
+        if not KnechtSettings.app.get('watch_mode', False) or self.old_path is None:
+            return
+
+        for path in (self.old_path, self.new_path):
+            if path.exists():
+                self.watcher.addPath(path.as_posix())
+
+    @staticmethod
+    def _file_stat(path: str):
+        try:
+            stat = Path(path).stat()
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def watched_file_changed(self, path: str):
+        LOGGER.debug('Watched POS file changed: %s', path)
+        # Files replaced by rename are dropped from the watcher
+        if path not in self.watcher.files() and Path(path).exists():
+            self.watcher.addPath(path)
+
+        self.watched_stats[path] = self._file_stat(path)
+        self.watch_timer.start()
+
+    def watched_files_settled(self):
+        from modules.pos_schnuffi_session import SchnuffiSession
+
+        for path, stat in self.watched_stats.items():
+            current_stat = self._file_stat(path)
+            if current_stat is None or current_stat != stat:
+                # Still being written or replaced
+                self.watched_stats[path] = current_stat
+                if Path(path).exists() and path not in self.watcher.files():
+                    self.watcher.addPath(path)
+                self.watch_timer.start()
+                return
+
+        if self.cmp_thread.isRunning() or self.remaining_items:
+            # Let the running compare finish, re-diff afterwards
+            self.watch_timer.start()
+            return
+
+        self.watched_stats = dict()
+        LOGGER.info('Watched POS files changed, comparing again.')
+
+        # Keep the users view on the data, the unchanged file is reused from the previous compare
+        view_state = {'tab': self.widgetTabs.currentIndex(),
+                      'trees': {widget.objectName(): capture_tree_state(widget) for widget in self.widget_list}}
+        diff = getattr(self.cmp_thread, 'diff', None)
+        self.compare(self.old_path, self.new_path, edits=SchnuffiSession.collect_edits(self.widget_list),
+                     incremental=getattr(self.cmp_thread, 'incremental', None),
+                     documents=(getattr(diff, 'new_xml', None), getattr(diff, 'old_xml', None)))
+        self.pending_view_state = view_state
+        self.statusBar().showMessage(_('POS Datei verändert. Vergleich wird aktualisiert...'), 8000)
+
+    @property
+    def export(self):
+        """ :rtype: modules.pos_schnuffi_export.ExportActionList """
+        if self._export is None:
+            from modules.pos_schnuffi_export import ExportActionList
+            self._export = ExportActionList(self, self)
+        return self._export
+
+    def export_selection(self):
+        self.export.export_selection()
+
+    def export_updated_pos_xml(self):
+        self.export.export_updated_pos_xml()
+
+    def export_report(self):
+        self.export.export_report()
+
+    def export_started(self, job):
+        """ Show progress of a background export job until it finished, failed or was cancelled """
+        job.signals.progress.connect(self.update_export_progress)
+        job.signals.finished.connect(self.export_job_done)
+        job.signals.failed.connect(self.export_job_failed)
+        job.signals.cancelled.connect(self.export_job_cancelled)
+
+        self.cancel_export_action.setEnabled(True)
+        self.statusBar().showMessage(_('Export wird erstellt...'))
+
+    def cancel_export(self):
+        if self._export is not None:
+            self._export.cancel()
+
+    def update_export_progress(self, label: str, done: int, total: int):
+        if total > 0:
+            self.statusBar().showMessage(f'{label} {done * 100 // total}%')
+        else:
+            self.statusBar().showMessage(label)
+
+    def export_job_done(self, result=None):
+        self.cancel_export_action.setEnabled(False)
+        self.statusBar().clearMessage()
+
+    def export_job_failed(self, error: str):
+        self.export_job_done()
+        LOGGER.error('Export failed: %s', error)
+        self.error_msg(_('Fehler beim Export: {}').format(error))
+
+    def export_job_cancelled(self):
+        self.export_job_done()
+        self.info_overlay.display(_('Export abgebrochen.'), 3000, True)
+
     def widget_with_focus(self):
         """ Return the current or last QTreeWidget in focus """
         return self.pos_app.tree_with_focus()
@@ -151,10 +361,12 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
                 self.menuExport.setEnabled(False)
 
     def closeEvent(self, close_event):
-        if self.cmp_thread:
-            self.cmp_thread.quit()
-            self.cmp_thread.wait(800)
-            
+        self.cancel_compare(show_message=False)
+        self.cancel_export()
+
+        for thread in self.cancelled_threads:
+            thread.wait(800)
+
         close_event.accept()
 
     def show_intro_msg(self):
@@ -176,8 +388,9 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
         self.info_overlay.display_confirm(error_str, (('[X]', None), ))
 
     def sort_all_headers(self, event=None):
-        for widget in self.widget_list:
-            sort_widget(widget)
+        with Timing.span('sort'):
+            for widget in self.widget_list:
+                sort_widget(widget)
 
     def expand_all_items(self):
         for widget in self.widget_list:
@@ -190,93 +403,291 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
     def open_file_window(self):
         self.file_win = FileWindow(self, self)
 
-    def compare(self):
-        self.clear_item_queue()
+    def compare(self, old_path=None, new_path=None, diff=None, edits: dict=None, incremental=None, documents=(),
+                file_hashes=None):
+        """ Compare the POS files chosen in the FileWindow or the provided paths
 
-        if self.cmp_thread is not None:
-            if self.cmp_thread.isRunning():
-                self.error_msg(_('POS Schnuffi Vergleichsthread läuft bereits.'))
-                return
+            :param diff: populate the views from this diff result instead of parsing the files
+            :param edits: user edits to restore once the views are populated
+            :param incremental: IncrementalDiff of the previous compare to update instead of a complete compare
+            :param documents: PosXml of the previous compare, reused for files that did not change since
+            :param file_hashes: (old, new) content hashes the provided diff was created from
+        """
+        # Compare and Xml machinery is imported on first compare
+        from modules.pos_schnuffi_compare import COMPARE_BACKENDS, GuiCompare
+
+        # A running compare is cancelled and it's results discarded
+        self.cancel_compare(show_message=False)
+        Timing.reset()
 
         for widget in self.widget_list:
             widget.clear()
             widget.hide()
 
-        self.cmp_thread = GuiCompare(self.file_win.old_file_dlg.path,
-                                     self.file_win.new_file_dlg.path,
-                                     self.widget_list,
-                                     self.cmp_queue)
+        compare_cls = COMPARE_BACKENDS.get(KnechtSettings.app.get('compare_backend'), GuiCompare)
+
+        if old_path is None or new_path is None:
+            old_path, new_path = self.file_win.old_file_dlg.path, self.file_win.new_file_dlg.path
+        self.old_path, self.new_path = Path(old_path), Path(new_path)
+        self.pending_edits = edits or dict()
+        self.pending_view_state = dict()
+        self.update_watched_paths()
 
-        self.cmp_thread.add_item.connect(self.request_item_add)
+        # Every compare gets it's own queue, cancelled threads may still put items into theirs
+        self.cmp_queue = Queue(-1)
+        self.cmp_thread = compare_cls(self.old_path,
+                                      self.new_path,
+                                      self.widget_list,
+                                      self.cmp_queue,
+                                      diff,
+                                      incremental,
+                                      documents,
+                                      file_hashes)
+
+        self.cmp_thread.add_items.connect(self.request_items_add)
         self.cmp_thread.no_difference.connect(self.no_difference_msg)
         self.cmp_thread.finished.connect(self.finished_compare)
         self.cmp_thread.error_report.connect(self.add_error_report)
+        self.cmp_thread.progress.connect(self.update_compare_progress)
 
         # Prepare add item worker
         self.item_worker.stop()
         self.remaining_items = 0
         self.progressBar.setMaximum(0)
         self.progressBar.setValue(0)
+        self.progressBar.setFormat(self.item_progress_format)
+        self.progressBar.show()
+        self.progress_label, self.progress_eta = '', None
 
         self.cmp_thread.start()
         self.statusBar().showMessage(_('POS Daten werden geladen und verglichen...'), 8000)
 
+    def cancel_compare(self, show_message: bool=True):
+        """ Cancel a running compare thread and discard all items not yet added to the views """
+        self.cancelled_threads = [t for t in self.cancelled_threads if t.isRunning()]
+        thread_running = hasattr(self.cmp_thread, 'cancel') and self.cmp_thread.isRunning()
+
+        if not thread_running and not self.item_worker.isActive():
+            return
+
+        if thread_running:
+            self.cmp_thread.cancel()
+            self.cancelled_threads.append(self.cmp_thread)
+
+        self.item_worker.stop()
+        self.clear_item_queue()
+        self.remaining_items = 0
+        self.progressBar.hide()
+
+        if not show_message:
+            return
+
+        for widget in self.widget_list:
+            widget.clear()
+            widget.show()
+
+        self.statusBar().showMessage(_('POS Vergleich abgebrochen.'), 8000)
+        self.info_overlay.display(_('POS Vergleich abgebrochen.'), 3000, True)
+
+    def _from_current_compare(self) -> bool:
+        """ Signals of cancelled compare threads may still be queued, they are ignored """
+        sender = self.sender()
+        return sender is None or sender is self.cmp_thread
+
     def finished_compare(self):
+        if not self._from_current_compare():
+            return
+
         self.sort_all_headers()
         self.statusBar().showMessage(_('POS Daten laden und vergleichen abgeschlossen. Bäume werden befüllt.'), 8000)
 
-        self.old_file_label.setText(Path(self.file_win.old_file_dlg.path).name)
-        self.new_file_label.setText(Path(self.file_win.new_file_dlg.path).name)
+        self.old_file_label.setText(self.old_path.name)
+        self.new_file_label.setText(self.new_path.name)
 
     def _item_worker_finished(self):
         for widget in self.widget_list:
             widget.show()
 
+        # Restore once all items are added, no_difference_msg may arrive earlier
+        if self.pending_edits and not self.remaining_items:
+            from modules.pos_schnuffi_session import SchnuffiSession
+            restored = SchnuffiSession.apply_edits(self.widget_list, self.pending_edits)
+            self.pending_edits = dict()
+            self.statusBar().showMessage(_('{} bearbeitete Action Listen wiederhergestellt.').format(restored), 8000)
+
+        if self.pending_view_state and not self.remaining_items:
+            self.restore_view_state(self.pending_view_state)
+            self.pending_view_state = dict()
+
         # self.widgetTabs.setCurrentIndex(0)
 
         # self.info_overlay.display_exit()
         self.info_overlay.display(_('POS Daten laden und vergleichen abgeschlossen.'), 5000, True)
+        self.report_timing()
+
+    def restore_view_state(self, view_state: dict):
+        for widget in self.widget_list:
+            restore_tree_state(widget, view_state['trees'].get(widget.objectName()))
+
+        if self.widgetTabs.currentIndex() != view_state['tab']:
+            self.widgetTabs.setCurrentIndex(view_state['tab'])
+        else:
+            # Re-apply the filter to the re-populated trees
+            self.tab_changed(view_state['tab'])
+
+    def save_session(self):
+        from modules.pos_schnuffi_session import SchnuffiSession
+
+        # Every compare backend keeps it's result as PosDiff, there is nothing to save without one
+        diff = getattr(self.cmp_thread, 'diff', None)
+        if self.old_path is None or self.cmp_thread.isRunning() or self.remaining_items \
+                or not hasattr(diff, 'to_state'):
+            self.info_overlay.display(_('Kein abgeschlossener Vergleich zum Speichern vorhanden.'), 3000)
+            return
+
+        file, _file_type = QtWidgets.QFileDialog.getSaveFileName(
+            self, _('Sitzung speichern'), KnechtSettings.app.get('current_path') or '', SchnuffiSession.file_filter)
+        if not file:
+            return
+
+        file = Path(file).with_suffix(SchnuffiSession.suffix)
+        KnechtSettings.app['current_path'] = file.parent.as_posix()
+
+        try:
+            # Hashed by the compare thread, files are not read on the GUI thread
+            old_hash, new_hash = self.cmp_thread.file_hashes or ('', '')
+            session = SchnuffiSession(self.old_path, self.new_path, diff,
+                                      SchnuffiSession.collect_edits(self.widget_list), old_hash, new_hash)
+            session.save(file)
+        except Exception as e:
+            LOGGER.error('Could not save session: %s', e)
+            self.error_msg(_('Sitzung konnte nicht gespeichert werden:<br>{}').format(e))
+            return
+
+        self.statusBar().showMessage(_('Sitzung gespeichert: {}').format(file.as_posix()), 8000)
+
+    def open_session(self):
+        from modules.pos_schnuffi_session import SchnuffiSession
+
+        file, _file_type = QtWidgets.QFileDialog.getOpenFileName(
+            self, _('Sitzung öffnen'), KnechtSettings.app.get('current_path') or '', SchnuffiSession.file_filter)
+        if not file:
+            return
+
+        file = Path(file)
+        KnechtSettings.app['current_path'] = file.parent.as_posix()
+
+        try:
+            session = SchnuffiSession.load(file)
+        except Exception as e:
+            LOGGER.error('Could not load session: %s', e)
+            self.error_msg(_('Sitzung konnte nicht geladen werden:<br>{}').format(e))
+            return
+
+        if session.hashes_match():
+            self.compare(session.old_path, session.new_path, session.diff, session.edits,
+                         file_hashes=(session.old_hash, session.new_hash))
+            return
+
+        if session.old_path.exists() and session.new_path.exists():
+            # Source files changed since the session was saved, compare again and re-apply the edits
+            self.compare(session.old_path, session.new_path, edits=session.edits)
+            self.info_overlay.display(_('POS Dateien wurden seit dem Speichern der Sitzung verändert und werden '
+                                        'neu verglichen.'), 5000)
+            return
+
+        # Source files are gone, show the stored result. Exports need the source files.
+        self.compare(session.old_path, session.new_path, session.diff, session.edits,
+                     file_hashes=(session.old_hash, session.new_hash))
+        self.info_overlay.display(_('POS Dateien der Sitzung nicht gefunden. Export ist nicht möglich.'), 5000)
+
+    def report_timing(self):
+        if not Timing.enabled:
+            return
+
+        Timing.log_record('compare')
+        self.statusBar().showMessage(Timing.summary(), 30000)
 
     def no_difference_msg(self):
+        if not self._from_current_compare():
+            return
+
         self.info_overlay.display_confirm(_('Keine Unterschiede gefunden.'), (('[X]', None),))
         self.statusBar().showMessage(_('POS Daten laden und vergleichen abgeschlossen. Keine Unterschiede gefunden.')
                                      , 8000)
         self._item_worker_finished()
 
-    def request_item_add(self):
-        self.remaining_items += 1
-        self.progressBar.setMaximum(max(self.remaining_items, self.progressBar.maximum()))
+    def update_compare_progress(self, label: str, done: int, total: int):
+        """ Receives throttled parse progress in bytes and diff progress in actionLists """
+        if not self._from_current_compare() or self.remaining_items or total <= 0:
+            return
 
-        if not self.item_worker.isActive():
-            self.item_worker.start()
-            self.progressBar.show()
+        if label != self.progress_label:
+            self.progress_label = label
+            self.progress_eta = PredictProgressTime(total)
+
+        # QProgressBar is limited to int range, scale large byte counts to KiB
+        scale = 1024 if total > 0x7fffffff else 1
+        self.progressBar.setMaximum(total // scale)
+        self.progressBar.setValue(done // scale)
+        self.progressBar.setFormat(f'{label} %p% - {self.progress_eta.update_to(done)}')
+
+    def request_items_add(self, item_count: int):
+        """ Receives one signal per batch of items put into the compare queue """
+        if not self._from_current_compare():
+            return
+
+        with Timing.span('deliver'):
+            Timing.count('deliveries')
+            if not self.remaining_items and self.progressBar.format() != self.item_progress_format:
+                # Switch from parse progress to item progress
+                self.progressBar.setFormat(self.item_progress_format)
+                self.progressBar.setMaximum(0)
+                self.progressBar.setValue(0)
+
+            self.remaining_items += item_count
+            self.progressBar.setMaximum(max(self.remaining_items, self.progressBar.maximum()))
+
+            if not self.item_worker.isActive():
+                self.item_worker.start()
+                self.progressBar.show()
 
     def add_widget_item(self):
         if not self.remaining_items:
             self.item_worker.stop()
             self.progressBar.hide()
             self._item_worker_finished()
+            Profiler.dump('add_widget_item')
 
             return
 
         count = 0
 
-        while self.remaining_items:
-            item, target_widget = self.cmp_queue.get()
-            self.color_items(item)
-            target_widget.addTopLevelItem(item)
+        with Timing.span('insert'), Profiler.tick('add_widget_item'):
+            while self.remaining_items:
+                if not self.item_batch:
+                    self.item_batch = deque(self.cmp_queue.get())
+                    self.cmp_queue.task_done()
 
-            self.remaining_items -= 1
-            self.cmp_queue.task_done()
+                item, target_widget = self.item_batch.popleft()
+                if not isinstance(item, QTreeWidgetItem):
+                    # Plain row from the compare process
+                    item = self.cmp_thread.create_item(item)
+                self.color_items(item)
+                target_widget.addTopLevelItem(item)
 
-            count += 1
+                self.remaining_items -= 1
+                count += 1
 
-            self.progressBar.setValue(self.progressBar.value() + 1)
+                self.progressBar.setValue(self.progressBar.value() + 1)
 
-            if count >= self.item_chunk_size:
-                break
+                if count >= self.item_chunk_size:
+                    break
 
     def add_error_report(self, error_report, error_num):
+        if not self._from_current_compare():
+            return
+
         # Reset error tab name
         widget_idx = self.widgetTabs.indexOf(self.errorsTab)
         self.widgetTabs.setTabText(widget_idx, _('Error'))
@@ -310,12 +721,14 @@ class SchnuffiWindow(QtWidgets.QMainWindow):
                     item.setForeground(c, QBrush(QColor(90, 140, 90)))
 
     def clear_item_queue(self):
+        self.item_batch.clear()
+
         if self.cmp_queue.qsize():
-            LOGGER.debug('Clearing %s items from the queue.', self.cmp_queue.qsize())
+            LOGGER.debug('Clearing %s item batches from the queue.', self.cmp_queue.qsize())
 
         while not self.cmp_queue.empty():
             try:
-                _, _ = self.cmp_queue.get()
+                self.cmp_queue.get()
             except Exception as e:
                 LOGGER.error('Error clearing queue %s', e)
 
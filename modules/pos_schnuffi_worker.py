@@ -0,0 +1,177 @@
+"""
+    Plain python view rows of a PosDiff and the compare process entry point.
+
+    A row is a tuple (columns, children) of display texts, eg.:
+        (('actionList_name',), (('actor', 'value', 'old_value', 'switch'), ...))
+
+    Rows are picklable and are send in batches from the compare process to the GUI process.
+"""
+from pathlib import Path
+
+from modules.pos_schnuffi_diff_cache import DiffCache
+from modules.pos_schnuffi_xml_diff import PosDiff, PosXml
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.log import init_logging
+from modules.utils.progress import ThrottledProgress
+
+LOGGER = init_logging(__name__)
+
+# View targets, index into SchnuffiWindow.widget_list
+ADDED, MODIFIED, REMOVED, SWITCHES, LOOKS, POS_OLD, POS_NEW, RENAMED = range(8)
+
+
+def action_list_row(al) -> tuple:
+    """ Row of a diffed modules.pos_schnuffi_xml_diff.ActionList """
+    children = list()
+
+    for actor, a in al.actors.items():
+        children.append((actor or '', a.get('new_value') or '', a.get('old_value') or '', a.get('type') or ''))
+
+    return (al.name, ), tuple(children)
+
+
+def renamed_action_list_row(al) -> tuple:
+    """ Row of a modules.pos_schnuffi_xml_diff.RenamedActionList, children are the changes to the old list """
+    children = action_list_row(al)[1]
+    return (al.name, al.old_name or '', f'{al.similarity:.0%}'), children
+
+
+def pos_action_list_row(al_name: str, al_dict: dict) -> tuple:
+    """ Row of a actionList in a complete POS document """
+    children = tuple(
+        (actor_name, actor_dict.get('value'), actor_dict.get('type')) for actor_name, actor_dict in al_dict.items()
+        )
+    return (al_name, ), children
+
+
+def actor_rows(add_set, rem_set, mod_set) -> list:
+    """ Rows of added, removed and modified switch or look actors """
+    add_text = f'{len(add_set):03d} Actors - hinzugefügt(kommen -nur- in neuer Xml vor)'
+    rem_text = f'{len(rem_set):03d} Actors - entfernt(in neuer Xml nicht mehr verwendet)'
+    mod_text = f'{len(mod_set):03d} Actors - geändert(Häufigkeit der Verwendung oder Werte verändert)'
+
+    rows = list()
+    for actor_set, parent_text in zip((add_set, rem_set, mod_set), (add_text, rem_text, mod_text)):
+        if not actor_set:
+            continue
+        rows.append(((f'{len(rows)} - {parent_text}', ), tuple((actor, ) for actor in actor_set)))
+
+    return rows
+
+
+def iterate_diff_rows(diff: PosDiff):
+    """ Yield (target, row) for every top level view item in the order views get populated """
+    for target, action_lists in ((ADDED, diff.added_action_ls),
+                                 (MODIFIED, diff.modified_action_ls),
+                                 (REMOVED, diff.removed_action_ls)):
+        for al in action_lists:
+            yield target, action_list_row(al)
+
+    for al in diff.renamed_action_ls:
+        yield RENAMED, renamed_action_list_row(al)
+
+    for row in actor_rows(diff.add_switches, diff.rem_switches, diff.mod_switches):
+        yield SWITCHES, row
+    for row in actor_rows(diff.add_looks, diff.rem_looks, diff.mod_looks):
+        yield LOOKS, row
+
+    for target, xml_dict in ((POS_OLD, diff.old), (POS_NEW, diff.new)):
+        for al_name, al_dict in xml_dict.items():
+            if al_dict:
+                yield target, pos_action_list_row(al_name, al_dict)
+
+
+def _current_document(path, documents):
+    """ PosXml of [path] in [documents] which still matches the file or the path itself """
+    for pos_xml in documents:
+        if pos_xml is not None and pos_xml.xml_file.resolve() == Path(path).resolve() and pos_xml.is_current():
+            return pos_xml
+    return path
+
+
+def load_or_create_diff(new_path, old_path, cancel_token=NO_CANCEL, progress=None, preload: bool=False,
+                        documents=()):
+    """
+        Load the diff of both files from the DiffCache or parse and diff them. Hashing and parsing
+        map the files only while they read them, no mapping is held during the diff.
+
+        :param documents: PosXml of a previous compare, used instead of parsing files that did not change since
+
+        :returns: tuple (diff, cache_key) - cache_key is set if the diff is new and should be saved
+                  with DiffCache.save once the views are populated
+    """
+    cache_key = None
+    if DiffCache.enabled():
+        try:
+            cache_key = DiffCache.key(new_path, old_path, cancel_token, progress)
+        except OSError as e:
+            LOGGER.error('Can not hash POS files for the diff cache: %s', e)
+
+        if cache_key is not None:
+            diff = DiffCache.load(cache_key)
+            if diff is not None:
+                return diff, None
+
+    new_xml, old_xml = _current_document(new_path, documents), _current_document(old_path, documents)
+
+    if preload:
+        # Pick up finished or in-flight background parses, parse both files concurrently otherwise
+        from modules.pos_schnuffi_preload import PosXmlPreloader
+        parse_new, parse_old = not isinstance(new_xml, PosXml), not isinstance(old_xml, PosXml)
+        if parse_new:
+            PosXmlPreloader.preload(new_path)
+        if parse_old:
+            PosXmlPreloader.preload(old_path)
+        if parse_new:
+            new_xml = PosXmlPreloader.get(new_path, cancel_token, progress)
+        if parse_old:
+            old_xml = PosXmlPreloader.get(old_path, cancel_token, progress)
+
+    return PosDiff(new_xml, old_xml, cancel_token, progress), cache_key
+
+
+def compare_process(old_path, new_path, conn, batch_size: int=500):
+    """
+        Entry point of the compare process. Parses and diffs the POS files and sends
+        messages to the connection:
+            ('progress', label, done, total)
+            ('rows', target, [row, ...])
+            ('error_report', report, error_num)
+            ('diff', state) - PosDiff.to_state of the result
+            ('file_hashes', old_hash, new_hash) - DiffCache.file_hash of both files
+            ('finished', no_difference)
+            ('error', message)
+    """
+    def send_progress(label: str, done: int, total: int):
+        conn.send(('progress', label, done, total))
+
+    try:
+        progress = ThrottledProgress(send_progress)
+        # Hashed before the diff, the DiffCache remembers the hashes for the cache key
+        file_hashes = DiffCache.file_hash(old_path, progress=progress), DiffCache.file_hash(new_path, progress=progress)
+        diff, cache_key = load_or_create_diff(new_path, old_path, progress=progress)
+        conn.send(('error_report', diff.error_report, diff.error_num))
+
+        batch, batch_target = list(), None
+        for target, row in iterate_diff_rows(diff):
+            if batch and (target != batch_target or len(batch) >= batch_size):
+                conn.send(('rows', batch_target, batch))
+                batch = list()
+
+            batch_target = target
+            batch.append(row)
+
+        if batch:
+            conn.send(('rows', batch_target, batch))
+
+        conn.send(('diff', diff.to_state()))
+        conn.send(('file_hashes', *file_hashes))
+        conn.send(('finished', diff.no_difference))
+
+        if cache_key is not None:
+            DiffCache.save(diff, cache_key)
+    except Exception as e:
+        LOGGER.error('Compare process failed: %s', e)
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
@@ -1,13 +1,20 @@
+from copy import deepcopy
 from pathlib import Path
-from typing import Union
+from typing import Iterator, List, Tuple, Union
 
 import lxml.etree as Et
 
 from modules.pos_schnuffi_msg import Msg
+from modules.pos_schnuffi_rename import RenameDetector
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.compressed_file import CompressedFile
 from modules.utils.dictdiffer import DictDiffer
 from modules.utils.gui_utils import XmlHelper
+from modules.utils.instrumentation import Timing
 from modules.utils.language import get_translation
 from modules.utils.log import init_logging
+from modules.utils.mapped_file import MappedFile, fromstring
+from modules.utils.settings import KnechtSettings
 
 # translate strings
 lang = get_translation()
@@ -18,28 +25,51 @@ LOGGER = init_logging(__name__)
 
 
 class PosDiff:
-    def __init__(self, new_xml_path, old_xml_path):
+    def __init__(self, new_xml_path, old_xml_path, cancel_token=NO_CANCEL, progress=None):
+        """ Diff two POS Xml files
+
+        :param new_xml_path: path to the new POS Xml or an already parsed PosXml
+        :param old_xml_path: path to the old POS Xml or an already parsed PosXml
+        :param modules.utils.cancel.CancelToken cancel_token: raises CancelledError when cancelled
+        :param callable progress: optional progress(label: str, done: int, total: int) receiving
+                                  bytes parsed per file and number of actionLists diffed
+        """
         self.no_difference = True
+        self.cancel_token = cancel_token
+        self.progress = progress
+
+        self.new_xml = self._get_pos_xml(new_xml_path)
+        self.old_xml = self._get_pos_xml(old_xml_path)
 
-        self.new_xml = PosXml(new_xml_path)
-        self.old_xml = PosXml(old_xml_path)
+        self._diff_total, self._diff_done = 0, 0
 
         self.new = self.new_xml.xml_dict
         self.old = self.old_xml.xml_dict
 
-        # Create actionList's difference
-        action_diff = DictDiffer(self.new, self.old)
+        with Timing.span('diff'):
+            # Create actionList's difference
+            action_diff = DictDiffer(self.new, self.old)
+            added, removed, changed = action_diff.added(), action_diff.removed(), action_diff.changed()
+            self._diff_total = len(added) + len(removed) + len(changed)
+
+            # Newly added actionList's
+            self.added_action_ls = self.__create_diff_action_lists(added)
+            # Removed actionList's
+            self.removed_action_ls = self.__create_diff_action_lists(removed)
+            # Modified actionList's
+            self.modified_action_ls = self.__create_diff_action_lists(changed)
+            # Removed and added actionList's with the same or similar content
+            self.renamed_action_ls = list()
+            self.__detect_renames()
 
-        # Newly added actionList's
-        self.added_action_ls = self.__create_diff_action_lists(action_diff.added())
-        # Removed actionList's
-        self.removed_action_ls = self.__create_diff_action_lists(action_diff.removed())
-        # Modified actionList's
-        self.modified_action_ls = self.__create_diff_action_lists(action_diff.changed())
+            self.__diff_documents()
 
-        # Error report
+        Timing.count('action_lists_diffed', len(self.new) + len(self.old))
+
+    def __diff_documents(self):
+        """ Error report, switch and look differences of both documents """
         self.error_num = 0
-        self.error_report = self.__create_error_report(new_xml_path, old_xml_path)
+        self.error_report = self.__create_error_report(self.new_xml.xml_file, self.old_xml.xml_file)
 
         # Newly added switches, removed switches, modified switches
         self.add_switches, self.rem_switches, self.mod_switches = \
@@ -51,23 +81,123 @@ class PosDiff:
         action_lists = list()
 
         for als in action_list_keys:
-            al = ActionList(als)
-            new_action = self.new.get(als) or dict()
-            old_action = self.old.get(als) or dict()
-
-            diff = DictDiffer(new_action, old_action)
-
-            for changed_keys in [diff.added(), diff.changed(), diff.removed()]:
-                if changed_keys:
-                    al.actors = (changed_keys, new_action, old_action)
-
-            action_lists.append(al)
+            self.cancel_token.check()
+            self._report_diff_progress()
+            action_lists.append(self.__create_diff_action_list(als))
 
         if action_lists:
             self.no_difference = False
 
         return action_lists
 
+    def __create_diff_action_list(self, als):
+        return self.__diff_action_list(ActionList(als), self.new.get(als) or dict(), self.old.get(als) or dict())
+
+    @staticmethod
+    def __diff_action_list(al, new_action: dict, old_action: dict):
+        diff = DictDiffer(new_action, old_action)
+
+        for changed_keys in [diff.added(), diff.changed(), diff.removed()]:
+            if changed_keys:
+                al.actors = (changed_keys, new_action, old_action)
+
+        return al
+
+    def __detect_renames(self):
+        """ Move removed and added actionLists with the same or similar content to renamed_action_ls """
+        if not self.removed_action_ls or not self.added_action_ls or not RenameDetector.enabled():
+            return
+
+        pairs = RenameDetector.detect([al.name for al in self.removed_action_ls],
+                                      [al.name for al in self.added_action_ls], self.old, self.new, self.cancel_token)
+        if not pairs:
+            return
+
+        old_names, new_names = {p[0] for p in pairs}, {p[1] for p in pairs}
+        self.removed_action_ls = [al for al in self.removed_action_ls if al.name not in old_names]
+        self.added_action_ls = [al for al in self.added_action_ls if al.name not in new_names]
+
+        for old_name, new_name, similarity in pairs:
+            al = RenamedActionList(new_name, old_name, similarity)
+            self.renamed_action_ls.append(
+                self.__diff_action_list(al, self.new.get(new_name) or dict(), self.old.get(old_name) or dict()))
+
+        Timing.count('action_lists_renamed', len(pairs))
+
+    def patch(self, action_list_names: set):
+        """ Update the result after the actionLists [action_list_names] changed in
+            new_xml or old_xml eg. by modules.pos_schnuffi_incremental.IncrementalDiff
+        """
+        # Renames are detected again from all removed and added actionLists
+        for al in self.renamed_action_ls:
+            self.added_action_ls.append(self.__create_diff_action_list(al.name))
+            self.removed_action_ls.append(self.__create_diff_action_list(al.old_name))
+        self.renamed_action_ls = list()
+
+        self.added_action_ls = [al for al in self.added_action_ls if al.name not in action_list_names]
+        self.removed_action_ls = [al for al in self.removed_action_ls if al.name not in action_list_names]
+        self.modified_action_ls = [al for al in self.modified_action_ls if al.name not in action_list_names]
+
+        for als in action_list_names:
+            self.cancel_token.check()
+            in_new, in_old = als in self.new, als in self.old
+
+            if in_new and not in_old:
+                self.added_action_ls.append(self.__create_diff_action_list(als))
+            elif in_old and not in_new:
+                self.removed_action_ls.append(self.__create_diff_action_list(als))
+            elif in_new and in_old and self.new[als] != self.old[als]:
+                self.modified_action_ls.append(self.__create_diff_action_list(als))
+
+        self.__detect_renames()
+        self.no_difference = not (self.added_action_ls or self.removed_action_ls or self.modified_action_ls or
+                                  self.renamed_action_ls)
+        self.__diff_documents()
+
+    def to_state(self) -> dict:
+        """ Return the diff result as plain python data eg. for caching or sessions """
+        return {
+            'added': [al.to_state() for al in self.added_action_ls],
+            'modified': [al.to_state() for al in self.modified_action_ls],
+            'removed': [al.to_state() for al in self.removed_action_ls],
+            'renamed': [al.to_state() for al in self.renamed_action_ls],
+            'error_report': self.error_report, 'error_num': self.error_num,
+            'switches': (self.add_switches, self.rem_switches, self.mod_switches),
+            'looks': (self.add_looks, self.rem_looks, self.mod_looks),
+            'no_difference': self.no_difference,
+            'new': self.new, 'old': self.old,
+            }
+
+    @classmethod
+    def from_state(cls, state: dict):
+        """ Restore a diff result created by to_state without parsing the POS files """
+        diff = cls.__new__(cls)
+        diff.cancel_token, diff.progress = NO_CANCEL, None
+        diff.new_xml, diff.old_xml = None, None
+        diff._diff_total, diff._diff_done = 0, 0
+
+        diff.added_action_ls = [ActionList.from_state(al) for al in state['added']]
+        diff.modified_action_ls = [ActionList.from_state(al) for al in state['modified']]
+        diff.removed_action_ls = [ActionList.from_state(al) for al in state['removed']]
+        diff.renamed_action_ls = [RenamedActionList.from_state(al) for al in state.get('renamed', ())]
+        diff.error_report, diff.error_num = state['error_report'], state['error_num']
+        diff.add_switches, diff.rem_switches, diff.mod_switches = state['switches']
+        diff.add_looks, diff.rem_looks, diff.mod_looks = state['looks']
+        diff.no_difference = state['no_difference']
+        diff.new, diff.old = state['new'], state['old']
+
+        return diff
+
+    def _get_pos_xml(self, xml_path):
+        if isinstance(xml_path, PosXml):
+            return xml_path
+        return PosXml(xml_path, self.cancel_token, self.progress, parallel=True, lean=True)
+
+    def _report_diff_progress(self):
+        self._diff_done += 1
+        if self.progress is not None:
+            self.progress(_('actionLists vergleichen'), self._diff_done, self._diff_total)
+
     def __create_error_report(self, new_xml_path, old_xml_path, report: str=''):
         for xml, file_path in zip([self.new_xml, self.old_xml], [new_xml_path, old_xml_path]):
             report += f'<h4>{Path(file_path).name}</h4>'
@@ -91,9 +221,100 @@ class PosDiff:
         return added, removed, changed
 
 
+class PosXmlChangedError(Exception):
+    """ The POS file changed since it's data was extracted, it's element tree can not be reloaded """
+    pass
+
+
 class PosXml(object):
-    def __init__(self, xml_file):
-        self.xml_tree = None
+    feed_size = 1024 * 1024
+    export_dom = {'root': 'stateMachine', 'sub_lvl_1': 'stateEngine'}
+    # Action types kept as actors, an actor used with several types keeps the last one
+    actor_types = ('switch', 'appearance', 'stateObject')
+
+    def __init__(self, xml_file, cancel_token=NO_CANCEL, progress=None, parallel: bool=False, lean: bool=False):
+        """ Parse a POS Xml file
+
+        :param parallel: parse large files in chunks in a process pool, the element tree is not kept
+        :param lean: the caller only needs the extracted data, release the element tree in lean mode
+        """
+        self.cancel_token = cancel_token
+        self.progress = progress
+        self._init_data(xml_file)
+
+        # Load the Xml content into a dictionary
+        with Timing.span('parse'):
+            self._stat = self.__file_stat()
+            if not parallel or not self.__load_parallel():
+                self.__load()
+
+        # Set after parsing, a failed parallel parse resets the data
+        self._lean = lean and self.lean_enabled()
+        if self._lean:
+            self.release_tree()
+
+    @staticmethod
+    def lean_enabled() -> bool:
+        return KnechtSettings.app.get('lean_mode', True)
+
+    @property
+    def xml_tree(self) -> Union[None, Et._ElementTree]:
+        """ The element tree of the document, parsed again if it was released or never kept. Lean
+            documents do not keep the reloaded tree, fetch it once per use.
+
+            :raises PosXmlChangedError: if the file changed since it's data was extracted
+        """
+        if self._xml_tree is not None or not self.xml_file.exists():
+            return self._xml_tree
+
+        if self._stat is not None and not self.is_current():
+            raise PosXmlChangedError(f'{self.xml_file.name} changed since it was compared, compare the files again.')
+
+        LOGGER.debug('Reloading released element tree of %s', self.xml_file.name)
+        xml_tree = self.__parse_tree(None, NO_CANCEL)
+        if not self._lean:
+            self._xml_tree = xml_tree
+
+        return xml_tree
+
+    @xml_tree.setter
+    def xml_tree(self, value: Union[None, Et._ElementTree]):
+        self._xml_tree = value
+
+    def release_tree(self):
+        """ Drop the element tree, the extracted data is kept and the tree reloaded on access """
+        self._xml_tree = None
+
+    def is_current(self) -> bool:
+        """ The extracted data matches the file, it did not change since it was parsed """
+        try:
+            return self._stat is not None and self._stat == self.__file_stat()
+        except OSError:
+            return False
+
+    def data_updated(self):
+        """ The extracted data was updated to the current file content eg. by an incremental diff """
+        self._stat = self.__file_stat()
+        self.release_tree()
+
+    @classmethod
+    def from_elements(cls, xml_file, parent: Et._Element):
+        """ Create from the actionList and condition children of [parent] eg. a chunk of a document """
+        pos_xml = cls.__new__(cls)
+        pos_xml.cancel_token, pos_xml.progress = NO_CANCEL, None
+        pos_xml._init_data(xml_file)
+
+        for e in parent.iterfind('actionList'):
+            pos_xml.add_action_list(e)
+        for e in parent.iterfind('condition'):
+            pos_xml.add_condition(e)
+
+        return pos_xml
+
+    def _init_data(self, xml_file):
+        self._xml_tree = None
+        self._stat = None
+        self._lean = False
         self.xml_dict = dict()
         self.switches = dict()
         self.looks = dict()
@@ -105,58 +326,180 @@ class PosXml(object):
         self.missing_al = list()
         self.missing_co = list()
 
-        # Load the Xml content into a dictionary
-        self.__load()
+    def __load_parallel(self) -> bool:
+        from modules.pos_schnuffi_parallel_parse import ParallelPosParser
+        return ParallelPosParser.load(self)
+
+    def merge(self, chunk):
+        """ Merge the data of a PosXml [chunk] following this document """
+        for name, al_dict in chunk.xml_dict.items():
+            self.xml_dict[name] = al_dict
+
+        for actor_dict, chunk_actor_dict in ((self.switches, chunk.switches), (self.looks, chunk.looks),
+                                             (self.state_objects, chunk.state_objects)):
+            for actor, values in chunk_actor_dict.items():
+                if actor not in actor_dict:
+                    actor_dict[actor] = set()
+                actor_dict[actor].update(values)
+
+        for name, state_objects in chunk.conditions.items():
+            self.conditions[name] = state_objects
 
     def __load(self):
         """
         Parse the Xml file and store items in xml_dict:
             actionList[name]: {actor.text: {value: value.text, type: type.text}}
         """
-        self.xml_tree = Et.parse(self.xml_file.as_posix())
+        self._xml_tree = self.__parse_tree(self.progress, self.cancel_token)
+        self.cancel_token.check()
 
         # ----------------------
         # Iterate actionList's
         for e in self.iterate_xml_action_list_elements():
-            if not e.get('name'):
-                continue
-
-            self.xml_dict[e.get('name')] = dict()
+            self.cancel_token.check()
 
-            # Add switch actors
-            self._find_actors(e, 'switch', self.switches)
-            # Add appearance actors
-            self._find_actors(e, 'appearance', self.looks)
-            # Add stateObject actors
-            self._find_actors(e, 'stateObject', self.state_objects)
+            self.add_action_list(e)
 
         # ----------------------
         # Add condition's and their stateObjects for Xml diagnose
         for e in self.xml_tree.iterfind('*condition'):
-            condition_name = e.findtext('actionListName')
+            self.cancel_token.check()
+            self.add_condition(e)
+
+    def __file_stat(self) -> tuple:
+        stat = self.xml_file.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def __parse_tree(self, progress, cancel_token) -> Et._ElementTree:
+        label = _('{} lesen').format(self.xml_file.name)
+
+        if CompressedFile.compression(self.xml_file):
+            # Decompress while the parser reads
+            with CompressedFile.reader(self.xml_file, label, progress, cancel_token) as reader:
+                return Et.parse(reader)
+
+        with MappedFile.open(self.xml_file) as mapped:
+            if progress is None:
+                root = fromstring(mapped.view, base_url=self.xml_file.as_posix())
+            else:
+                root = self.__feed(mapped, label, progress, cancel_token)
+        return root.getroottree()
+
+    def __feed(self, mapped: MappedFile, label: str, progress, cancel_token) -> Et._Element:
+        """ Feed the mapping to the parser in slices to report progress and check for cancellation """
+        parser, done = Et.XMLParser(), 0
+
+        for view in mapped.iter_views(self.feed_size):
+            cancel_token.check()
+            # The feed interface only accepts bytes, one slice at a time is copied
+            parser.feed(bytes(view))
+            done += len(view)
+            view.release()
+            progress(label, done, mapped.size)
+
+        return parser.close()
+
+    def add_action_list(self, e: Et._Element):
+        if not e.get('name'):
+            return
+
+        al_dict = self.xml_dict[e.get('name')] = dict()
+        actor_dicts = {'switch': self.switches, 'appearance': self.looks, 'stateObject': self.state_objects}
+
+        # Add switch, appearance and stateObject actors
+        for actor, value, actor_type in self.iterate_actors(e):
+            al_dict[actor] = {'value': value, 'type': actor_type}
+            self.__update_actor_dict(actor_dicts[actor_type], actor, value)
+
+    def add_condition(self, e: Et._Element):
+        condition_name, state_objects = self.condition_links(e)
+
+        if not condition_name:
+            return
 
-            if not condition_name:
+        self.conditions[condition_name] = state_objects
+
+    @staticmethod
+    def iterate_actions(e: Et._Element) -> Iterator[Tuple[str, str, str]]:
+        """ actor, value and type of every action of an actionList element """
+        for a in e.iterfind('./*[@type]'):
+            actor, value = a.find('actor'), a.find('value')
+            yield None if actor is None else actor.text, None if value is None else value.text, a.get('type')
+
+    @classmethod
+    def iterate_actors(cls, e: Et._Element) -> Iterator[Tuple[str, str, str]]:
+        """ The actions of iterate_actions with one of the actor_types, grouped by type in actor_types order """
+        actions = {actor_type: list() for actor_type in cls.actor_types}
+        for action in cls.iterate_actions(e):
+            if action[2] in actions:
+                actions[action[2]].append(action)
+
+        for type_actions in actions.values():
+            yield from type_actions
+
+    @staticmethod
+    def condition_links(e: Et._Element) -> Tuple[str, List[str]]:
+        """ actionList name and stateObject names of a condition element """
+        state_objects = list()
+
+        # Add stateObjects
+        for s in e.iterfind("./stateCondition"):
+            state_obj_name = s.findtext('stateObjectName')
+            if state_obj_name:
+                state_objects.append(state_obj_name)
+
+        return e.findtext('actionListName'), state_objects
+
+    @staticmethod
+    def collect_action_list(et: Et._ElementTree, action_list_name: str) \
+            -> Tuple[Union[None, Et._Element], Union[None, Et._Element], List[Union[None, Et._Element]]]:
+        al_elem = et.find(f"*actionList[@name='{action_list_name}']")
+        conditions = et.xpath(f"*/condition/actionListName[text()='{action_list_name}']/..")
+        condition = conditions[0] if conditions else None
+
+        if al_elem is None or condition is None:
+            return None, None, [None]
+
+        # Collect affected state objects
+        state_objects = list()
+        for state_object_name in condition.xpath(f"stateCondition/stateObjectName"):
+            state_object = et.find(f"*stateObject[@name='{state_object_name.text}']")
+            if state_object is not None:
+                state_objects.append(state_object)
+
+        return al_elem, condition, state_objects
+
+    def action_list_document(self, action_list_names, cancel_token=NO_CANCEL, progress=None) -> Et._ElementTree:
+        """ New POS document with copies of the actionLists [action_list_names], their conditions
+            and stateObjects. The element tree of this document is not modified.
+        """
+        root = Et.Element(self.export_dom['root'])
+        state_engine = Et.SubElement(root, self.export_dom['sub_lvl_1'])
+        state_engine.set('autoType', 'variant')
+
+        xml_tree = self.xml_tree
+        label = _('actionLists exportieren')
+        for num, al_name in enumerate(action_list_names, start=1):
+            cancel_token.check()
+            if progress is not None:
+                progress(label, num, len(action_list_names))
+
+            al, condition, state_objects = self.collect_action_list(xml_tree, al_name)
+            if al is None or condition is None:
                 continue
 
-            self.conditions[condition_name] = list()
+            LOGGER.debug('Adding actionList Xml element %s', al_name)
+            state_engine.append(deepcopy(al))
+            state_engine.append(deepcopy(condition))
+            for e in state_objects:
+                state_engine.insert(0, deepcopy(e))
 
-            # Add stateObjects
-            for s in e.iterfind("./stateCondition"):
-                state_obj_name = s.findtext('stateObjectName')
-                if state_obj_name:
-                    self.conditions[condition_name].append(state_obj_name)
+        return Et.ElementTree(root)
 
     def iterate_xml_action_list_elements(self):
         for e in self.xml_tree.iterfind('*actionList'):
             yield e
 
-    def _find_actors(self, e: Et._Element, actor_type: str, actor_dict: dict):
-        for a in e.iterfind(f"./*[@type='{actor_type}']"):
-            actor = a.find('./actor').text
-            value = a.find('./value').text
-            self.xml_dict[e.get('name')][actor] = {'value': value, 'type': actor_type}
-            self.__update_actor_dict(actor_dict, actor, value)
-
     @staticmethod
     def __update_actor_dict(actor_dict, actor, value):
         if actor not in actor_dict.keys():
@@ -180,12 +523,16 @@ class PosXml(object):
         self.missing_al = self.__list_difference(conditions, action_lists)
         self.missing_co = self.__list_difference(action_lists, conditions)
 
-        # Return result as string
-        if not self.missing_al and not self.missing_co:
+        return self.condition_report(self.missing_al, self.missing_co)
+
+    @staticmethod
+    def condition_report(missing_al, missing_co) -> str:
+        """ Return the result of check_conditions as string """
+        if not missing_al and not missing_co:
             return Msg.POS_NO_ERROR
         else:
-            al_s = f'{Msg.POS_AL_ERROR}    {"<br>".join(str(x) for x in self.missing_al)}'
-            co_s = f'{Msg.POS_CO_ERROR}    {"<br>".join(str(x) for x in self.missing_co)}'
+            al_s = f'{Msg.POS_AL_ERROR}    {"<br>".join(str(x) for x in missing_al)}'
+            co_s = f'{Msg.POS_CO_ERROR}    {"<br>".join(str(x) for x in missing_co)}'
             return al_s + '<br><br>' + co_s
 
     def to_string(self, xml: Union[None, Et._Element]=None) -> str:
@@ -199,11 +546,11 @@ class PosXml(object):
             xml = self.xml_tree
         return XmlHelper.to_bytes(xml)
 
-    def write_xml_tree(self, file: Path, xml: Union[None, Et._Element]=None):
+    def write_xml_tree(self, file: Path, xml: Union[None, Et._Element]=None, cancel_token=NO_CANCEL, progress=None):
         if xml is None:
             xml = self.xml_tree
 
-        XmlHelper.write_xml_tree(file, xml)
+        XmlHelper.write_xml_tree(file, xml, cancel_token, progress, _('{} schreiben').format(Path(file).name))
 
 
 class ActionList(object):
@@ -211,6 +558,16 @@ class ActionList(object):
         self.name = name
         self.__actors = dict()
 
+    def to_state(self) -> tuple:
+        return self.name, self.__actors
+
+    @classmethod
+    def from_state(cls, state: tuple):
+        name, actors = state
+        al = cls(name)
+        al.__actors = actors
+        return al
+
     @property
     def actors(self):
         return self.__actors
@@ -237,3 +594,24 @@ class ActionList(object):
     @actors.deleter
     def actors(self):
         self.__actors = dict()
+
+
+class RenamedActionList(ActionList):
+    """ actionList of the new document renamed from [old_name] of the old document, actors are the
+        differences to the old actionList
+    """
+    def __init__(self, name, old_name=None, similarity: float=1.0):
+        super(RenamedActionList, self).__init__(name)
+        self.old_name = old_name
+        self.similarity = similarity
+
+    def to_state(self) -> tuple:
+        name, actors = super(RenamedActionList, self).to_state()
+        return name, actors, self.old_name, self.similarity
+
+    @classmethod
+    def from_state(cls, state: tuple):
+        name, actors, old_name, similarity = state
+        al = super(RenamedActionList, cls).from_state((name, actors))
+        al.old_name, al.similarity = old_name, similarity
+        return al
@@ -0,0 +1,43 @@
+import threading
+
+
+class CancelledError(Exception):
+    """ Raised by CancelToken.check inside an operation that has been cancelled """
+    pass
+
+
+class CancelToken:
+    """
+        Cooperative cancellation flag shared between the GUI and a worker.
+
+        Workers call check() at safe points, it raises CancelledError once cancel() was called.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise CancelledError()
+
+
+class _NoCancel:
+    """ Token used when an operation can not be cancelled """
+    cancelled = False
+
+    @staticmethod
+    def cancel():
+        return
+
+    @staticmethod
+    def check():
+        return
+
+
+NO_CANCEL = _NoCancel()
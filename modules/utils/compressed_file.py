@@ -0,0 +1,135 @@
+import gzip
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.log import init_logging
+from modules.utils.mapped_file import MappedFile
+from modules.utils.progress import ProgressReader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = init_logging(__name__)
+
+
+class CompressedFile:
+    """
+        Transparent gzip and zstandard compression of POS files eg. archived *.xml.gz or *.pos.zst revisions.
+
+        Inputs are recognized by their content and decompressed while the parser reads them, outputs
+        are compressed according to their file suffix. zstandard is optional.
+    """
+    GZIP, ZSTD = 'gzip', 'zstd'
+    suffixes = {'.gz': GZIP, '.zst': ZSTD}
+    pos_suffixes = ('.xml', '.pos')
+    _magic = {b'\x1f\x8b': GZIP, b'\x28\xb5\x2f\xfd': ZSTD}
+
+    gzip_level = 6
+    zstd_level = 3
+
+    @classmethod
+    def available(cls, compression: str) -> bool:
+        return compression != cls.ZSTD or zstandard is not None
+
+    @classmethod
+    def supported_suffixes(cls) -> list:
+        return [s for s, compression in cls.suffixes.items() if cls.available(compression)]
+
+    @classmethod
+    def file_filter(cls) -> str:
+        """ Name filter for POS file dialogs including the supported compressed variants """
+        patterns = [f'*{s}' for s in cls.pos_suffixes]
+        patterns += [f'*{s}{c}' for c in cls.supported_suffixes() for s in cls.pos_suffixes]
+        return ';'.join(patterns)
+
+    @classmethod
+    def base_suffix(cls, file: Union[Path, str]) -> str:
+        """ Suffix of [file] without a compression suffix eg. .xml for pos.xml.gz """
+        file = Path(file)
+        if file.suffix.casefold() in cls.suffixes:
+            return Path(file.stem).suffix.casefold()
+        return file.suffix.casefold()
+
+    @classmethod
+    def suffix_compression(cls, file: Union[Path, str]) -> Union[str, None]:
+        return cls.suffixes.get(Path(file).suffix.casefold())
+
+    @classmethod
+    def compression(cls, file: Union[Path, str]) -> Union[str, None]:
+        """ Compression of [file] detected from it's content, shares a mapping of the file if it is open """
+        with MappedFile.open(file) as mapped:
+            head = bytes(mapped.data[:4])
+
+        for magic, compression in cls._magic.items():
+            if head.startswith(magic):
+                return compression
+
+        return None
+
+    @classmethod
+    @contextmanager
+    def reader(cls, file: Union[Path, str], label: str='', progress=None, cancel_token=NO_CANCEL):
+        """ File like object decompressing [file] while it is read. Progress reports the
+            consumed bytes of the file on disk.
+        """
+        file = Path(file)
+        compression = cls.compression(file)
+        if compression is not None and not cls.available(compression):
+            raise OSError(f'Reading {file.name} requires the zstandard package.')
+
+        with open(file.as_posix(), 'rb') as f:
+            raw = ProgressReader(f, file.stat().st_size, label, progress, cancel_token)
+
+            if compression == cls.GZIP:
+                with gzip.GzipFile(fileobj=raw, mode='rb') as decompressed:
+                    yield decompressed
+            elif compression == cls.ZSTD:
+                with zstandard.ZstdDecompressor().stream_reader(raw, closefd=False) as decompressed:
+                    yield decompressed
+            else:
+                yield raw
+
+    @classmethod
+    @contextmanager
+    def writer(cls, file: Union[Path, str], atomic: bool=False):
+        """ Binary file object compressing according to the suffix of [file]. An atomic writer writes
+            to a temporary file next to [file] which replaces [file] only if no exception occurred.
+        """
+        file = Path(file)
+        compression = cls.suffix_compression(file)
+        if compression is not None and not cls.available(compression):
+            raise OSError(f'Writing {file.name} requires the zstandard package.')
+
+        out_file = file.with_name(f'{file.name}.part') if atomic else file
+
+        try:
+            with open(out_file.as_posix(), 'wb') as f:
+                if compression == cls.GZIP:
+                    # No file name and time stamp in the header, equal documents produce equal files
+                    with gzip.GzipFile(filename='', fileobj=f, mode='wb', compresslevel=cls.gzip_level,
+                                       mtime=0) as compressed:
+                        yield compressed
+                elif compression == cls.ZSTD:
+                    with zstandard.ZstdCompressor(level=cls.zstd_level).stream_writer(f, closefd=False) as compressed:
+                        yield compressed
+                else:
+                    yield f
+        except BaseException:
+            if atomic:
+                cls._remove(out_file)
+            raise
+
+        if atomic:
+            os.replace(out_file.as_posix(), file.as_posix())
+
+    @staticmethod
+    def _remove(file: Path):
+        try:
+            file.unlink()
+        except OSError as e:
+            LOGGER.warning('Could not remove incomplete file %s: %s', file.name, e)
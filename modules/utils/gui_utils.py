@@ -1,20 +1,24 @@
+import importlib
 import logging
 from datetime import datetime
 from pathlib import Path
 from statistics import mean
 from time import time
-from typing import Iterator
+from typing import TYPE_CHECKING, Iterator
 
 from PySide2 import QtCore, QtWidgets
-from PySide2.QtCore import QEvent, QFile, QObject, QTimer, Qt, Signal, Slot
+from PySide2.QtCore import QBuffer, QByteArray, QEvent, QFile, QObject, QTimer, Qt, Signal, Slot
 from PySide2.QtGui import QMouseEvent
 from PySide2.QtWidgets import QTreeWidgetItem, QTreeWidgetItemIterator, QWidget
-from lxml import etree as Et
 
-from modules.utils.globals import UI_PATH, get_current_modules_dir, get_settings_dir
+from modules.utils.cancel import NO_CANCEL
+from modules.utils.globals import FROZEN, UI_PATH, get_current_modules_dir, get_settings_dir
 from modules.utils.log import init_logging
 from modules.utils.ui_loader import loadUi
 
+if TYPE_CHECKING:
+    import lxml.etree
+
 LOGGER = init_logging(__name__)
 
 
@@ -36,6 +40,47 @@ def iterate_widget_items_flat(widget) -> Iterator[QTreeWidgetItem]:
         it += 1
 
 
+def _tree_item_key(item: QTreeWidgetItem) -> tuple:
+    parent = item.parent()
+    if parent is not None:
+        return parent.text(0), item.text(0)
+    return item.text(0),
+
+
+def capture_tree_state(widget) -> dict:
+    """ Remember expanded, selected and current items by their texts and the scroll position """
+    expanded, selected = set(), set()
+
+    for item in iterate_widget_items_flat(widget):
+        if item.isExpanded():
+            expanded.add(_tree_item_key(item))
+        if item.isSelected():
+            selected.add(_tree_item_key(item))
+
+    current = widget.currentItem()
+
+    return {'expanded': expanded, 'selected': selected,
+            'current': _tree_item_key(current) if current is not None else None,
+            'scroll': widget.verticalScrollBar().value()}
+
+
+def restore_tree_state(widget, state: dict):
+    """ Restore a state created by capture_tree_state on re-populated items """
+    if not state:
+        return
+
+    for item in iterate_widget_items_flat(widget):
+        key = _tree_item_key(item)
+        if key in state['expanded']:
+            item.setExpanded(True)
+        if key in state['selected']:
+            item.setSelected(True)
+        if key == state['current']:
+            widget.setCurrentItem(item, 0, QtCore.QItemSelectionModel.NoUpdate)
+
+    widget.verticalScrollBar().setValue(state['scroll'])
+
+
 def time_string(time_f: float) -> str:
     """ Converts time in float seconds to display format
 
@@ -63,27 +108,68 @@ def time_string(time_f: float) -> str:
 
 
 class XmlHelper:
+    """ lxml is imported on first use to keep it out of application start up """
     @staticmethod
-    def to_string(xml: Et._Element) -> str:
+    def to_string(xml: 'lxml.etree._Element') -> str:
+        from lxml import etree as Et
         return Et.tostring(xml,
                            xml_declaration=True,
                            encoding="utf-8",
                            pretty_print=True).decode('utf-8')
 
     @staticmethod
-    def to_bytes(xml: Et._Element) -> bytes:
+    def to_bytes(xml: 'lxml.etree._Element') -> bytes:
+        from lxml import etree as Et
         return Et.tostring(xml, xml_declaration=True, encoding="utf-8", pretty_print=True)
 
     @classmethod
-    def write_xml_tree(cls, file: Path, xml: Et._Element):
-        with open(file.as_posix(), 'wb') as f:
-            f.write(cls.to_bytes(xml))
+    def write_xml_tree(cls, file: Path, xml: 'lxml.etree._Element', cancel_token=NO_CANCEL, progress=None,
+                       label: str='', chunk_size: int=1024 * 1024):
+        """ Write [xml] to [file], compressed if the file name ends with .gz or .zst. The file is
+            replaced only once it is completely written, progress reports the bytes written.
+        """
+        from modules.utils.compressed_file import CompressedFile
+        data = cls.to_bytes(xml)
+
+        with CompressedFile.writer(file, atomic=True) as f, memoryview(data) as view:
+            for offset in range(0, len(data), chunk_size):
+                cancel_token.check()
+                f.write(view[offset:offset + chunk_size])
+
+                if progress is not None:
+                    progress(label, min(offset + chunk_size, len(data)), len(data))
 
 
 class SetupWidget(QObject):
-    @staticmethod
-    def from_ui_file(widget_cls, ui_file, custom_widgets=dict()):
+    """
+        Setup widgets from Qt Designer files.
+
+        Python UI classes created by ui/compile_ui.py are used if available, otherwise
+        the .ui file is parsed at runtime with QUiLoader. Compiled classes and .ui file
+        contents are cached, so widgets created several times eg. overlays share one template.
+    """
+    compiled_prefix = 'ui_'
+
+    # ui file: compiled Ui_ class or None
+    _ui_classes = dict()
+    # ui file: QByteArray of the .ui file content
+    _ui_data = dict()
+
+    @classmethod
+    def from_ui_file(cls, widget_cls, ui_file, custom_widgets=dict()):
         """ Load a Qt .ui file to setup the provided widget """
+        ui_class = cls._get_compiled_class(ui_file)
+
+        if ui_class is not None:
+            LOGGER.info('Setup from compiled UI class: %s - %s', type(widget_cls), ui_class.__name__)
+            ui = ui_class()
+            ui.setupUi(widget_cls)
+
+            # Move the created child widgets to the widget, just like loadUi does
+            for name, obj in vars(ui).items():
+                setattr(widget_cls, name, obj)
+            return
+
         # Store current log level and set it to ERROR for Ui load
         LOGGER.info('Loading UI File: %s - %s', type(widget_cls), ui_file)
 
@@ -91,15 +177,63 @@ class SetupWidget(QObject):
         logging.root.setLevel(logging.ERROR)
 
         # Load the Ui file
-        ui_file = Path(get_current_modules_dir()) / UI_PATH / ui_file
-        file = QFile(ui_file.as_posix())
-        file.open(QFile.ReadOnly)
-        loadUi(file, widget_cls, custom_widgets)
-        file.close()
+        buffer = QBuffer()
+        buffer.setData(cls._get_ui_data(ui_file))
+        buffer.open(QBuffer.ReadOnly)
+        loadUi(buffer, widget_cls, custom_widgets)
+        buffer.close()
 
         # Restore previous log level
         logging.root.setLevel(current_log_level)
 
+    @classmethod
+    def _get_ui_data(cls, ui_file) -> QByteArray:
+        if ui_file not in cls._ui_data:
+            file = QFile((Path(get_current_modules_dir()) / UI_PATH / ui_file).as_posix())
+            file.open(QFile.ReadOnly)
+            cls._ui_data[ui_file] = file.readAll()
+            file.close()
+
+        return cls._ui_data[ui_file]
+
+    @classmethod
+    def _get_compiled_class(cls, ui_file):
+        if ui_file in cls._ui_classes:
+            return cls._ui_classes[ui_file]
+
+        cls._ui_classes[ui_file] = cls._import_compiled_class(ui_file)
+        return cls._ui_classes[ui_file]
+
+    @classmethod
+    def _import_compiled_class(cls, ui_file):
+        ui_path = Path(get_current_modules_dir()) / UI_PATH / ui_file
+        module_name = f'{cls.compiled_prefix}{ui_path.stem}'
+
+        if not FROZEN:
+            # Ignore compiled classes that are older than the .ui file
+            module_path = ui_path.with_name(f'{module_name}.py')
+            try:
+                if not module_path.exists():
+                    return None
+                if ui_path.exists() and ui_path.stat().st_mtime > module_path.stat().st_mtime:
+                    LOGGER.warning('Compiled UI class %s is outdated, loading %s at runtime.',
+                                   module_path.name, ui_path.name)
+                    return None
+            except OSError as e:
+                LOGGER.error('Can not access compiled UI class: %s', e)
+                return None
+
+        try:
+            module = importlib.import_module(f'{UI_PATH}.{module_name}')
+        except ImportError:
+            return None
+
+        for name, obj in vars(module).items():
+            if name.startswith('Ui_') and isinstance(obj, type):
+                return obj
+
+        return None
+
 
 class ConnectCall(QObject):
     def __init__(self, *args, target=None, parent=None):
@@ -149,6 +283,21 @@ class PredictProgressTime(QObject):
 
         return average_step_duration * remaining_steps
 
+    def update_to(self, progressed_steps: int):
+        """ Update with the absolute number of processed steps eg. from throttled progress reports """
+        return time_string(
+            self._predict_remaining_time_to(progressed_steps)
+            )
+
+    def _predict_remaining_time_to(self, progressed_steps: int) -> float:
+        self.progressed_steps = max(1, min(progressed_steps, self.max_steps))
+
+        average_step_duration = (time() - self.progress_start) / self.progressed_steps
+        remaining_steps = self.max_steps - self.progressed_steps
+        self._set_step_start_time()
+
+        return average_step_duration * remaining_steps
+
     def _average_duration(self):
         return mean(self.step_durations)
 
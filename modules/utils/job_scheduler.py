@@ -0,0 +1,350 @@
+import atexit
+import heapq
+import itertools
+import os
+import threading
+from concurrent.futures import CancelledError as FutureCancelledError, Future, ProcessPoolExecutor, TimeoutError
+
+from PySide2 import QtCore
+
+from modules.utils.cancel import CancelToken, CancelledError, NO_CANCEL
+from modules.utils.log import init_logging
+from modules.utils.progress import ThrottledProgress
+from modules.utils.settings import KnechtSettings
+
+LOGGER = init_logging(__name__)
+
+
+class JobPriority:
+    """ Lower values run first """
+    INTERACTIVE = 0
+    EXPORT = 10
+    NORMAL = 20
+    BACKGROUND = 30
+
+
+class JobSignals(QtCore.QObject):
+    """ Completion of a Job, emitted from the worker. Connect slots of QObjects to receive them in their thread. """
+    progress = QtCore.Signal(str, 'qint64', 'qint64')
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+
+class Job:
+    """
+        A unit of work submitted to the JobScheduler.
+
+        Thread jobs receive the cancel_token and progress keyword arguments if they are created with
+        cooperative=True. Process jobs can only be cancelled before they started.
+    """
+    QUEUED, RUNNING, DONE = range(3)
+
+    def __init__(self, name: str, func, args: tuple, kwargs: dict, priority: int, process: bool=False,
+                 progress=None):
+        self.name = name
+        self.priority = priority
+        self.process = process
+        self.state = self.QUEUED
+
+        self.future = Future()
+        self.cancel_token = CancelToken()
+        self.signals = JobSignals()
+        self.listener = progress
+
+        self._func, self._args, self._kwargs = func, args, kwargs
+        self._progress = ThrottledProgress(self._report_progress)
+
+    def __repr__(self):
+        return f'<Job {self.name} priority {self.priority}>'
+
+    def progress(self, label: str, done: int, total: int):
+        self._progress(label, done, total)
+
+    def _report_progress(self, label: str, done: int, total: int):
+        listener = self.listener
+        if listener is not None:
+            listener(label, done, total)
+        self.signals.progress.emit(label, done, total)
+
+    def cancel(self):
+        """ Cancel a queued job or ask a running thread job to stop at it's next check """
+        self.cancel_token.cancel()
+        JobScheduler.cancelled(self)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, cancel_token=NO_CANCEL, poll_interval: float=0.1):
+        """ Wait for the result while [cancel_token] is not cancelled. Cancelled jobs raise CancelledError. """
+        try:
+            while True:
+                cancel_token.check()
+                try:
+                    return self.future.result(timeout=poll_interval)
+                except TimeoutError:
+                    continue
+        except FutureCancelledError:
+            raise CancelledError()
+
+    def _run(self):
+        """ Execute a thread job in the calling worker thread """
+        try:
+            self.cancel_token.check()
+            result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            self._set_exception(e)
+        else:
+            self._set_result(result)
+
+    def _set_result(self, result):
+        self.state = self.DONE
+        if self.future.done():
+            return
+        self.future.set_result(result)
+        self.signals.finished.emit(result)
+
+    def _set_exception(self, e: BaseException):
+        self.state = self.DONE
+        if self.future.done():
+            return
+        if isinstance(e, (CancelledError, FutureCancelledError)):
+            self.future.set_exception(CancelledError())
+            self.signals.cancelled.emit()
+            return
+
+        LOGGER.debug('Job %s failed: %s', self.name, e)
+        self.future.set_exception(e)
+        self.signals.failed.emit(str(e))
+
+
+class JobScheduler:
+    """
+        Shared worker pools for parse, diff, export and filter jobs.
+
+        Thread jobs run on a fixed number of worker threads ordered by priority, interactive jobs
+        additionally have a reserved worker so a filter never waits behind a background parse.
+        Process jobs eg. chunks of the parallel parser run in a process pool which is only handed
+        as many jobs as it has workers, so later jobs of higher priority overtake queued ones.
+    """
+    _lock = threading.Lock()
+    _condition = threading.Condition(_lock)
+    _counter = itertools.count()
+
+    _queue = list()  # heap (priority, sequence, job)
+    _threads = list()
+    _idle_threads = 0
+    _interactive_thread = None
+    _running = set()
+    _local = threading.local()
+
+    _process_queue = list()
+    _process_executor = None
+    _processes_running = 0
+    # Guards the executor only, worker processes are spawned without holding the scheduler lock
+    _executor_lock = threading.Lock()
+
+    @staticmethod
+    def thread_workers() -> int:
+        return max(2, int(KnechtSettings.app.get('job_threads', 0)) or min(4, os.cpu_count() or 1))
+
+    @staticmethod
+    def process_workers() -> int:
+        return int(KnechtSettings.app.get('job_processes', 0)) or os.cpu_count() or 1
+
+    @classmethod
+    def current_priority(cls) -> int:
+        """ Priority of the job running in this thread, sub jobs eg. parse chunks inherit it """
+        job = getattr(cls._local, 'job', None)
+        return JobPriority.NORMAL if job is None else job.priority
+
+    @classmethod
+    def submit(cls, func, *args, name: str='', priority: int=JobPriority.NORMAL, progress=None,
+               cooperative: bool=False, **kwargs) -> Job:
+        """ Run func(*args, **kwargs) on a worker thread. Cooperative functions are passed the
+            jobs cancel_token and progress as keyword arguments.
+        """
+        return cls.enqueue(cls.create_job(func, *args, name=name, priority=priority, progress=progress,
+                                          cooperative=cooperative, **kwargs))
+
+    @staticmethod
+    def create_job(func, *args, name: str='', priority: int=JobPriority.NORMAL, progress=None,
+                   cooperative: bool=False, **kwargs) -> Job:
+        """ Create a thread job like submit without running it. Connect it's signals, then enqueue it,
+            so a job finishing right away can not emit before anything is connected.
+        """
+        job = Job(name or getattr(func, '__name__', 'job'), func, args, kwargs, priority, progress=progress)
+        if cooperative:
+            job._kwargs.update(cancel_token=job.cancel_token, progress=job.progress)
+        return job
+
+    @classmethod
+    def enqueue(cls, job: Job) -> Job:
+        with cls._lock:
+            heapq.heappush(cls._queue, (job.priority, next(cls._counter), job))
+            cls._start_threads(job.priority)
+            cls._condition.notify_all()
+
+        return job
+
+    @classmethod
+    def submit_process(cls, func, *args, name: str='', priority: int=JobPriority.NORMAL) -> Job:
+        """ Run the picklable func(*args) in the process pool """
+        job = Job(name or getattr(func, '__name__', 'job'), func, args, dict(), priority, process=True)
+
+        with cls._lock:
+            heapq.heappush(cls._process_queue, (priority, next(cls._counter), job))
+        cls._dispatch_processes()
+
+        return job
+
+    @classmethod
+    def prioritize(cls, job: Job, priority: int):
+        """ Move [job] eg. a background parse the user now waits for ahead. A running job passes the
+            priority on to the sub jobs it submits from now on.
+        """
+        with cls._lock:
+            if priority >= job.priority:
+                return
+
+            job.priority = priority
+            if job.state != Job.QUEUED:
+                return
+            queue = cls._process_queue if job.process else cls._queue
+            # The previous entry is skipped once the job left the queued state
+            heapq.heappush(queue, (priority, next(cls._counter), job))
+
+            if not job.process:
+                cls._start_threads(priority)
+                cls._condition.notify_all()
+
+    @classmethod
+    def cancelled(cls, job: Job):
+        with cls._lock:
+            if job.state != Job.QUEUED:
+                return
+            job.state = Job.DONE
+
+        job._set_exception(CancelledError())
+
+    @classmethod
+    def _start_threads(cls, priority: int):
+        """ Start worker threads on demand, called with the lock held """
+        if cls._idle_threads:
+            return
+
+        if len(cls._threads) < cls.thread_workers():
+            thread = threading.Thread(target=cls._worker, name=f'JobWorker-{len(cls._threads)}', daemon=True)
+            cls._threads.append(thread)
+            thread.start()
+        elif priority <= JobPriority.INTERACTIVE and cls._interactive_thread is None:
+            cls._interactive_thread = threading.Thread(target=cls._worker, args=(JobPriority.INTERACTIVE, ),
+                                                       name='JobWorker-interactive', daemon=True)
+            cls._interactive_thread.start()
+
+    @classmethod
+    def _next_job(cls, max_priority: int=None) -> Job:
+        with cls._lock:
+            while True:
+                while cls._queue and cls._queue[0][2].state != Job.QUEUED:
+                    heapq.heappop(cls._queue)
+
+                if cls._queue and (max_priority is None or cls._queue[0][0] <= max_priority):
+                    job = heapq.heappop(cls._queue)[2]
+                    job.state = Job.RUNNING
+                    cls._running.add(job)
+                    return job
+
+                # The interactive worker does not count as idle, it can not take every job
+                idle = 1 if max_priority is None else 0
+                cls._idle_threads += idle
+                cls._condition.wait()
+                cls._idle_threads -= idle
+
+    @classmethod
+    def _worker(cls, max_priority: int=None):
+        while True:
+            job = cls._next_job(max_priority)
+            if job.future.set_running_or_notify_cancel():
+                cls._local.job = job
+                job._run()
+                cls._local.job = None
+
+            with cls._lock:
+                cls._running.discard(job)
+            # Drop references to the job and it's result while idle
+            del job
+
+    @classmethod
+    def _executor(cls) -> ProcessPoolExecutor:
+        with cls._executor_lock:
+            if cls._process_executor is None:
+                cls._process_executor = ProcessPoolExecutor(max_workers=cls.process_workers())
+            return cls._process_executor
+
+    @classmethod
+    def _dispatch_processes(cls):
+        """ Hand queued process jobs to the pool while it has free workers """
+        jobs = list()
+        with cls._lock:
+            while cls._process_queue and cls._processes_running < cls.process_workers():
+                job = heapq.heappop(cls._process_queue)[2]
+                if job.state != Job.QUEUED:
+                    continue
+
+                job.state = Job.RUNNING
+                cls._processes_running += 1
+                jobs.append(job)
+
+        if not jobs:
+            return
+
+        # Submitting spawns the worker processes, submit() of other threads must not wait for that
+        executor = cls._executor()
+        for job in jobs:
+            job.future.set_running_or_notify_cancel()
+            try:
+                future = executor.submit(job._func, *job._args)
+            except Exception as e:
+                with cls._lock:
+                    cls._processes_running -= 1
+                job._set_exception(e)
+                continue
+            future.add_done_callback(lambda f, j=job: cls._process_done(j, f))
+
+    @classmethod
+    def _process_done(cls, job: Job, future: Future):
+        with cls._lock:
+            cls._processes_running -= 1
+
+        if future.cancelled() or job.cancel_token.cancelled:
+            job._set_exception(CancelledError())
+        elif future.exception() is not None:
+            job._set_exception(future.exception())
+        else:
+            job._set_result(future.result())
+
+        cls._dispatch_processes()
+
+    @classmethod
+    def shutdown(cls):
+        """ Cancel queued jobs and ask running thread jobs to stop, worker threads are daemonic and do
+            not block the exit. The process pool finishes it's running jobs and shuts down cleanly before
+            the interpreter does.
+        """
+        with cls._lock:
+            jobs = [entry[2] for entry in cls._queue + cls._process_queue] + list(cls._running)
+            cls._queue.clear()
+            cls._process_queue.clear()
+
+        for job in jobs:
+            job.cancel()
+
+        with cls._executor_lock:
+            executor, cls._process_executor = cls._process_executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+atexit.register(JobScheduler.shutdown)
@@ -5,6 +5,9 @@ from gettext import translation
 
 from modules.utils.globals import get_current_modules_dir, APP_NAME
 
+# Translation loaded once and shared by all modules
+_TRANSLATION = None
+
 
 def get_ms_windows_language():
     """ Currently we only support english and german """
@@ -48,6 +51,10 @@ def setup_translation(language=None):
 
 
 def get_translation():
+    global _TRANSLATION
+    if _TRANSLATION is not None:
+        return _TRANSLATION
+
     # Set OS language if not already set
     lang = os.environ.get('LANGUAGE')
 
@@ -58,4 +65,5 @@ def get_translation():
 
     locale_dir = os.path.join(get_current_modules_dir(), 'locale')
 
-    return translation(APP_NAME, localedir=locale_dir, codeset='UTF-8')
+    _TRANSLATION = translation(APP_NAME, localedir=locale_dir, codeset='UTF-8')
+    return _TRANSLATION
@@ -107,13 +107,7 @@ def setup_log_queue_listener(logger, queue):
 
 def init_logging(logger_name):
     logger_name = logger_name.replace('modules.', '')
-    logger = logging.getLogger(logger_name)
-
-    print('Logger requested by: ',
-          Path(sys._getframe().f_back.f_code.co_filename).name,
-          sys._getframe().f_back.f_code.co_name, logging.getLevelName(logger.getEffectiveLevel()))
-
-    return logger
+    return logging.getLogger(logger_name)
 
 
 class _HandlerSignal(QObject):
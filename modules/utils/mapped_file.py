@@ -0,0 +1,108 @@
+import mmap
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Union
+
+from modules.utils.log import init_logging
+
+if TYPE_CHECKING:
+    import lxml.etree
+
+LOGGER = init_logging(__name__)
+
+
+class MappedFile:
+    """
+        Read only memory mapping of a file, shared by everyone who opens the same unchanged
+        file while it is mapped eg. a background parse and the content hasher. Slices of [view]
+        are zero copy memoryviews, [data] supports find and re. Parser feed interfaces only accept
+        bytes, they get a copy of one slice at a time.
+
+        Use as context manager and release or drop views before leaving it, the mapping is closed
+        when the last user closes it. Mapped files can not be replaced on Windows, so keep mappings short lived.
+    """
+    # resolved path: MappedFile
+    _mapped = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, path: Path, key: tuple):
+        self.path = path
+        self.key = key
+        self._refs = 0
+        self._file = open(path.as_posix(), 'rb')
+
+        if key[2]:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can not be mapped
+            self.data = b''
+        self.view = memoryview(self.data)
+
+    @staticmethod
+    def _key(path: Path) -> tuple:
+        stat = path.stat()
+        return path.resolve().as_posix(), stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def open(cls, path: Union[Path, str]):
+        """ Map [path] or share the existing mapping of the unchanged file """
+        path = Path(path)
+        key = cls._key(path)
+
+        with cls._lock:
+            mapped = cls._mapped.get(key[0])
+            if mapped is None or mapped.key != key:
+                mapped = cls(path, key)
+                cls._mapped[key[0]] = mapped
+
+            mapped._refs += 1
+
+        return mapped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return self.key[2]
+
+    def iter_views(self, chunk_size: int, start: int=0, end: int=None) -> Iterator[memoryview]:
+        """ Yield consecutive zero copy views of at most [chunk_size] bytes """
+        end = self.size if end is None else end
+        for offset in range(start, end, chunk_size):
+            yield self.view[offset:min(offset + chunk_size, end)]
+
+    def close(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+
+            if self._mapped.get(self.key[0]) is self:
+                del self._mapped[self.key[0]]
+
+        try:
+            self.view.release()
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+        except BufferError:
+            # A view is still referenced somewhere, the mapping is closed once it is collected
+            LOGGER.warning('Mapping of %s is still in use and will be closed later.', self.path.name)
+        self._file.close()
+
+
+def fromstring(buffer, base_url: str=None) -> 'lxml.etree._Element':
+    """ Parse a buffer eg. a view of a mapping in place, lxml versions only accepting bytes get a copy """
+    from lxml import etree as Et
+
+    if not len(buffer):
+        # Let lxml report the empty document
+        buffer = b''
+
+    try:
+        return Et.fromstring(buffer, base_url=base_url)
+    except ValueError:
+        return Et.fromstring(bytes(buffer), base_url=base_url)
@@ -0,0 +1,97 @@
+import cProfile
+import io
+import os
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+from modules.utils.globals import get_settings_dir
+from modules.utils.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+
+class Profiler:
+    """
+        On-demand cProfile capture of compare and export runs.
+
+        Enabled by environment variable POS_SCHNUFFI_PROFILE or the profiling menu action.
+        Results are written to the settings directory as timestamped *.prof files, readable
+        with pstats or snakeviz, plus a plain text summary sorted by cumulative time.
+    """
+    enabled = os.environ.get('POS_SCHNUFFI_PROFILE', '') not in ('', '0')
+
+    # Number of entries in the text summary
+    summary_lines = 40
+
+    # Profiles accumulated over several calls eg. timer ticks: name: cProfile.Profile
+    _sessions = dict()
+
+    @classmethod
+    def profiled(cls, name: str):
+        """ Decorator profiling every call of the decorated method while profiling is enabled """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not cls.enabled:
+                    return func(*args, **kwargs)
+
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(func, *args, **kwargs)
+                finally:
+                    cls._write(name, profile)
+            return wrapper
+        return decorator
+
+    @classmethod
+    @contextmanager
+    def tick(cls, name: str):
+        """ Accumulate the enclosed block into the session profile [name], written on dump(name) """
+        if not cls.enabled:
+            yield
+            return
+
+        profile = cls._sessions.get(name)
+        if profile is None:
+            profile = cProfile.Profile()
+            cls._sessions[name] = profile
+
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    @classmethod
+    def dump(cls, name: str):
+        """ Write and discard the accumulated session profile [name] """
+        profile = cls._sessions.pop(name, None)
+        if profile is not None:
+            cls._write(name, profile)
+
+    @classmethod
+    def _write(cls, name: str, profile: cProfile.Profile):
+        settings_dir = get_settings_dir()
+        if not settings_dir:
+            LOGGER.error('Can not write profile %s, settings directory not available.', name)
+            return
+
+        file_name = datetime.now().strftime(f'PosSchnuffi_Profile_{name}_%Y-%m-%d_%H%M%S_%f')
+        prof_file = Path(settings_dir) / f'{file_name}.prof'
+
+        try:
+            profile.dump_stats(prof_file.as_posix())
+
+            summary = io.StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(cls.summary_lines)
+            with open(prof_file.with_suffix('.txt'), 'w') as f:
+                f.write(summary.getvalue())
+        except Exception as e:
+            LOGGER.error('Could not write profile %s: %s', prof_file.as_posix(), e)
+            return
+
+        LOGGER.info('Profile %s written to %s', name, prof_file.as_posix())
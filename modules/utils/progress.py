@@ -0,0 +1,50 @@
+from time import monotonic
+
+from modules.utils.cancel import NO_CANCEL
+
+
+class ThrottledProgress:
+    """
+        Forward progress(label, done, total) to a callback at most every [interval] seconds.
+        The first and the final update of a stage are always forwarded.
+    """
+    def __init__(self, callback=None, interval: float=0.1):
+        self.callback = callback
+        self.interval = interval
+        self._last_update = 0.0
+        self._last_label = None
+
+    def __call__(self, label: str, done: int, total: int):
+        if self.callback is None:
+            return
+
+        now = monotonic()
+        if label == self._last_label and done < total and now - self._last_update < self.interval:
+            return
+
+        self._last_update, self._last_label = now, label
+        self.callback(label, done, total)
+
+
+class ProgressReader:
+    """
+        File like object reporting the number of bytes consumed by a parser eg. lxml.etree.parse
+        and checking for cancellation on every read.
+    """
+    def __init__(self, file_obj, total: int, label: str, progress=None, cancel_token=NO_CANCEL):
+        self.file_obj = file_obj
+        self.total = total
+        self.label = label
+        self.progress = progress
+        self.cancel_token = cancel_token
+        self.bytes_read = 0
+
+    def read(self, size: int=-1) -> bytes:
+        self.cancel_token.check()
+        data = self.file_obj.read(size)
+        self.bytes_read += len(data)
+
+        if self.progress is not None:
+            self.progress(self.label, min(self.bytes_read, self.total), self.total)
+
+        return data
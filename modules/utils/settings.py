@@ -5,8 +5,6 @@ import zlib
 from pathlib import Path
 from typing import Union, Any
 
-import jsonpickle
-
 from modules.utils.globals import Resource, UI_PATH, UI_PATHS_FILE, SETTINGS_FILE
 from modules.utils.globals import get_current_modules_dir, get_settings_dir
 from modules.utils.language import setup_translation
@@ -18,7 +16,11 @@ def delayed_log_setup():
     LOGGER = init_logging(__name__)
 
 
-jsonpickle.set_preferred_backend('ujson')
+def _jsonpickle():
+    """ Import jsonpickle on first use, it is not needed during application start up """
+    import jsonpickle
+    jsonpickle.set_preferred_backend('ujson')
+    return jsonpickle
 
 
 class Settings:
@@ -80,6 +82,7 @@ class Settings:
     @staticmethod
     def pickle_save(obj: object, file: Path, compressed: bool=False) -> bool:
         try:
+            jsonpickle = _jsonpickle()
             w = 'wb' if compressed else 'w'
             with open(file.as_posix(), w) as f:
                 if compressed:
@@ -102,6 +105,7 @@ class Settings:
 
         try:
             start = time.time()
+            jsonpickle = _jsonpickle()
             r = 'rb' if compressed else 'r'
 
             with open(file.as_posix(), r) as f:
@@ -1,11 +1,15 @@
+from typing import TYPE_CHECKING
+
 from PySide2.QtGui import QFont, QFontDatabase, QIcon, QPixmap
-from PySide2.QtMultimedia import QSound
 
 from modules.utils.globals import Resource
 from modules.utils.language import get_translation
 from modules.utils.log import init_logging
 from modules.utils.settings import KnechtSettings
 
+if TYPE_CHECKING:
+    from PySide2.QtMultimedia import QSound
+
 LOGGER = init_logging(__name__)
 
 # translate strings
@@ -129,7 +133,10 @@ class SoundRsc:
     positive = 'positive'
 
     @classmethod
-    def _get_resource_from_key(cls, resource_key, parent=None) -> QSound:
+    def _get_resource_from_key(cls, resource_key, parent=None) -> 'QSound':
+        # QtMultimedia is slow to load, import it only when a sound is requested
+        from PySide2.QtMultimedia import QSound
+
         if resource_key in cls.storage:
             return cls.storage.get(resource_key)
 
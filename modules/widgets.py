@@ -5,6 +5,7 @@ from PySide2 import QtWidgets
 from PySide2.QtCore import Signal
 from PySide2.QtWidgets import QWidget, QMessageBox
 
+from modules.utils.compressed_file import CompressedFile
 from modules.utils.globals import Resource, UI_FILE_DIALOG
 from modules.utils.gui_utils import SetupWidget
 
@@ -94,7 +95,7 @@ class FileWindow(QtWidgets.QWidget):
                                              mode='file',
                                              line_edit=self.OldLineEdit,
                                              tool_button=self.OldToolButton,
-                                             dialog_args=('POS XML wählen', 'DeltaGen POS Datei (*.xml;*.pos)'),
+                                             dialog_args=('POS XML wählen', f'DeltaGen POS Datei ({CompressedFile.file_filter()})'),
                                              reject_invalid_path_edits=True,
                                              )
         self.old_file_dlg.path_changed.connect(self.save_old_path_setting)
@@ -103,7 +104,7 @@ class FileWindow(QtWidgets.QWidget):
                                              mode='file',
                                              line_edit=self.NewLineEdit,
                                              tool_button=self.NewToolButton,
-                                             dialog_args=('POS XML wählen', 'DeltaGen POS Datei (*.xml;*.pos)'),
+                                             dialog_args=('POS XML wählen', f'DeltaGen POS Datei ({CompressedFile.file_filter()})'),
                                              reject_invalid_path_edits=True,
                                              )
         self.new_file_dlg.path_changed.connect(self.save_new_path_setting)
@@ -153,20 +154,37 @@ class FileWindow(QtWidgets.QWidget):
         if self.verify_pos_path(new_path):
             self.new_file_dlg.set_path(new_path)
 
-    @staticmethod
-    def save_old_path_setting(old_path: Path):
+    @classmethod
+    def save_old_path_setting(cls, old_path: Path):
         KnechtSettings.app['pos_old_path'] = old_path.as_posix()
+        cls.preload_pos_file(old_path)
 
-    @staticmethod
-    def save_new_path_setting(new_path: Path):
+    @classmethod
+    def save_new_path_setting(cls, new_path: Path):
         KnechtSettings.app['pos_new_path'] = new_path.as_posix()
+        cls.preload_pos_file(new_path)
+
+    @classmethod
+    def preload_pos_file(cls, pos_path: Path):
+        """ Start parsing a chosen POS file in the background before the compare is requested """
+        if not cls.verify_pos_path(pos_path):
+            return
+
+        from modules.pos_schnuffi_preload import PosXmlPreloader
+        if PosXmlPreloader.enabled():
+            PosXmlPreloader.preload(pos_path)
 
     @staticmethod
     def verify_pos_path(pos_path: Path):
         if not pos_path:
             return False
 
-        if pos_path.suffix.casefold() not in ['.pos', '.xml']:
+        if CompressedFile.base_suffix(pos_path) not in CompressedFile.pos_suffixes:
+            return False
+
+        compression = CompressedFile.suffix_compression(pos_path)
+        if compression is not None and not CompressedFile.available(compression):
+            LOGGER.warning('Reading %s requires the zstandard package.', pos_path.name)
             return False
 
         if not pos_path.exists():
@@ -1,15 +1,17 @@
+from time import perf_counter
+START_TIME = perf_counter()
+
 import sys
 
+import importlib
 import logging
 import multiprocessing
 from multiprocessing import Queue
 
-from modules.utils.globals import FROZEN, MAIN_LOGGER_NAME, Resource
+from modules.utils.globals import FROZEN, MAIN_LOGGER_NAME
 from modules.utils.gui_utils import KnechtExceptionHook
-from modules.main_app import SchnuffiApp
 from modules.utils.log import init_logging, setup_log_queue_listener, setup_logging
 from modules.utils.settings import KnechtSettings, delayed_log_setup
-from ui import pos_schnuffi_res
 
 VERSION = '1.11'
 
@@ -28,8 +30,10 @@ def initialize_log_listener(logging_queue):
 def shutdown(log_listener):
     #
     # ---- CleanUp ----
-    # We do this just to prevent the IDE from deleting the imports
-    pos_schnuffi_res.qCleanupResources()
+    # Release the Qt resources, if the GUI was started
+    pos_schnuffi_res = sys.modules.get('ui.pos_schnuffi_res')
+    if pos_schnuffi_res:
+        pos_schnuffi_res.qCleanupResources()
 
     # Shutdown logging and remove handlers
     LOGGER.info('Shutting down log queue listener and logging module.')
@@ -67,12 +71,15 @@ def main():
         shutdown(log_listener)
         return
 
-    print(Resource.ui_paths)
-
     #
     #
     # ---- Start application ----
-    app = SchnuffiApp(VERSION)
+    # Qt resources and the GUI modules are imported only after logging and settings are ready,
+    # importing the resource module registers the resources
+    importlib.import_module('ui.pos_schnuffi_res')
+    from modules.main_app import SchnuffiApp
+
+    app = SchnuffiApp(VERSION, START_TIME)
     result = app.exec_()
     #
     #
@@ -16,7 +16,7 @@ a = Analysis(['schnuffi.py'],
              pathex=['E:\\PycharmProjects\\PosSchnuffi'],
              binaries=[],
              datas=viewer_files,
-             hiddenimports=[],
+             hiddenimports=['ui.ui_POS_Schnuffi', 'ui.ui_POS_Schnuffi_File_Dialog', 'ui.ui_overlay'],
              hookspath=local_hooks,
              runtime_hooks=[],
              excludes=[],
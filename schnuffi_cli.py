@@ -0,0 +1,254 @@
+"""
+    POS Schnuffi command line.
+
+    usage: python schnuffi_cli.py daemon [--port PORT]
+           python schnuffi_cli.py status | stop
+           python schnuffi_cli.py compare NEW OLD [--json] [--no-daemon]
+           python schnuffi_cli.py report NEW OLD OUT_FILE [--no-daemon]
+           python schnuffi_cli.py export POS_FILE OUT_FILE -a ACTION_LIST [-a ...] [--no-daemon]
+           python schnuffi_cli.py query POS_FILE [-a ACTION_LIST ...] [--no-daemon]
+           python schnuffi_cli.py columnar POS_FILE [POS_FILE ...] -o OUT_DIR [--format parquet|arrow]
+
+    Requests are answered by a running diff daemon, which keeps parsed documents in memory,
+    and in-process otherwise. compare and report exit with 0 if the documents do not differ, 1 if they
+    differ and 2 on errors.
+"""
+import argparse
+import contextlib
+import logging
+import multiprocessing
+import sys
+from pathlib import Path
+
+# The modules package reports loading the settings on stdout, keep stdout for results
+with contextlib.redirect_stdout(sys.stderr):
+    import ujson
+
+    from modules.pos_schnuffi_columnar import ColumnarExport
+    from modules.pos_schnuffi_daemon import DaemonClient, DaemonError, DiffDaemon, diff_from_json, query_document
+    from modules.pos_schnuffi_diff_cache import DiffCache
+    from modules.pos_schnuffi_report import DiffReport
+    from modules.pos_schnuffi_worker import load_or_create_diff
+    from modules.pos_schnuffi_xml_diff import PosXml
+    from modules.utils.gui_utils import XmlHelper
+
+EXIT_SAME, EXIT_DIFFERENT, EXIT_ERROR = 0, 1, 2
+
+
+def print_json(data):
+    print(ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, indent=2))
+
+
+def progress_printer(verbose: bool):
+    if not verbose:
+        return None
+
+    def progress(label: str, done: int, total: int):
+        print(f'{label}: {done}/{total}' if total else f'{label}: {done}', file=sys.stderr)
+    return progress
+
+
+def request_daemon(args, cmd: str, **kwargs) -> dict:
+    """ Result of the daemon or None if it should be answered in-process """
+    if getattr(args, 'no_daemon', False):
+        return None
+
+    client = DaemonClient.connect()
+    if client is None:
+        logging.info('Diff daemon not running, working in-process.')
+        return None
+
+    try:
+        with client:
+            return client.request(cmd, progress=progress_printer(args.verbose), **kwargs)
+    except (DaemonError, OSError) as e:
+        logging.error('Diff daemon request failed, working in-process: %s', e)
+        return None
+
+
+def daemon_path(path: str) -> str:
+    """ The daemon runs in another working directory, send absolute paths """
+    return Path(path).resolve().as_posix()
+
+
+def diff_summary(diff) -> dict:
+    return {
+        'no_difference': diff.no_difference, 'error_num': diff.error_num,
+        'added': sorted(al.name for al in diff.added_action_ls),
+        'modified': sorted(al.name for al in diff.modified_action_ls),
+        'removed': sorted(al.name for al in diff.removed_action_ls),
+        'renamed': sorted([al.old_name, al.name] for al in diff.renamed_action_ls),
+        'switches': {'added': sorted(map(str, diff.add_switches)), 'removed': sorted(map(str, diff.rem_switches)),
+                     'modified': sorted(map(str, diff.mod_switches))},
+        'looks': {'added': sorted(map(str, diff.add_looks)), 'removed': sorted(map(str, diff.rem_looks)),
+                  'modified': sorted(map(str, diff.mod_looks))},
+        }
+
+
+def get_diff(args):
+    # The command line does not show the POS views
+    result = request_daemon(args, 'compare', new=daemon_path(args.new), old=daemon_path(args.old),
+                            views=False)
+    if result is not None:
+        return diff_from_json(result['diff'])
+
+    diff, cache_key = load_or_create_diff(args.new, args.old, progress=progress_printer(args.verbose))
+    if cache_key is not None:
+        DiffCache.save(diff, cache_key)
+    return diff
+
+
+def compare(args) -> int:
+    diff = get_diff(args)
+
+    summary = diff_summary(diff)
+    if args.json:
+        print_json(summary)
+    else:
+        for key in ('added', 'modified', 'removed', 'renamed'):
+            print(f'{len(summary[key]):>6} actionLists {key}')
+        for actor_type in ('switches', 'looks'):
+            counts = ', '.join(f'{len(v)} {k}' for k, v in summary[actor_type].items())
+            print(f'{actor_type:>18}: {counts}')
+        print(f'{summary["error_num"]:>6} condition errors')
+
+    return EXIT_SAME if diff.no_difference else EXIT_DIFFERENT
+
+
+def report(args) -> int:
+    # Fail on unsupported file types before comparing
+    DiffReport.report_format(args.out_file)
+
+    diff = get_diff(args)
+    rows = DiffReport.write(diff, args.out_file, progress=progress_printer(args.verbose))
+    print_json({'out_file': args.out_file, 'rows': rows})
+    return EXIT_SAME if diff.no_difference else EXIT_DIFFERENT
+
+
+def export(args) -> int:
+    result = request_daemon(args, 'export', file=daemon_path(args.pos_file), out=daemon_path(args.out_file),
+                            action_lists=args.action_lists)
+    if result is not None:
+        exported = result['exported']
+    else:
+        tree = PosXml(args.pos_file).action_list_document(args.action_lists)
+        XmlHelper.write_xml_tree(args.out_file, tree)
+        exported = [e.get('name') for e in tree.iterfind('*actionList')]
+
+    print_json({'out_file': args.out_file, 'exported': exported})
+    return EXIT_SAME
+
+
+def query(args) -> int:
+    result = request_daemon(args, 'query', file=daemon_path(args.pos_file), action_lists=args.action_lists)
+    if result is None:
+        result = query_document(PosXml(args.pos_file, lean=True), args.action_lists)
+
+    result.pop('ok', None)
+    print_json(result)
+    return EXIT_SAME
+
+
+def columnar(args) -> int:
+    results = dict()
+    for pos_file in args.pos_files:
+        results[pos_file] = ColumnarExport.write(pos_file, args.out_dir, args.format,
+                                                 progress=progress_printer(args.verbose))
+
+    print_json(results)
+    return EXIT_SAME
+
+
+def daemon(args) -> int:
+    DiffDaemon(port=args.port).run()
+    return EXIT_SAME
+
+
+def status(args) -> int:
+    client = DaemonClient.connect()
+    if client is None:
+        print('Diff daemon is not running.')
+        return EXIT_DIFFERENT
+
+    with client:
+        result = client.request('status')
+    result.pop('ok', None)
+    print_json(result)
+    return EXIT_SAME
+
+
+def stop(args) -> int:
+    client = DaemonClient.connect()
+    if client is None:
+        print('Diff daemon is not running.')
+        return EXIT_SAME
+
+    with client:
+        client.request('shutdown')
+    return EXIT_SAME
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='schnuffi_cli', description='Compare DeltaGen POS files.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log and report progress on stderr')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('daemon', help='run the diff daemon in the foreground')
+    p.add_argument('--port', type=int, default=0, help='localhost port, a free port by default')
+    p.set_defaults(func=daemon)
+
+    commands.add_parser('status', help='show the documents cached by the daemon').set_defaults(func=status)
+    commands.add_parser('stop', help='stop the diff daemon').set_defaults(func=stop)
+
+    p = commands.add_parser('compare', help='compare two POS files')
+    p.add_argument('new')
+    p.add_argument('old')
+    p.add_argument('--json', action='store_true', help='print the changed actionLists and actors as JSON')
+    p.add_argument('--no-daemon', action='store_true', help='compare in-process')
+    p.set_defaults(func=compare)
+
+    p = commands.add_parser('report', help='write the diff of two POS files as XLSX, CSV or JSON report')
+    p.add_argument('new')
+    p.add_argument('old')
+    p.add_argument('out_file', help='.xlsx, .csv or .json, CSV and JSON are compressed if they end with .gz or .zst')
+    p.add_argument('--no-daemon', action='store_true', help='compare in-process')
+    p.set_defaults(func=report)
+
+    p = commands.add_parser('export', help='export actionLists with their conditions into a new POS file')
+    p.add_argument('pos_file')
+    p.add_argument('out_file', help='compressed if it ends with .gz or .zst')
+    p.add_argument('-a', '--action-list', dest='action_lists', action='append', required=True)
+    p.add_argument('--no-daemon', action='store_true')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser('query', help='summary and actors of actionLists of a POS file')
+    p.add_argument('pos_file')
+    p.add_argument('-a', '--action-list', dest='action_lists', action='append')
+    p.add_argument('--no-daemon', action='store_true')
+    p.set_defaults(func=query)
+
+    p = commands.add_parser('columnar', help='convert POS files to Parquet or Arrow tables of actions and '
+                                             'condition links, requires pyarrow')
+    p.add_argument('pos_files', nargs='+')
+    p.add_argument('-o', '--out-dir', required=True)
+    p.add_argument('--format', choices=tuple(ColumnarExport.suffixes), default=ColumnarExport.PARQUET)
+    p.set_defaults(func=columnar)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    multiprocessing.freeze_support()
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+    try:
+        return args.func(args)
+    except Exception as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return EXIT_ERROR
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""
+    Creates python UI classes from the Qt Designer *.ui files with pyside2-uic
+
+    The generated modules ui_<ui file stem>.py are picked up by SetupWidget.from_ui_file
+    instead of parsing the *.ui files at runtime with QUiLoader.
+"""
+import re
+import shutil
+import sys
+from pathlib import Path
+from subprocess import run
+
+UI_DIR = Path(__file__).parent
+COMPILED_PREFIX = 'ui_'
+
+# Generated code imports the compiled resource file as <qrc stem>_rc,
+# the application registers its resources itself from ui.pos_schnuffi_res
+RC_IMPORT = re.compile(r'^import \w+_rc\s*$', re.MULTILINE)
+
+
+def get_uic_path() -> str:
+    scripts_dir = Path(sys.executable).parent  # eg. C:/Python/Scripts
+    for uic in (scripts_dir / 'pyside2-uic.exe', scripts_dir / 'Scripts' / 'pyside2-uic.exe'):
+        if uic.exists():
+            return uic.as_posix()
+
+    return shutil.which('pyside2-uic') or ''
+
+
+def compile_ui(ui_dir: Path=UI_DIR) -> bool:
+    uic = get_uic_path()
+    if not uic:
+        print('Could not locate pyside2-uic. UI files will be loaded at runtime.')
+        return False
+
+    for ui_file in ui_dir.glob('*.ui'):
+        out_file = ui_dir / f'{COMPILED_PREFIX}{ui_file.stem}.py'
+        print(f'Compiling {ui_file.name} -> {out_file.name}')
+
+        result = run([uic, ui_file.as_posix(), '-o', out_file.as_posix()])
+        if result.returncode != 0:
+            print(f'pyside2-uic could not compile {ui_file.name}')
+            return False
+
+        code = out_file.read_text(encoding='utf-8')
+        out_file.write_text(RC_IMPORT.sub('', code), encoding='utf-8')
+
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if compile_ui() else 1)